@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'meals.patients.PatientMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -126,6 +127,70 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 import os
 
+# Alternative database file, e.g. for a scratch copy of the history
+if os.environ.get("BOLUSHISTORY_DB_NAME"):
+    DATABASES["default"]["NAME"] = os.environ["BOLUSHISTORY_DB_NAME"]
+
+# Opt-in database profile for running ingest while the site is in use
+# (BOLUSHISTORY_DB_PROFILE=concurrent).  WAL lets pages read while a write
+# is in progress, connections are reused across requests, and writers
+# wait for a busy database instead of failing.  meals/sqlite.py applies
+# the pragmas to each new connection.
+SQLITE_PRAGMAS = {}
+if os.environ.get("BOLUSHISTORY_DB_PROFILE") == "concurrent":
+    DATABASES["default"].update(
+        CONN_MAX_AGE=600,
+        CONN_HEALTH_CHECKS=True,
+        # Busy timeout, in seconds
+        OPTIONS={"timeout": 30},
+    )
+    SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        # Under WAL a power loss can lose the latest commits but cannot
+        # corrupt the database
+        "synchronous": "normal",
+        "mmap_size": 256*1024*1024,
+        # Negative sizes are in KiB
+        "cache_size": -64*1024,
+        "temp_store": "memory",
+    }
+
+# Directory where each worker process writes its metrics snapshot; the
+# /meals/metrics/ endpoint merges all of them.  Empty keeps metrics local
+# to the process answering the scrape.
+METRICS_DIR = os.environ.get("BOLUSHISTORY_METRICS_DIR", "")
+
+# Insulin action curve for insulin-on-board; see meals/iob.py
+IOB_CURVE = {
+    "model": "exponential",
+    "dia_minutes": 300,
+    "peak_minutes": 75,
+}
+
+# Schedule for `manage.py sync_tandem`; see meals/sync.py
+TANDEM_SYNC = {
+    "interval_seconds": 30*60,
+    "jitter": 0.2,
+    "initial_days": 7,
+}
+
+# Cold storage for old events; see meals/archive.py
+EVENT_ARCHIVE = {
+    "directory": os.environ.get("BOLUSHISTORY_ARCHIVE_DIR",
+                                str(BASE_DIR / "archive")),
+    "after_days": 365,
+}
+
+# Worker processes used by `manage.py render_plots`; None means one per CPU
+PLOT_PRERENDER_WORKERS = None
+
+# Patient whose data is used outside requests (management commands) and by
+# sessions that haven't picked one; see meals/patients.py
+DEFAULT_PATIENT = int(os.environ.get("BOLUSHISTORY_PATIENT", 1))
+
+# Switching patients requires a login; the admin's is the only login page
+LOGIN_URL = "admin:login"
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
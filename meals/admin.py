@@ -1,9 +1,362 @@
-from django.contrib import admin
-from .models import Dish, Meal, InsulinDelivery, GlucoseMeasurement
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import OperationalError, connections, transaction
+from django.db.models import Max, Min
+from django.shortcuts import redirect, render
+from django.urls import path, reverse
+from django.utils.functional import cached_property
 
-admin.site.register(Dish)
-admin.site.register(Meal)
-admin.site.register(InsulinDelivery)
-admin.site.register(GlucoseMeasurement)
+from datetime import datetime, timedelta
+import calendar
 
+from . import patients
+from .forms import DishForm
+from .models import Dish, Meal, InsulinDelivery, GlucoseMeasurement, \
+    IngestManifest, Patient
 
+import logging
+logger = logging.getLogger(__name__)
+
+# Query string parameter holding the keyset cursor for event changelists
+CURSOR_VAR = "before"
+
+
+def _table_stat(cursor, table):
+    # The (patient, when) constraint is the table's only automatic index
+    try:
+        cursor.execute(
+            "SELECT stat FROM sqlite_stat1 WHERE tbl = %s"
+            " AND idx LIKE 'sqlite_autoindex_%%' LIMIT 1", [table])
+        return cursor.fetchone()
+    except OperationalError:
+        # sqlite_stat1 doesn't exist until the first ANALYZE
+        return None
+
+
+def estimate_count(model):
+    """Approximate row count of the active patient's events
+
+    Uses the planner statistics left by ANALYZE (the average rows per
+    patient on the (patient, when) index), analyzing the table the first
+    time they are missing; only an empty table, which ANALYZE records
+    nothing for, or a database that is busy is counted instead.
+    """
+    connection = connections["default"]
+    if connection.vendor == "sqlite":
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            row = _table_stat(cursor, table)
+            if row is None:
+                try:
+                    cursor.execute("ANALYZE %s"
+                                   % connection.ops.quote_name(table))
+                    row = _table_stat(cursor, table)
+                except OperationalError as err:
+                    logger.info("Could not analyze %s: %s" % (table, err))
+        if row:
+            return int(row[0].split()[1])
+    return model.objects.count()
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that avoids COUNT(*) over whole event tables
+
+    Filtered querysets are range scans on the `when` index and are counted
+    exactly; the patient's unfiltered events use estimate_count().
+    """
+
+    @cached_property
+    def count(self):
+        # The only condition of an unfiltered changelist is the patient
+        if len(self.object_list.query.where.children) <= 1:
+            return estimate_count(self.object_list.model)
+        return super().count
+
+
+class KeysetChangeList(ChangeList):
+    """Changelist paged by `when` rather than by OFFSET
+
+    The cursor parameter holds the `when` of the last row on the previous
+    page; the next page is the following rows by descending `when`, which
+    is an index range scan however deep into the history it is.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = None
+        value = request.GET.get(CURSOR_VAR)
+        if value:
+            try:
+                self.cursor = datetime.fromisoformat(value)
+            except ValueError:
+                pass
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        super().get_results(request)
+        if self.cursor is not None:
+            self.result_list = self.queryset.filter(
+                when__lt=self.cursor)[:self.list_per_page]
+        elif self.multi_page and not self.show_all:
+            self.result_list = self.queryset[:self.list_per_page]
+        self.result_list = list(self.result_list)
+
+        self.next_cursor = None
+        if len(self.result_list) == self.list_per_page:
+            self.next_cursor = self.result_list[-1].when.isoformat()
+
+    def get_first_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    def get_next_url(self):
+        if self.next_cursor is None:
+            return None
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class WhenDrillDownFilter(admin.SimpleListFilter):
+    """Year / month / day drill-down expressed as `when` range lookups
+
+    Unlike date_hierarchy, listing the choices never runs a DISTINCT over
+    the table: years come from MIN/MAX of the indexed column.
+    """
+    title = "date"
+    parameter_name = "period"
+
+    def parse(self):
+        value = self.value()
+        if not value:
+            return ()
+        try:
+            return tuple(int(p) for p in value.split("-"))
+        except ValueError:
+            return ()
+
+    def lookups(self, request, model_admin):
+        parts = self.parse()
+        if not parts:
+            span = model_admin.model.objects.aggregate(
+                lo=Min("when"), hi=Max("when"))
+            if span["lo"] is None:
+                return []
+            return [(str(y), str(y))
+                    for y in range(span["hi"].year, span["lo"].year - 1, -1)]
+
+        choices = []
+        if len(parts) >= 2:
+            choices.append(("%04d" % parts[0], "%04d" % parts[0]))
+        if len(parts) == 1:
+            choices += [("%04d-%02d" % (parts[0], m), calendar.month_abbr[m])
+                        for m in range(1, 13)]
+        else:
+            (y, m) = parts[:2]
+            choices.append(("%04d-%02d" % (y, m),
+                            "%s %d" % (calendar.month_abbr[m], y)))
+            choices += [("%04d-%02d-%02d" % (y, m, d), str(d))
+                        for d in range(1, calendar.monthrange(y, m)[1] + 1)]
+        return choices
+
+    def range(self):
+        parts = self.parse()
+        try:
+            if len(parts) == 1:
+                return (datetime(parts[0], 1, 1), datetime(parts[0] + 1, 1, 1))
+            if len(parts) == 2:
+                begin = datetime(parts[0], parts[1], 1)
+                return (begin, (begin + timedelta(days=32)).replace(day=1))
+            if len(parts) == 3:
+                begin = datetime(*parts)
+                return (begin, begin + timedelta(days=1))
+        except ValueError:
+            pass
+        return None
+
+    def queryset(self, request, queryset):
+        span = self.range()
+        if span is None:
+            return queryset
+        return queryset.filter(when__gte=span[0], when__lt=span[1])
+
+
+class DeleteRangeForm(forms.Form):
+    start = forms.DateTimeField()
+    end = forms.DateTimeField()
+
+    def clean(self):
+        cleaned = super().clean()
+        if cleaned.get("start") and cleaned.get("end") and \
+           cleaned["end"] <= cleaned["start"]:
+            raise forms.ValidationError("End must be after start")
+        return cleaned
+
+
+class EventSeriesAdmin(admin.ModelAdmin):
+    """Admin for large time-indexed event tables"""
+    ordering = ("-when",)
+    sortable_by = ()
+    list_filter = (WhenDrillDownFilter,)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 200
+    # Rows always belong to the patient being viewed
+    exclude = ("patient",)
+    change_list_template = "admin/meals/keyset_change_list.html"
+    # Which kinds of derived data the model feeds; see derived.refresh_derived
+    derived = {}
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_urls(self):
+        info = (self.model._meta.app_label, self.model._meta.model_name)
+        return [
+            path("delete-range/",
+                 self.admin_site.admin_view(self.delete_range_view),
+                 name="%s_%s_delete_range" % info),
+        ] + super().get_urls()
+
+    def events_changed(self, first, last):
+        """Keep derived data in step after events in [first, last] changed
+
+        Called inside the admin's transaction; the derived data is only
+        refreshed once that commits.
+        """
+        from meals import derived
+
+        patient = patients.current_id()
+
+        def refresh():
+            with patients.using(patient):
+                derived.refresh_derived(first, last, **self.derived)
+        transaction.on_commit(refresh)
+
+    def on_range_deleted(self, start, end):
+        from meals import manifest
+        # Deleted days must not be skipped when re-imported
+        manifest.forget(start, end)
+        self.events_changed(start, end)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # An edit may have moved the event away from its old time
+        times = [obj.when] + ([form.initial["when"]]
+                              if change and "when" in form.initial else [])
+        self.events_changed(min(times), max(times))
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.events_changed(obj.when, obj.when)
+
+    def delete_queryset(self, request, queryset):
+        times = list(queryset.values_list("when", flat=True))
+        super().delete_queryset(request, queryset)
+        if times:
+            self.events_changed(min(times), max(times))
+
+    def delete_range_view(self, request):
+        """Delete every event in [start, end) with a single DELETE"""
+        if not self.has_delete_permission(request):
+            return redirect("admin:index")
+        opts = self.model._meta
+        form = DeleteRangeForm(request.POST or request.GET or None)
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=opts,
+            form=form,
+            title="Delete %s by date range" % opts.verbose_name_plural,
+        )
+        if form.is_valid():
+            start, end = form.cleaned_data["start"], form.cleaned_data["end"]
+            events = self.model.objects.filter(when__gte=start, when__lt=end)
+            if request.method == "POST" and "confirm" in request.POST:
+                with transaction.atomic():
+                    # Event tables have no dependents or signal receivers,
+                    # so this is one DELETE ... WHERE on the when index
+                    deleted, _ = events.delete()
+                    self.on_range_deleted(start, end)
+                logger.warning("Admin %s deleted %d %s from %s to %s"
+                               % (request.user, deleted,
+                                  opts.verbose_name_plural, start, end))
+                self.message_user(request, "Deleted %d %s" % (
+                    deleted, opts.verbose_name_plural), messages.SUCCESS)
+                return redirect("admin:%s_%s_changelist"
+                                % (opts.app_label, opts.model_name))
+            context["count"] = events.count()
+        return render(request, "admin/meals/delete_range.html", context)
+
+
+@admin.register(GlucoseMeasurement)
+class GlucoseMeasurementAdmin(EventSeriesAdmin):
+    list_display = ("when", "value")
+    derived = {"readings": True, "boluses": False}
+
+    def events_changed(self, first, last):
+        from meals import coverage
+        coverage.refresh(first, last)
+        super().events_changed(first, last)
+
+
+@admin.register(InsulinDelivery)
+class InsulinDeliveryAdmin(EventSeriesAdmin):
+    list_display = ("when", "amount", "duration", "meal")
+    list_select_related = ("meal__dish",)
+    raw_id_fields = ("meal",)
+    derived = {"readings": False, "boluses": True}
+
+
+@admin.register(Meal)
+class MealAdmin(admin.ModelAdmin):
+    list_display = ("when", "dish", "appx")
+    list_select_related = ("dish",)
+    ordering = ("-when",)
+    raw_id_fields = ("dish",)
+    exclude = ("patient",)
+
+
+@admin.register(Dish)
+class DishAdmin(admin.ModelAdmin):
+    exclude = ("patient",)
+    form = DishForm
+
+
+@admin.register(IngestManifest)
+class IngestManifestAdmin(admin.ModelAdmin):
+    """Review of imported units, in particular ones flagged as changed"""
+    list_display = ("key", "upload_id", "events", "committed", "flagged")
+    list_filter = ("flagged",)
+    search_fields = ("key",)
+    ordering = ("-committed",)
+    exclude = ("patient",)
+    readonly_fields = ("key", "upload_id", "first_source_rec",
+                       "last_source_rec", "events", "checksum", "digests",
+                       "committed")
+    actions = ("clear_flag", "forget")
+
+    def has_add_permission(self, request):
+        # Entries are only written by ingest
+        return False
+
+    @admin.action(description="Clear the changed-content flag")
+    def clear_flag(self, request, queryset):
+        cleared = queryset.filter(flagged=True).update(flagged=False)
+        self.message_user(request, "Cleared the flag on %d entries" % cleared,
+                          messages.SUCCESS)
+
+    @admin.action(description="Forget, so the units are imported again")
+    def forget(self, request, queryset):
+        keys = list(queryset.values_list("key", flat=True))
+        forgotten, _ = queryset.delete()
+        logger.warning("Admin %s forgot manifest entries %s"
+                       % (request.user, ", ".join(keys)))
+        self.message_user(request, "Forgot %d entries; their records will "
+                          "be committed again on the next import"
+                          % forgotten, messages.SUCCESS)
+
+
+admin.site.register(Patient)
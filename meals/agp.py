@@ -0,0 +1,187 @@
+"""Ambulatory glucose profile (AGP)
+
+Readings over the last N days are counted into a histogram of integer
+mg/dL values per minute of the day.  A minute holds too few readings on
+its own, so each minute pools the counts within SMOOTH_MINUTES either
+side of it (a circular running sum, wrapping around midnight); the
+curves are smooth without the steps of coarse bins shifting peaks by up
+to a bin width.  Every percentile of every minute is then read off the
+cumulative counts by binary search, so the cost grows with the readings
+plus the histogram size, not with the pooling width.  Results are cached
+as AGPReport rows and dropped when ingest adds readings inside a cached
+range.
+"""
+
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+RANGES = (14, 30, 90)
+PERCENTILES = (5, 25, 50, 75, 95)
+BIN_MINUTES = 1
+# Half-width of the window of readings pooled into each bin
+SMOOTH_MINUTES = 15
+
+
+def span(days, end):
+    """Return (begin, end) datetimes covering `days` whole days to `end`"""
+    stop = datetime.combine(end + timedelta(days=1), time())
+    return (stop - timedelta(days=days), stop)
+
+
+def figure(result):
+    """Plotly figure of percentile bands against time of day"""
+    import plotly.graph_objects as go
+
+    pct = result["percentiles"]
+    x = [i*result["bin_minutes"]/60 for i in range(len(pct["50"]))]
+    fig = go.Figure()
+    for (lo, hi, opacity) in (("5", "95", 0.2), ("25", "75", 0.4)):
+        fig.add_trace(go.Scatter(x=x, y=pct[lo], line_width=0,
+                                 showlegend=False, hoverinfo="skip"))
+        fig.add_trace(go.Scatter(x=x, y=pct[hi], line_width=0,
+                                 fill="tonexty", opacity=opacity,
+                                 fillcolor="rgba(0,0,255,%s)" % opacity,
+                                 name="%s-%s%%" % (lo, hi)))
+    fig.add_trace(go.Scatter(x=x, y=pct["50"], name="Median",
+                             line_color="blue"))
+    fig.update_xaxes(title_text="Hour of day", range=(0, 24), dtick=3)
+    fig.update_yaxes(title_text="EGV (mg/dL)")
+    return fig.to_html(include_plotlyjs="cdn", full_html=False)
+
+
+def histogram(bins, values, nbins):
+    """Counts of each integer value per bin
+
+    :param bins: integer bin of each value
+    :param values: numpy array of values, rounded to integers
+    :returns: (array of shape (nbins, value range), lowest value)
+    """
+    values = np.rint(values).astype(np.int64)
+    if len(values) == 0:
+        return (np.zeros((nbins, 1), dtype=np.int64), 0)
+    low = int(values.min())
+    width = int(values.max()) - low + 1
+    counts = np.bincount(bins*width + values - low, minlength=nbins*width)
+    return (counts.reshape(nbins, width), low)
+
+
+def pool(hist, width):
+    """Sum each row with the `width` rows either side, wrapping around"""
+    padded = np.concatenate((hist[len(hist) - width:], hist, hist[:width]))
+    cum = np.concatenate((np.zeros((1, hist.shape[1]), dtype=hist.dtype),
+                          np.cumsum(padded, axis=0)))
+    return cum[2*width + 1:] - cum[:len(hist)]
+
+
+def percentiles(hist, low, qs=PERCENTILES):
+    """Linear-interpolated percentiles of each row of a histogram
+
+    :param hist: counts of shape (rows, values), as from histogram()
+    :param low: value of the first column
+    :param qs: percentiles to compute (0-100)
+    :returns: array of shape (len(qs), rows); NaN for empty rows
+    """
+    (nrows, nvalues) = hist.shape
+    counts = hist.sum(axis=1)
+    result = np.full((len(qs), nrows), np.nan)
+    rows = np.flatnonzero(counts)
+    if len(rows) == 0:
+        return result
+    # Offset each row's cumulative counts past the previous row's, so one
+    # searchsorted over the flattened array serves every row at once
+    stride = int(counts.max()) + 1
+    flat = (np.cumsum(hist, axis=1) +
+            np.arange(nrows)[:, None]*stride).ravel()
+
+    def value_at(rank):
+        i = np.searchsorted(flat, rows*stride + rank, side="right")
+        return low + i - rows*nvalues
+
+    n = counts[rows]
+    for (k, q) in enumerate(qs):
+        pos = (n - 1)*q/100.0
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, n - 1)
+        frac = pos - lo
+        result[k, rows] = value_at(lo)*(1 - frac) + value_at(hi)*frac
+    return result
+
+
+def time_in_range(values, stops):
+    """Fraction of readings between consecutive stops (and above the last)"""
+    edges = list(stops) + [np.inf]
+    counts, _ = np.histogram(values, bins=edges)
+    total = max(len(values), 1)
+    return [
+        {"low": edges[i], "high": None if np.isinf(edges[i+1]) else edges[i+1],
+         "fraction": float(counts[i]/total)}
+        for i in range(len(counts))
+    ]
+
+
+def compute(days, end):
+    """Build the AGP for `days` days ending on date `end`"""
+    from meals import archive
+    from meals.models import GLUCOSE_STOPS, GlucoseMeasurement
+
+    begin, stop = span(days, end)
+    rows = [r for r in archive.values(GlucoseMeasurement, ["when", "value"],
+                                      begin, stop) if r[0] < stop]
+    minute = np.array([t.hour*60 + t.minute for (t, _) in rows],
+                      dtype=np.int64)
+    value = np.array([r[1] for r in rows], dtype=float)
+
+    nbins = 24*60//BIN_MINUTES
+    (hist, low) = histogram(minute//BIN_MINUTES, value, nbins)
+    profile = percentiles(pool(hist, SMOOTH_MINUTES//BIN_MINUTES), low)
+
+    return {
+        "days": days,
+        "end": end.isoformat(),
+        "readings": len(rows),
+        "bin_minutes": BIN_MINUTES,
+        "percentiles": {
+            str(q): [None if np.isnan(v) else round(float(v), 1) for v in row]
+            for (q, row) in zip(PERCENTILES, profile)
+        },
+        "time_in_range": time_in_range(value, GLUCOSE_STOPS),
+    }
+
+
+def report(days, end=None):
+    """Cached AGP for `days` days ending on `end` (default today)"""
+    from django.db import IntegrityError, transaction
+    from meals import metrics
+    from meals.models import AGPReport
+
+    end = end or date.today()
+    cached = AGPReport.objects.filter(days=days, end=end).first()
+    metrics.cache_requests.inc(cache="agp",
+                               result="hit" if cached else "miss")
+    if cached:
+        return cached.result
+
+    result = compute(days, end)
+    try:
+        with transaction.atomic():
+            AGPReport.objects.create(days=days, end=end, result=result)
+    except IntegrityError:
+        # Another request computed the same range concurrently
+        pass
+    return result
+
+
+def invalidate(start, end):
+    """Drop cached reports whose range includes [start, end]"""
+    from meals.models import AGPReport
+
+    stale = [r.pk for r in AGPReport.objects.filter(
+                 end__gte=start.date(),
+                 end__lte=end.date() + timedelta(days=max(RANGES)))
+             .only("pk", "days", "end")
+             if span(r.days, r.end)[0] <= end]
+    AGPReport.objects.filter(pk__in=stale).delete()
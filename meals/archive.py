@@ -0,0 +1,379 @@
+"""Cold storage tier for old event data
+
+Whole months of GlucoseMeasurement and InsulinDelivery rows older than
+EVENT_ARCHIVE["after_days"] can be moved out of the database into one
+gzipped JSON file per patient, model and month, recorded by an
+ArchivedMonth row.  The hot tables and their indexes then only hold
+recent history.  Everything here works on the active patient.
+
+Readers go through events(), or values() for bulk column reads, which
+merge archived and hot rows; decoded months are kept in an LRU, so
+browsing around an old meal decodes each month once.  Rows imported into
+an already archived month stay in the database until the next
+move_out(), which merges them into the file.
+
+Derived data (coverage, detections, response vectors, AGP reports, bolus
+links) is computed through these readers, so rebuilding it covers
+archived months too; update() rewrites archived rows in place.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+import gzip
+import json
+import os
+import time
+
+from meals import patients
+from meals.cache import LRUCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Default settings; override with settings.EVENT_ARCHIVE
+DEFAULT_ARCHIVE = {
+    "directory": "archive",
+    # Months ending more than this many days ago are archived
+    "after_days": 365,
+}
+
+# Decoded months kept in memory per process
+CACHED_MONTHS = 24
+
+# Rows deleted per statement once a month is written out
+DELETE_BATCH = 500
+
+# How long a process trusts its cached archive boundary (seconds)
+BOUNDARY_SECONDS = 60
+
+_months = LRUCache("archive", maxsize=CACHED_MONTHS)
+_boundary = {}
+
+
+def get_config(config=None):
+    if config is None:
+        from django.conf import settings
+        config = getattr(settings, "EVENT_ARCHIVE", None) or {}
+    params = dict(DEFAULT_ARCHIVE)
+    params.update(config)
+    return params
+
+
+def event_models():
+    from meals.models import GlucoseMeasurement, InsulinDelivery
+    return (GlucoseMeasurement, InsulinDelivery)
+
+
+def month_start(dt):
+    return date(dt.year, dt.month, 1)
+
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def month_span(month):
+    """[begin, end) datetimes of a month"""
+    return (datetime.combine(month, datetime.min.time()),
+            datetime.combine(next_month(month), datetime.min.time()))
+
+
+def path(model, month, patient=None):
+    if patient is None:
+        patient = patients.current_id()
+    return os.path.join(get_config()["directory"], str(patient),
+                        model._meta.label_lower,
+                        "%s.json.gz" % month.strftime("%Y-%m"))
+
+
+def encode(model, instances):
+    fields = model._meta.concrete_fields
+    rows = []
+    for obj in instances:
+        row = []
+        for f in fields:
+            value = f.value_from_object(obj)
+            row.append(None if value is None else f.value_to_string(obj))
+        rows.append(row)
+    return {"model": model._meta.label_lower,
+            "fields": [f.attname for f in fields], "rows": rows}
+
+
+def decode(model, data):
+    """Unsaved model instances, ordered by time, from encode() output"""
+    fields = {f.attname: f for f in model._meta.concrete_fields}
+    columns = [fields[name] for name in data["fields"]]
+    instances = []
+    for row in data["rows"]:
+        obj = model(**{f.attname: None if v is None else f.to_python(v)
+                       for (f, v) in zip(columns, row)})
+        obj._state.adding = False
+        instances.append(obj)
+    instances.sort(key=lambda obj: obj.when)
+    return instances
+
+
+def write_month(model, month, instances):
+    """Write a month file atomically; returns its size in bytes"""
+    target = path(model, month)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as fp:
+        json.dump(encode(model, instances), fp, separators=(",", ":"))
+    os.replace(tmp, target)
+    return os.path.getsize(target)
+
+
+def read_month(model, record):
+    """Decoded events of an ArchivedMonth, through the LRU
+
+    :returns: (list of times, list of instances), both ordered by time
+    """
+    key = (record.patient_id, record.model, record.month, record.archived)
+    cached = _months.get(key)
+    if cached is not None:
+        return cached
+    with gzip.open(path(model, record.month, record.patient_id), "rt",
+                   encoding="utf-8") as fp:
+        instances = decode(model, json.load(fp))
+    result = ([obj.when for obj in instances], instances)
+    _months.put(key, result)
+    return result
+
+
+def months(model, begin=None, end=None):
+    """ArchivedMonth records overlapping [begin, end]; None is unbounded"""
+    from meals.models import ArchivedMonth
+
+    records = ArchivedMonth.objects.filter(model=model._meta.label_lower)
+    if begin is not None:
+        records = records.filter(month__gte=month_start(begin))
+    if end is not None:
+        records = records.filter(month__lte=month_start(end))
+    return records
+
+
+def archived_until(model):
+    """End of the latest archived month of a model, or None
+
+    Cached for BOUNDARY_SECONDS, so reads of recent windows cost no
+    query; other processes notice a move_out() within that time.
+    """
+    from django.db.models import Max
+    from meals.models import ArchivedMonth
+
+    label = model._meta.label_lower
+    key = (patients.current_id(), label)
+    now = time.monotonic()
+    cached = _boundary.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    latest = (ArchivedMonth.objects.filter(model=label)
+              .aggregate(latest=Max("month"))["latest"])
+    until = month_span(latest)[1] if latest else None
+    _boundary[key] = (now + BOUNDARY_SECONDS, until)
+    return until
+
+
+def is_archived(model, begin, end):
+    until = archived_until(model)
+    return (until is not None and begin < until and
+            months(model, begin, end).exists())
+
+
+def archived(model, begin, end):
+    """Archived events in [begin, end], ordered by time"""
+    result = []
+    for record in months(model, begin, end).order_by("month"):
+        (times, instances) = read_month(model, record)
+        result += instances[bisect_left(times, begin):
+                            bisect_right(times, end)]
+    return result
+
+
+def events(model, begin, end):
+    """Events in [begin, end] from both tiers, ordered by time
+
+    Where both tiers hold an event at the same time, the database row
+    wins.
+    """
+    hot = list(model.objects.filter(when__gte=begin, when__lte=end)
+               .order_by("when"))
+    cold = archived(model, begin, end)
+    if not cold:
+        return hot
+    if not hot:
+        return cold
+    seen = {obj.when for obj in hot}
+    return sorted(hot + [obj for obj in cold if obj.when not in seen],
+                  key=lambda obj: obj.when)
+
+
+def values(model, fields, begin=None, end=None):
+    """Tuples of `fields` for events in [begin, end] from both tiers
+
+    Like events(), ordered by time with database rows winning, but reads
+    only the named columns; without archived months in range this is a
+    single values_list() query.  None leaves that end unbounded.
+
+    :param fields: attribute names, including "when"
+    """
+    hot = model.objects.order_by("when")
+    if begin is not None:
+        hot = hot.filter(when__gte=begin)
+    if end is not None:
+        hot = hot.filter(when__lte=end)
+    hot = list(hot.values_list(*fields))
+    until = archived_until(model)
+    if until is None or (begin is not None and begin >= until):
+        return hot
+
+    i = list(fields).index("when")
+    cold = []
+    for record in months(model, begin, end).order_by("month"):
+        (times, instances) = read_month(model, record)
+        lo = 0 if begin is None else bisect_left(times, begin)
+        hi = len(times) if end is None else bisect_right(times, end)
+        cold += [tuple(getattr(obj, f) for f in fields)
+                 for obj in instances[lo:hi]]
+    if not cold:
+        return hot
+    seen = {row[i] for row in hot}
+    return sorted(hot + [row for row in cold if row[i] not in seen],
+                  key=lambda row: row[i])
+
+
+def update(model, field, changes):
+    """Set `field` on archived events, rewriting their month files
+
+    :param changes: (when, pk, value) of each event to change; events
+        that are not archived are ignored
+    :returns: number of archived events changed
+    """
+    from meals.models import ArchivedMonth
+
+    by_month = {}
+    for (when, pk, value) in changes:
+        by_month.setdefault(month_start(when), {})[pk] = value
+    if not by_month:
+        return 0
+    changed = 0
+    for record in ArchivedMonth.objects.filter(
+            model=model._meta.label_lower, month__in=list(by_month)):
+        wanted = by_month[record.month]
+        # Copies, so readers holding the cached month are unaffected
+        instances = [model(**{f.attname: getattr(obj, f.attname)
+                              for f in model._meta.concrete_fields})
+                     for obj in read_month(model, record)[1]]
+        n = 0
+        for obj in instances:
+            if obj.pk in wanted and getattr(obj, field) != wanted[obj.pk]:
+                setattr(obj, field, wanted[obj.pk])
+                n += 1
+        if n:
+            record.size = write_month(model, record.month, instances)
+            # Saving bumps `archived`, which retires the cached decode
+            record.save()
+            changed += n
+    return changed
+
+
+def _valid_relations(model, instances):
+    """Clear foreign keys to rows deleted since the events were archived"""
+    for f in model._meta.concrete_fields:
+        if not f.is_relation:
+            continue
+        ids = {getattr(obj, f.attname) for obj in instances} - {None}
+        present = set(f.related_model.objects.filter(pk__in=ids)
+                      .values_list("pk", flat=True))
+        for obj in instances:
+            if getattr(obj, f.attname) not in present:
+                setattr(obj, f.attname, None)
+
+
+def move_out(before=None, models=None):
+    """Move whole months ending before `before` to the archive
+
+    :param before: cutoff; defaults to EVENT_ARCHIVE["after_days"] ago
+    :param models: event models to archive; defaults to all of them
+    :returns: dict of model label -> rows moved
+    """
+    from django.db import transaction
+    from django.db.models import Min
+    from meals.models import ArchivedMonth
+
+    if before is None:
+        before = datetime.now() - timedelta(days=get_config()["after_days"])
+    moved = {}
+    for model in models or event_models():
+        label = model._meta.label_lower
+        moved[label] = 0
+        first = model.objects.aggregate(first=Min("when"))["first"]
+        if first is None:
+            continue
+        month = month_start(first)
+        while month_span(month)[1] <= before:
+            (begin, end) = month_span(month)
+            hot = model.objects.filter(when__gte=begin, when__lt=end)
+            rows = list(hot.order_by("when"))
+            if rows:
+                record = ArchivedMonth.objects.filter(
+                    model=label, month=month).first()
+                merged = rows
+                if record is not None:
+                    seen = {obj.when for obj in rows}
+                    merged = rows + [obj for obj in read_month(model, record)[1]
+                                     if obj.when not in seen]
+                # The file is complete before any row is deleted
+                size = write_month(model, month, merged)
+                with transaction.atomic():
+                    ArchivedMonth.objects.update_or_create(
+                        model=label, month=month,
+                        defaults={"rows": len(merged), "size": size})
+                    # Only rows now in the file: ingest may have added
+                    # more since they were read, which stay hot until
+                    # the next move_out()
+                    pks = [obj.pk for obj in rows]
+                    for i in range(0, len(pks), DELETE_BATCH):
+                        model.objects.filter(
+                            pk__in=pks[i:i + DELETE_BATCH]).delete()
+                moved[label] += len(rows)
+                logger.info("Archived %d %s rows for %s"
+                            % (len(rows), label, month.strftime("%Y-%m")))
+            month = next_month(month)
+    _boundary.clear()
+    return moved
+
+
+def restore(begin=None, end=None, models=None):
+    """Move archived months overlapping [begin, end] back into the database
+
+    :returns: dict of model label -> rows restored
+    """
+    from django.db import transaction
+    from meals import coverage
+
+    restored = {}
+    for model in models or event_models():
+        restored[model._meta.label_lower] = 0
+        for record in months(model, begin, end):
+            instances = read_month(model, record)[1]
+            for obj in instances:
+                obj._state.adding = True
+            _valid_relations(model, instances)
+            with transaction.atomic():
+                # Rows re-imported since archiving take precedence
+                model.objects.bulk_create(instances, batch_size=1000,
+                                          ignore_conflicts=True)
+                record.delete()
+            os.remove(path(model, record.month, record.patient_id))
+            if record.model == "meals.glucosemeasurement":
+                # Recomputed rather than added to: coverage built from
+                # both tiers already counts these readings
+                coverage.refresh(*month_span(record.month))
+            restored[record.model] += len(instances)
+            logger.info("Restored %d %s rows for %s"
+                        % (len(instances), record.model,
+                           record.month.strftime("%Y-%m")))
+    _boundary.clear()
+    return restored
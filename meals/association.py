@@ -0,0 +1,110 @@
+"""Bolus-to-meal association
+
+Each InsulinDelivery is linked to the closest Meal that falls within the
+configured window around it.  Both series are read in time order and
+matched in a single merge sweep, so associating a whole history costs one
+pass over each table rather than one query per meal.
+"""
+
+from datetime import timedelta
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Default rules; override with settings.BOLUS_ASSOCIATION
+DEFAULT_RULES = {
+    # How long before a meal a pre-bolus may be given
+    "before_minutes": 30,
+    # How long after a meal a late bolus may be given
+    "after_minutes": 30,
+}
+
+
+def get_rules(rules=None):
+    if rules is None:
+        from django.conf import settings
+        rules = getattr(settings, "BOLUS_ASSOCIATION", None) or {}
+    params = dict(DEFAULT_RULES)
+    params.update(rules)
+    return params
+
+
+def match(meals, boluses, before, after):
+    """Pair each bolus with its closest meal by a merge sweep
+
+    :param meals: list of (pk, when) sorted by when
+    :param boluses: list of (pk, when) sorted by when
+    :param before: timedelta a bolus may precede its meal
+    :param after: timedelta a bolus may follow its meal
+    :returns: dict of bolus pk -> meal pk (or None)
+    """
+    links = {}
+    j = 0
+    nmeals = len(meals)
+    for (bpk, bwhen) in boluses:
+        # Advance to the last meal at or before this bolus
+        while j + 1 < nmeals and meals[j + 1][1] <= bwhen:
+            j += 1
+
+        best = None
+        bestdist = None
+        for k in (j, j + 1):
+            if k >= nmeals:
+                continue
+            (mpk, mwhen) = meals[k]
+            delta = bwhen - mwhen
+            if -before <= delta <= after:
+                dist = abs(delta)
+                if bestdist is None or dist < bestdist:
+                    best, bestdist = mpk, dist
+        links[bpk] = best
+    return links
+
+
+def associate(start=None, end=None, rules=None):
+    """Recompute bolus-to-meal links for boluses in [start, end]
+
+    :param start: earliest bolus time to relink; None for no lower bound
+    :param end: latest bolus time to relink; None for no upper bound
+    :param rules: association rules; defaults to settings.BOLUS_ASSOCIATION
+    :returns: number of boluses whose link changed
+    """
+    from django.db import transaction
+    from meals import archive
+    from meals.models import InsulinDelivery, Meal
+
+    params = get_rules(rules)
+    before = timedelta(minutes=params["before_minutes"])
+    after = timedelta(minutes=params["after_minutes"])
+
+    meal_qs = Meal.objects.order_by("when", "pk")
+    if start is not None:
+        meal_qs = meal_qs.filter(when__gte=start - after)
+    if end is not None:
+        meal_qs = meal_qs.filter(when__lte=end + before)
+
+    boluses = archive.values(InsulinDelivery, ["pk", "when", "meal_id"],
+                             start, end)
+    meals = list(meal_qs.values_list("pk", "when"))
+    links = match(meals, [(b[0], b[1]) for b in boluses], before, after)
+
+    changed = [(when, pk, links[pk])
+               for (pk, when, old) in boluses if links[pk] != old]
+    if changed:
+        with transaction.atomic():
+            # Archived boluses match no row here and are rewritten below
+            InsulinDelivery.objects.bulk_update(
+                [InsulinDelivery(pk=pk, meal_id=meal)
+                 for (_, pk, meal) in changed], ["meal"], batch_size=500)
+            archive.update(InsulinDelivery, "meal_id", changed)
+    logger.info("Associated %d boluses with %d meals; %d links changed"
+                % (len(boluses), len(meals), len(changed)))
+    return len(changed)
+
+
+def associate_around(when, rules=None):
+    """Relink boluses that could belong to a meal at `when`"""
+    params = get_rules(rules)
+    return associate(when - timedelta(minutes=params["before_minutes"]),
+                     when + timedelta(minutes=params["after_minutes"]),
+                     rules)
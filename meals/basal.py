@@ -0,0 +1,189 @@
+"""Basal insulin as run-length segments
+
+Tandem reports basal delivery as a list of rate changes: the CSV therapy
+timeline has one row per change, with many repeats, and closes the
+downloaded range with a final row at its end.  Rows are parsed one at a
+time and coalesced into [start, end) BasalSegment rows of constant rate.
+
+Each segment also stores the insulin delivered by all earlier segments, so
+delivered(t) is one index lookup plus a multiply, and the total basal
+insulin over a window is the difference of two of those.
+"""
+
+from bisect import bisect_right
+import csv
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _hours(td):
+    return td.total_seconds()/3600
+
+
+def read_csv(lines):
+    """Stream basal rows from a t:connect therapy timeline CSV export
+
+    The export is a series of CSV tables separated by blank lines, each
+    with its own header row; rows are yielded as dicts as they are read.
+
+    :param lines: iterable of text lines, e.g. an open file
+    """
+    header = None
+    for row in csv.reader(lines):
+        if not row or not any(f.strip() for f in row):
+            header = None
+        elif header is None:
+            header = [f.strip() for f in row]
+        elif row[0].strip() == "Basal":
+            yield dict(zip(header, row))
+
+
+def changes(rows):
+    """(time, rate) for each rate change row, skipping unreadable rows"""
+    from meals.tconnectdata import parseTime
+
+    for row in rows:
+        t = parseTime(row.get("EventDateTime", ""))
+        try:
+            rate = float(row["BasalRate"])
+        except (KeyError, ValueError):
+            t = None
+        if t is None:
+            logger.warning("Ignoring unreadable basal record: %s" % row)
+            continue
+        yield (t, rate)
+
+
+def segments(changes):
+    """Coalesce time-ordered (time, rate) changes into (start, end, rate)
+
+    Consecutive changes to the same rate extend one segment; the last
+    change only closes the final segment.
+    """
+    current = None
+    for (t, rate) in changes:
+        if current is None:
+            current = [t, rate]
+        elif rate != current[1] and t > current[0]:
+            yield (current[0], t, current[1])
+            current = [t, rate]
+        elif rate != current[1]:
+            # Superseded at the same instant
+            current[1] = rate
+        last = t
+    if current is not None and last > current[0]:
+        yield (current[0], last, current[1])
+
+
+def delivered(t):
+    """Basal insulin delivered over all stored segments before t"""
+    from meals.models import BasalSegment
+
+    seg = BasalSegment.objects.filter(start__lte=t).order_by("-start").first()
+    if seg is None:
+        return 0.0
+    return seg.cumulative + seg.rate*_hours(min(t, seg.end) - seg.start)
+
+
+def total(start, end):
+    """Basal insulin delivered in [start, end]"""
+    return delivered(end) - delivered(start)
+
+
+def store(segs):
+    """Replace stored segments over the span of segs
+
+    :param segs: time-ordered, non-overlapping (start, end, rate) tuples
+    :returns: number of segments stored
+    """
+    from django.db import transaction
+    from django.db.models import F
+    from meals.models import BasalSegment
+
+    segs = list(segs)
+    if not segs:
+        return 0
+    (lo, hi) = (segs[0][0], segs[-1][1])
+    added = sum(rate*_hours(e - s) for (s, e, rate) in segs)
+
+    with transaction.atomic():
+        (before_lo, before_hi) = (delivered(lo), delivered(hi))
+        delta = added - (before_hi - before_lo)
+
+        # Trim any segment straddling the start of the replaced span,
+        # keeping the part after the span if it reaches past it
+        tail = None
+        left = BasalSegment.objects.filter(start__lt=lo, end__gt=lo).first()
+        if left is not None:
+            if left.end > hi:
+                tail = BasalSegment(start=hi, end=left.end, rate=left.rate,
+                                    cumulative=before_hi + delta)
+            left.end = lo
+            left.save(update_fields=["end"])
+        # ... and any straddling its end
+        right = BasalSegment.objects.filter(
+            start__gte=lo, start__lt=hi, end__gt=hi).first()
+        if right is not None:
+            right.start = hi
+            right.cumulative = before_hi
+        BasalSegment.objects.filter(start__gte=lo, start__lt=hi).delete()
+        if right is not None:
+            right.save()
+
+        # Everything later moves by the change in delivered insulin
+        if delta:
+            BasalSegment.objects.filter(start__gte=hi).update(
+                cumulative=F("cumulative") + delta)
+        if tail is not None:
+            tail.save()
+
+        cumulative = before_lo
+        new = []
+        for (s, e, rate) in segs:
+            new.append(BasalSegment(start=s, end=e, rate=rate,
+                                    cumulative=cumulative))
+            cumulative += rate*_hours(e - s)
+        BasalSegment.objects.bulk_create(new, batch_size=1000)
+    logger.info("Stored %d basal segments from %s to %s"
+                % (len(new), lo, hi))
+    return len(new)
+
+
+def ingest(rows):
+    """Parse basal rows (dicts with EventDateTime and BasalRate) and store
+    them as segments"""
+    return store(segments(changes(rows)))
+
+
+class BasalIndex:
+    """Stored segments answering delivered/total queries by binary search"""
+
+    def __init__(self, segments):
+        segments = sorted(segments)
+        self.starts = [s[0] for s in segments]
+        self.ends = [s[1] for s in segments]
+        self.rates = [s[2] for s in segments]
+        self.cumulative = [s[3] for s in segments]
+
+    @classmethod
+    def load(cls, begin, end):
+        """Index of stored segments needed for windows inside [begin, end]"""
+        from meals.models import BasalSegment
+
+        first = (BasalSegment.objects.filter(start__lte=begin)
+                 .order_by("-start").values_list("start", flat=True).first())
+        qs = BasalSegment.objects.filter(start__lte=end)
+        if first is not None:
+            qs = qs.filter(start__gte=first)
+        return cls(qs.values_list("start", "end", "rate", "cumulative"))
+
+    def delivered(self, t):
+        i = bisect_right(self.starts, t) - 1
+        if i < 0:
+            return 0.0
+        return self.cumulative[i] + \
+            self.rates[i]*_hours(min(t, self.ends[i]) - self.starts[i])
+
+    def total(self, start, end):
+        return self.delivered(end) - self.delivered(start)
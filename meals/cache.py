@@ -0,0 +1,46 @@
+"""Small in-process caches shared by the analytics modules"""
+
+from collections import OrderedDict
+import threading
+
+from meals import metrics
+
+
+class LRUCache:
+    """Thread-safe least-recently-used mapping with a fixed capacity
+
+    Lookups are counted in the cache_requests metric under `name`.
+    """
+
+    def __init__(self, name, maxsize=128):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                hit = False
+            else:
+                self.data.move_to_end(key)
+                hit = True
+        metrics.cache_requests.inc(cache=self.name,
+                                   result="hit" if hit else "miss")
+        return value if hit else default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
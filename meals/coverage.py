@@ -0,0 +1,154 @@
+"""CGM coverage index
+
+Runs of CGM readings are stored as merged [start, end] CoverageInterval
+rows; a gap longer than MAX_GAP between readings starts a new run.  Ingest
+merges each batch into the overlapping intervals, so answering "is there
+data in this window, and how much" never touches the raw measurement
+table.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Three missed 5-minute readings split a run
+MAX_GAP = timedelta(minutes=20)
+
+
+def runs(times, max_gap=MAX_GAP):
+    """Group sorted reading times into [start, end, count] runs"""
+    result = []
+    for t in times:
+        if result and t - result[-1][1] <= max_gap:
+            result[-1][1] = max(result[-1][1], t)
+            result[-1][2] += 1
+        else:
+            result.append([t, t, 1])
+    return result
+
+
+def merge(intervals, max_gap=MAX_GAP):
+    """Merge [start, end, count] intervals closer than max_gap"""
+    result = []
+    for (start, end, n) in sorted(intervals):
+        if result and start - result[-1][1] <= max_gap:
+            result[-1][1] = max(result[-1][1], end)
+            result[-1][2] += n
+        else:
+            result.append([start, end, n])
+    return result
+
+
+def add_readings(times):
+    """Merge newly stored reading times into the coverage intervals
+
+    :param times: datetimes of readings added to GlucoseMeasurement
+    """
+    from django.db import transaction
+    from meals.models import CoverageInterval
+
+    new = runs(sorted(times))
+    if not new:
+        return
+    with transaction.atomic():
+        existing = CoverageInterval.objects.select_for_update().filter(
+            start__lte=new[-1][1] + MAX_GAP, end__gte=new[0][0] - MAX_GAP)
+        old = list(existing.values_list("start", "end", "readings"))
+        existing.delete()
+        CoverageInterval.objects.bulk_create([
+            CoverageInterval(start=s, end=e, readings=n)
+            for (s, e, n) in merge(new + [list(r) for r in old])])
+
+
+def refresh(start, end):
+    """Recompute intervals around [start, end] after readings were removed"""
+    from django.db import transaction
+    from django.db.models import Max, Min
+    from meals import archive
+    from meals.models import CoverageInterval, GlucoseMeasurement
+
+    with transaction.atomic():
+        existing = CoverageInterval.objects.select_for_update().filter(
+            start__lte=end + MAX_GAP, end__gte=start - MAX_GAP)
+        bounds = existing.aggregate(lo=Min("start"), hi=Max("end"))
+        lo = min(start, bounds["lo"] or start)
+        hi = max(end, bounds["hi"] or end)
+        existing.delete()
+        times = [t for (t,) in archive.values(GlucoseMeasurement, ["when"],
+                                              lo, hi)]
+        CoverageInterval.objects.bulk_create([
+            CoverageInterval(start=s, end=e, readings=n)
+            for (s, e, n) in runs(times)], batch_size=1000)
+
+
+def rebuild():
+    """Recompute all coverage intervals from the raw CGM data
+
+    Archived months are included, so old meals keep their coverage.
+
+    :returns: number of intervals stored
+    """
+    from django.db import transaction
+    from meals import archive
+    from meals.models import CoverageInterval, GlucoseMeasurement
+
+    intervals = runs(t for (t,) in archive.values(GlucoseMeasurement,
+                                                  ["when"]))
+    with transaction.atomic():
+        CoverageInterval.objects.all().delete()
+        CoverageInterval.objects.bulk_create([
+            CoverageInterval(start=s, end=e, readings=n)
+            for (s, e, n) in intervals], batch_size=1000)
+    logger.info("Rebuilt %d CGM coverage intervals" % len(intervals))
+    return len(intervals)
+
+
+class CoverageIndex:
+    """Sorted intervals answering coverage queries by binary search"""
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals)
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+
+    @classmethod
+    def load(cls, begin=None, end=None):
+        """Index of stored intervals overlapping [begin, end]"""
+        from meals.models import CoverageInterval
+
+        qs = CoverageInterval.objects.all()
+        if begin is not None:
+            qs = qs.filter(end__gte=begin)
+        if end is not None:
+            qs = qs.filter(start__lte=end)
+        return cls(qs.values_list("start", "end"))
+
+    def _overlapping(self, begin, end):
+        # Intervals are disjoint and sorted, so ends are sorted too
+        return range(bisect_left(self.ends, begin),
+                     bisect_right(self.starts, end))
+
+    def has_data(self, begin, end):
+        return len(self._overlapping(begin, end)) > 0
+
+    def fraction(self, begin, end):
+        """Fraction of [begin, end] inside a coverage interval"""
+        if end <= begin:
+            return 1.0 if self.has_data(begin, end) else 0.0
+        covered = timedelta(0)
+        for i in self._overlapping(begin, end):
+            covered += min(end, self.ends[i]) - max(begin, self.starts[i])
+        return covered/(end - begin)
+
+
+def has_data(begin, end):
+    """Whether any CGM reading lies in [begin, end]"""
+    from meals.models import CoverageInterval
+
+    # Intervals don't overlap, so only the last one starting by `end` can
+    # reach back to `begin`; one probe of the (patient, start) index
+    last_end = (CoverageInterval.objects.filter(start__lte=end)
+                .order_by("-start").values_list("end", flat=True).first())
+    return last_end is not None and last_end >= begin
@@ -0,0 +1,38 @@
+"""Keeping derived data in step with the event tables
+
+Ingest and admin edits change CGM readings and boluses in bulk, bypassing
+model signals.  refresh_derived() brings everything computed from a time
+range of those events up to date.  Coverage intervals are left to the
+caller, which knows whether readings were added (coverage.add_readings)
+or removed (coverage.refresh).
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def refresh_derived(first, last, readings=True, boluses=True):
+    """Update data derived from events in [first, last]
+
+    Each step runs in its own transaction, so call this outside any
+    atomic block (e.g. from transaction.on_commit).
+
+    :param first: earliest changed event time
+    :param last: latest changed event time
+    :param readings: whether CGM readings changed
+    :param boluses: whether boluses changed
+    """
+    from meals import agp, association, detection, prerender, similarity, \
+        summary
+    from meals.sqlite import retry_locked
+
+    if boluses:
+        retry_locked(association.associate, first, last)
+    if readings:
+        retry_locked(agp.invalidate, first, last)
+        # Readings changed before the last scan must be scanned again
+        retry_locked(detection.rewind, first)
+        retry_locked(detection.scan)
+        retry_locked(similarity.refresh, first, last)
+        retry_locked(summary.refresh_window, first, last)
+    retry_locked(prerender.enqueue_window, first, last)
@@ -0,0 +1,194 @@
+"""Scanner for unlogged meals in CGM history
+
+A meal start is a run of consecutive CGM readings whose rate of rise stays
+above a threshold, optionally with a bolus nearby.  Detections with no
+logged Meal close by are stored as DetectedMeal rows.  The scan works on
+NumPy arrays of the raw series and records a checkpoint, so each run after
+a sync only looks at data that arrived since the previous one; ingest of
+older data moves the checkpoint back with rewind().
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = "meal-detection"
+
+# Default rules; override with settings.MEAL_DETECTION
+DEFAULT_RULES = {
+    # Minimum rate of rise between consecutive readings (mg/dL per minute)
+    "min_rate": 1.0,
+    # Number of consecutive intervals that must all meet min_rate
+    "min_intervals": 3,
+    # Minimum total rise across the whole run (mg/dL)
+    "min_rise": 25,
+    # Readings further apart than this break a run (minutes)
+    "max_gap_minutes": 11,
+    # Detections closer than this to an earlier one are the same meal
+    "refractory_minutes": 120,
+    # A logged meal within this distance explains the rise
+    "meal_window_minutes": 60,
+    # Window for counting a bolus as belonging to the rise
+    "bolus_window_minutes": 45,
+    # Only report rises that have a bolus nearby
+    "require_bolus": False,
+}
+
+
+def get_rules(rules=None):
+    if rules is None:
+        from django.conf import settings
+        rules = getattr(settings, "MEAL_DETECTION", None) or {}
+    params = dict(DEFAULT_RULES)
+    params.update(rules)
+    return params
+
+
+def _near(sorted_times, times, window):
+    """For each of `times`, whether any of `sorted_times` is within window"""
+    if len(sorted_times) == 0:
+        return np.zeros(len(times), dtype=bool)
+    lo = np.searchsorted(sorted_times, times - window, side="left")
+    hi = np.searchsorted(sorted_times, times + window, side="right")
+    return hi > lo
+
+
+def find_rises(when, value, params):
+    """Locate sustained rises in a CGM series
+
+    :param when: numpy datetime64[s] array, sorted
+    :param value: numpy array of glucose values
+    :param params: detection rules
+    :returns: (start indices, end indices) of each qualifying run; a run
+        extends over every consecutive interval meeting min_rate
+    """
+    n = params["min_intervals"]
+    if len(when) <= n:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty
+
+    gap = np.diff(when).astype(np.int64)/60.0
+    rate = np.diff(value)/np.maximum(gap, 1e-9)
+    ok = (rate >= params["min_rate"]) & (gap <= params["max_gap_minutes"])
+
+    # Intervals starts[k]..stops[k]-1 all qualify, spanning readings
+    # starts[k]..stops[k]
+    edges = np.flatnonzero(np.diff(np.r_[False, ok, False].astype(np.int8)))
+    (starts, stops) = (edges[0::2], edges[1::2])
+    sustained = stops - starts >= n
+    begins = starts[sustained]
+    ends = stops[sustained]
+
+    rise = value[ends] - value[begins]
+    keep = rise >= params["min_rise"]
+    return begins[keep], ends[keep]
+
+
+def scan(full=False, rules=None):
+    """Scan CGM history for unlogged meals
+
+    :param full: discard previous detections and rescan all history
+    :param rules: detection rules; defaults to settings.MEAL_DETECTION
+    :returns: number of new detections stored
+    """
+    from django.db import transaction
+    from meals import archive
+    from meals.models import (DetectedMeal, GlucoseMeasurement,
+                              InsulinDelivery, Meal, ScanCheckpoint)
+
+    params = get_rules(rules)
+    refractory = timedelta(minutes=params["refractory_minutes"])
+    lookback = (params["min_intervals"] + 1) * \
+        timedelta(minutes=params["max_gap_minutes"])
+
+    checkpoint = ScanCheckpoint.objects.filter(name=CHECKPOINT).first()
+    if full:
+        DetectedMeal.objects.all().delete()
+        checkpoint = None
+
+    begin = None
+    if checkpoint:
+        # Overlap the previous scan so runs crossing its end are found
+        begin = checkpoint.position - lookback
+    rows = archive.values(GlucoseMeasurement, ["when", "value"], begin)
+    if not rows:
+        return 0
+
+    when = np.array([r[0] for r in rows], dtype="datetime64[s]")
+    value = np.array([r[1] for r in rows], dtype=float)
+    begins, ends = find_rises(when, value, params)
+    starts = when[begins]
+
+    window_start = rows[0][0] - refractory
+    window_end = rows[-1][0] + refractory
+    meal_times = np.array(
+        Meal.objects.filter(when__gte=window_start, when__lte=window_end)
+        .order_by("when").values_list("when", flat=True),
+        dtype="datetime64[s]")
+    bolus_times = np.array(
+        [t for (t,) in archive.values(InsulinDelivery, ["when"],
+                                      window_start, window_end)],
+        dtype="datetime64[s]")
+
+    meal_window = np.timedelta64(params["meal_window_minutes"]*60, "s")
+    bolus_window = np.timedelta64(params["bolus_window_minutes"]*60, "s")
+    logged = _near(meal_times, starts, meal_window)
+    bolused = _near(bolus_times, starts, bolus_window)
+
+    # Suppress repeat detections of the same meal, including ones stored
+    # by the previous scan
+    last = (DetectedMeal.objects.filter(when__lt=rows[0][0] + lookback)
+            .order_by("-when").values_list("when", flat=True).first())
+    last = np.datetime64(last, "s") if last else None
+    refractory64 = np.timedelta64(int(refractory.total_seconds()), "s")
+
+    found = []
+    for (k, t) in enumerate(starts):
+        if last is not None and t - last < refractory64:
+            continue
+        last = t
+        if logged[k] or (params["require_bolus"] and not bolused[k]):
+            continue
+        (i, j) = (begins[k], ends[k])
+        minutes = (when[j] - when[i]).astype(np.int64)/60.0
+        found.append(DetectedMeal(
+            when=t.astype(object),
+            rise=int(value[j] - value[i]),
+            rate=float((value[j] - value[i])/minutes),
+            bolus=bool(bolused[k]),
+        ))
+
+    with transaction.atomic():
+        # Rescans after a rewind find detections that are already stored;
+        # bulk_create with ignore_conflicts can't tell which were skipped
+        stored = set(DetectedMeal.objects.filter(
+            when__in=[d.when for d in found]).values_list("when", flat=True))
+        created = [d for d in found if d.when not in stored]
+        DetectedMeal.objects.bulk_create(created, ignore_conflicts=True)
+        ScanCheckpoint.objects.update_or_create(
+            name=CHECKPOINT, defaults={"position": rows[-1][0]})
+
+    logger.info("Scanned %d CGM readings; %d possible unlogged meals"
+                % (len(rows), len(created)))
+    return len(created)
+
+
+def rewind(position):
+    """Make the next scan start no later than `position`"""
+    from meals.models import ScanCheckpoint
+
+    ScanCheckpoint.objects.filter(name=CHECKPOINT,
+                                  position__gt=position).update(
+        position=position)
+
+
+def resolve(when, rules=None):
+    """Drop detections explained by a meal logged at `when`"""
+    from meals.models import DetectedMeal
+
+    window = timedelta(minutes=get_rules(rules)["meal_window_minutes"])
+    DetectedMeal.objects.filter(when__gte=when - window,
+                                when__lte=when + window).delete()
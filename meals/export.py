@@ -0,0 +1,233 @@
+"""Streaming bulk export of meals and event data
+
+Rows are read with values_list() through chunked iterators and encoded
+line by line, so memory use stays flat however long the range is.  The
+NDJSON layout mirrors ciqEvents records, and load() feeds exported files
+back through tconnectdata.commit(), so an export can be re-imported into
+an empty database.
+"""
+
+import csv
+import gzip
+import heapq
+import io
+import itertools
+import json
+import zlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+KINDS = ("meals", "cgm", "bolus")
+FORMATS = ("ndjson", "csv")
+
+CSV_FIELDS = ("type", "eventDateTime", "value", "amount", "duration",
+              "dish", "appx")
+
+CHUNK_SIZE = 5000
+# Events handed to commit() at a time when loading
+LOAD_BATCH = 10000
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def _in_range(qs, start, end):
+    if start is not None:
+        qs = qs.filter(when__gte=start)
+    if end is not None:
+        qs = qs.filter(when__lt=end)
+    return qs.order_by("when")
+
+
+def _with_archive(model, rows, fields, start, end):
+    """Merge archived events into a time-ordered values_list() iterator
+
+    Archived months are decoded one at a time, so memory stays bounded by
+    the archive's LRU.  Events held in both tiers (e.g. restored but not
+    yet re-archived) are yielded once, from the database.
+    """
+    from meals import archive
+    from meals.models import ArchivedMonth
+
+    hot = rows.iterator(chunk_size=CHUNK_SIZE)
+    records = ArchivedMonth.objects.filter(model=model._meta.label_lower)
+    if start is not None:
+        records = records.filter(month__gte=archive.month_start(start))
+    if end is not None:
+        records = records.filter(month__lte=archive.month_start(end))
+
+    def cold():
+        for record in records.order_by("month"):
+            for obj in archive.read_month(model, record)[1]:
+                if ((start is None or obj.when >= start) and
+                        (end is None or obj.when < end)):
+                    yield (tuple(getattr(obj, f) for f in fields), 1)
+
+    # Database rows sort first among rows with the same time
+    merged = heapq.merge(((row, 0) for row in hot), cold(),
+                         key=lambda tagged: (tagged[0][0], tagged[1]))
+    last = None
+    for (row, _) in merged:
+        if row[0] != last:
+            last = row[0]
+            yield row
+
+
+def events(kinds, start=None, end=None):
+    """Yield exported records as ciqEvents-style dicts
+
+    :param kinds: subset of KINDS to include
+    :param start: earliest time to include; None for no bound
+    :param end: time to stop before; None for no bound
+    """
+    from meals.models import GlucoseMeasurement, InsulinDelivery, Meal
+
+    if "meals" in kinds:
+        rows = _in_range(Meal.objects, start, end).values_list(
+            "when", "dish__desc", "appx")
+        for (when, desc, appx) in rows.iterator(chunk_size=CHUNK_SIZE):
+            yield {"type": "Meal", "eventDateTime": when.strftime(TIME_FORMAT),
+                   "dish": desc, "appx": appx}
+
+    if "cgm" in kinds:
+        rows = _in_range(GlucoseMeasurement.objects, start, end).values_list(
+            "when", "value")
+        for (when, value) in _with_archive(GlucoseMeasurement, rows,
+                                           ("when", "value"), start, end):
+            yield {"type": "CGM", "eventDateTime": when.strftime(TIME_FORMAT),
+                   "eventID": 256, "sourceRecId": 0,
+                   "egv": {"estimatedGlucoseValue": value}}
+
+    if "bolus" in kinds:
+        rows = _in_range(InsulinDelivery.objects, start, end).values_list(
+            "when", "amount", "duration")
+        for (when, amount, duration) in _with_archive(
+                InsulinDelivery, rows, ("when", "amount", "duration"),
+                start, end):
+            yield {"type": "Bolus", "eventDateTime": when.strftime(TIME_FORMAT),
+                   "sourceRecId": 0,
+                   "standard": {"insulinDelivered": {"value": float(amount)}},
+                   "durationSeconds": int(duration.total_seconds())}
+
+
+def to_csv_row(event):
+    row = {"type": event["type"], "eventDateTime": event["eventDateTime"]}
+    if event["type"] == "Meal":
+        row.update(dish=event["dish"], appx=int(event["appx"]))
+    elif event["type"] == "CGM":
+        row.update(value=event["egv"]["estimatedGlucoseValue"])
+    elif event["type"] == "Bolus":
+        row.update(amount=event["standard"]["insulinDelivered"]["value"],
+                   duration=event["durationSeconds"])
+    return row
+
+
+def from_csv_row(row):
+    event = {"type": row["type"], "eventDateTime": row["eventDateTime"],
+             "sourceRecId": 0}
+    if row["type"] == "Meal":
+        event.update(dish=row["dish"], appx=bool(int(row["appx"] or 0)))
+    elif row["type"] == "CGM":
+        event.update(eventID=256,
+                     egv={"estimatedGlucoseValue": int(row["value"])})
+    elif row["type"] == "Bolus":
+        event.update(standard={"insulinDelivered": {
+                         "value": float(row["amount"])}},
+                     durationSeconds=int(row["duration"] or 0))
+    return event
+
+
+def lines(kinds, start=None, end=None, fmt="ndjson"):
+    """Yield the export as text lines"""
+    if fmt == "ndjson":
+        for event in events(kinds, start, end):
+            yield json.dumps(event) + "\n"
+    elif fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for event in events(kinds, start, end):
+            writer.writerow(to_csv_row(event))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    else:
+        raise ValueError("Unknown export format: %s" % fmt)
+
+
+def stream(kinds, start=None, end=None, fmt="ndjson", compress=False,
+           block=64*1024):
+    """Yield the export as byte blocks, optionally gzip-compressed
+
+    Lines are gathered into blocks of roughly `block` bytes so the
+    consumer (file or HTTP response) sees few, large writes.
+    """
+    z = zlib.compressobj(wbits=31) if compress else None
+    pending = []
+    size = 0
+    for line in lines(kinds, start, end, fmt):
+        pending.append(line)
+        size += len(line)
+        if size >= block:
+            data = "".join(pending).encode()
+            pending, size = [], 0
+            data = z.compress(data) if z else data
+            if data:
+                yield data
+    data = "".join(pending).encode()
+    if z:
+        data = z.compress(data) + z.flush()
+    if data:
+        yield data
+
+
+def read_events(fp, fmt="ndjson"):
+    """Yield event dicts from an export opened in binary mode
+
+    Gzip-compressed input is detected from its header.
+    """
+    head = fp.peek(2)[:2] if hasattr(fp, "peek") else b""
+    if head == b"\x1f\x8b":
+        fp = gzip.GzipFile(fileobj=fp)
+    text = io.TextIOWrapper(fp, encoding="utf-8", newline="")
+    if fmt == "ndjson":
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+    elif fmt == "csv":
+        for row in csv.DictReader(text):
+            yield from_csv_row(row)
+    else:
+        raise ValueError("Unknown export format: %s" % fmt)
+
+
+def load(fp, fmt="ndjson"):
+    """Import an export file
+
+    Pump events go through tconnectdata.commit() in batches; meals are
+    matched to dishes by description, creating dishes as needed.
+
+    :returns: number of meals created
+    """
+    from meals import tconnectdata
+    from meals.models import Dish, Meal
+
+    meals = 0
+    source = read_events(fp, fmt)
+    while True:
+        batch = list(itertools.islice(source, LOAD_BATCH))
+        if not batch:
+            break
+        pump = [e for e in batch if e["type"] != "Meal"]
+        if pump:
+            tconnectdata.commit({"ciqEvents": {"event": pump}})
+        for e in batch:
+            if e["type"] != "Meal":
+                continue
+            dish, _ = Dish.objects.get_or_create(desc=e["dish"])
+            when = tconnectdata.parseTime(e["eventDateTime"])
+            _, created = Meal.objects.get_or_create(
+                dish=dish, when=when, defaults={"appx": e["appx"]})
+            meals += created
+    return meals
@@ -25,8 +25,23 @@ class DishForm(forms.ModelForm):
         model = Dish
         fields = ["desc"]
 
+    def clean_desc(self):
+        # With patient excluded from the form, model validation skips the
+        # (patient, desc) constraint; check it against the active patient
+        desc = self.cleaned_data["desc"]
+        if Dish.objects.filter(desc=desc).exclude(
+                pk=self.instance.pk).exists():
+            raise forms.ValidationError(
+                "A dish with this description already exists.")
+        return desc
+
 class MealForm(forms.ModelForm):
     class Meta:
         model = Meal
-        fields = "__all__"
+        exclude = ["patient"]
     date = DateTimeLocalField()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The class-level choices were scoped to the patient active at import
+        self.fields["dish"].queryset = Dish.objects.all()
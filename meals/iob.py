@@ -0,0 +1,164 @@
+"""Insulin-on-board (IOB) engine
+
+IOB is computed by building a per-minute delivery series from the
+InsulinDelivery history and convolving it with an action curve giving the
+fraction of a dose still active after each minute.  Extended boluses are
+spread evenly across their `duration`.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from meals import archive, patients
+from meals.cache import LRUCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+MINUTE = timedelta(minutes=1)
+
+# Default action curve; override with settings.IOB_CURVE
+DEFAULT_CURVE = {
+    "model": "exponential",
+    "dia_minutes": 300,   # duration of insulin action
+    "peak_minutes": 75,   # time of peak activity (exponential model only)
+}
+
+# Longest extended bolus the pump can deliver
+MAX_EXTENDED = timedelta(hours=8)
+
+# Longest span served by the IOB view
+MAX_SPAN = timedelta(days=31)
+
+_cache = LRUCache("iob", maxsize=256)
+
+
+def exponential_curve(dia_minutes, peak_minutes):
+    """Fraction of insulin remaining for each minute after a dose
+
+    Exponential model as used by Loop and OpenAPS.
+    """
+    dia = float(dia_minutes)
+    peak = float(peak_minutes)
+    t = np.arange(int(dia_minutes), dtype=float)
+    tau = peak * (1 - peak/dia) / (1 - 2*peak/dia)
+    a = 2*tau/dia
+    s = 1 / (1 - a + (1 + a)*np.exp(-dia/tau))
+    return 1 - s*(1 - a)*(
+        (t**2/(tau*dia*(1 - a)) - t/tau - 1)*np.exp(-t/tau) + 1)
+
+
+def linear_curve(dia_minutes, peak_minutes=None):
+    """Fraction of insulin remaining, decaying linearly to zero"""
+    t = np.arange(int(dia_minutes), dtype=float)
+    return 1 - t/dia_minutes
+
+
+CURVE_MODELS = {
+    "exponential": exponential_curve,
+    "linear": linear_curve,
+}
+
+
+def get_curve_params(curve=None):
+    if curve is None:
+        from django.conf import settings
+        curve = getattr(settings, "IOB_CURVE", None) or {}
+    params = dict(DEFAULT_CURVE)
+    params.update(curve)
+    return params
+
+
+def action_curve(params):
+    return CURVE_MODELS[params["model"]](params["dia_minutes"],
+                                         params["peak_minutes"])
+
+
+def delivery_series(start, nminutes, boluses):
+    """Insulin delivered in each minute starting at `start`
+
+    :param start: datetime of the first minute of the series
+    :param nminutes: length of the series
+    :param boluses: iterable of (when, amount, duration) tuples
+    :returns: numpy array of units delivered per minute
+    """
+    rows = list(boluses)
+    series = np.zeros(nminutes + 1)
+    if not rows:
+        return series[:nminutes]
+
+    offset = np.array([(r[0] - start)//MINUTE for r in rows], dtype=np.int64)
+    amount = np.array([float(r[1]) for r in rows])
+    duration = np.array([r[2]//MINUTE for r in rows], dtype=np.int64)
+
+    inrange = (offset >= 0) & (offset < nminutes)
+    extended = duration > 1
+
+    # Immediate boluses land in a single minute
+    now = inrange & ~extended
+    np.add.at(series, offset[now], amount[now])
+
+    # Extended boluses are a constant rate over their duration; accumulate
+    # rate steps and integrate, clipping the tail to the series length
+    ext = extended & (offset < nminutes) & (offset + duration > 0)
+    if ext.any():
+        rate = amount[ext]/duration[ext]
+        begin = np.clip(offset[ext], 0, nminutes)
+        end = np.clip(offset[ext] + duration[ext], 0, nminutes)
+        steps = np.zeros(nminutes + 1)
+        np.add.at(steps, begin, rate)
+        np.add.at(steps, end, -rate)
+        series += np.cumsum(steps)
+
+    return series[:nminutes]
+
+
+def insulin_on_board(start, end, step=timedelta(minutes=5), curve=None):
+    """IOB sampled on a regular grid
+
+    :param start: first grid time
+    :param end: last grid time (inclusive)
+    :param step: grid spacing (whole minutes)
+    :param curve: action curve parameters; defaults to settings.IOB_CURVE
+    :returns: (list of grid datetimes, numpy array of IOB units)
+    """
+    from django.db.models import Count, Max, Sum
+    from meals.models import InsulinDelivery
+
+    params = get_curve_params(curve)
+    dia = int(params["dia_minutes"])
+    stepmin = max(1, step//MINUTE)
+
+    # Doses up to one action duration before the window still contribute,
+    # as do extended boluses started earlier and still running at origin
+    origin = start - dia*MINUTE
+    lookback = origin - MAX_EXTENDED
+    events = InsulinDelivery.objects.filter(when__gte=lookback, when__lte=end)
+    cold = archive.archived(InsulinDelivery, lookback, end)
+
+    # Cheap fingerprint of the window's deliveries, so cached results are
+    # invalidated by ingest running in any process
+    fingerprint = tuple(events.aggregate(
+        n=Count("id"), last=Max("id"), total=Sum("amount"),
+        spread=Sum("duration")).values()) + \
+        (len(cold),)
+    key = (patients.current_id(), start, end, stepmin,
+           tuple(sorted(params.items())), fingerprint)
+    cached = _cache.get(key)
+    if cached is not None:
+        return cached
+
+    nminutes = (end - origin)//MINUTE + 1
+    rows = list(events.order_by().values_list("when", "amount", "duration"))
+    if cold:
+        hot = {r[0] for r in rows}
+        rows += [(b.when, b.amount, b.duration) for b in cold
+                 if b.when not in hot]
+    series = delivery_series(origin, nminutes, rows)
+    iob = np.convolve(series, action_curve(params))[:nminutes]
+
+    grid = np.arange(dia, nminutes, stepmin)
+    result = ([origin + int(i)*MINUTE for i in grid], iob[grid])
+    _cache.put(key, result)
+    return result
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from meals import patients
+
+
+class PatientCommand(BaseCommand):
+    """Command working on one patient's data
+
+    Adds a --patient option naming the patient; without it the command
+    runs as the default patient (see meals.patients).
+    """
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument("--patient",
+                            help="Name of the patient whose data to use "
+                            "(default: DEFAULT_PATIENT)")
+        return parser
+
+    def execute(self, *args, **options):
+        from meals.models import Patient
+
+        patient = None
+        if options.get("patient"):
+            try:
+                patient = Patient.objects.get(name=options["patient"])
+            except Patient.DoesNotExist:
+                raise CommandError("No patient named %s" % options["patient"])
+        with patients.using(patient):
+            return super().execute(*args, **options)
@@ -0,0 +1,41 @@
+from django.db import connection
+
+from datetime import datetime, timedelta
+
+from meals import archive
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Move old CGM and bolus events between the database and the " \
+        "archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", dest="days", type=int,
+                            help="Archive whole months older than this "
+                            "many days (default: EVENT_ARCHIVE after_days)")
+        parser.add_argument("--restore", action="store_true",
+                            help="Move archived months back into the "
+                            "database instead")
+        parser.add_argument("--start", type=datetime.fromisoformat,
+                            help="With --restore, first month to restore")
+        parser.add_argument("--end", type=datetime.fromisoformat,
+                            help="With --restore, last month to restore")
+        parser.add_argument("--vacuum", action="store_true",
+                            help="Compact the database file afterwards")
+
+    def handle(self, *args, **options):
+        if options["restore"]:
+            counts = archive.restore(options["start"], options["end"])
+            verb = "Restored"
+        else:
+            before = None
+            if options["days"] is not None:
+                before = datetime.now() - timedelta(days=options["days"])
+            counts = archive.move_out(before)
+            verb = "Archived"
+        for (label, n) in counts.items():
+            self.stdout.write("%s %d %s rows" % (verb, n, label))
+        if options["vacuum"] and connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
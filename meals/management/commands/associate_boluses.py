@@ -0,0 +1,10 @@
+from meals import association
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Recompute bolus-to-meal links over the whole history"
+
+    def handle(self, *args, **options):
+        changed = association.associate()
+        self.stdout.write("Updated %d bolus links" % changed)
@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from meals import archive, coverage
+from meals.models import GlucoseMeasurement, InsulinDelivery
+
+
+class Command(BaseCommand):
+    help = "Measure window query latency and database size before and " \
+        "after archiving, on synthetic history in an empty database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--years", type=int, default=3,
+                            help="Years of synthetic history to generate")
+        parser.add_argument("--queries", type=int, default=200,
+                            help="Window queries per measurement")
+
+    def handle(self, *args, **options):
+        if GlucoseMeasurement.objects.exists() or \
+           InsulinDelivery.objects.exists():
+            raise CommandError(
+                "The benchmark needs an empty database, e.g.\n"
+                "  export BOLUSHISTORY_DB_NAME=/tmp/bench.sqlite3\n"
+                "  manage.py migrate && manage.py benchmark_archive")
+        self.now = datetime.now().replace(second=0, microsecond=0)
+        self.generate(options["years"])
+        self.queries = options["queries"]
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             override_settings(EVENT_ARCHIVE={"directory": tmpdir}):
+            before = self.measure()
+            t = time.perf_counter()
+            moved = archive.move_out(self.now - timedelta(days=365))
+            elapsed = time.perf_counter() - t
+            after = self.measure()
+            size = sum(os.path.getsize(os.path.join(d, f))
+                       for (d, _, files) in os.walk(tmpdir) for f in files)
+            # Old windows: first read decodes the months, later ones hit
+            # the LRU
+            cold = self.latencies(self.now - timedelta(days=700),
+                                  self.now - timedelta(days=400), 1)
+            warm = self.latencies(self.now - timedelta(days=700),
+                                  self.now - timedelta(days=400))
+
+        self.stdout.write("Moved %s rows in %.1f s; archive files %.1f MB"
+                          % (sum(moved.values()), elapsed, size/1e6))
+        self.stdout.write("%-28s %12s %12s" % ("", "before", "after"))
+        for (name, a, b) in [
+                ("database size (MB)", before[0]/1e6, after[0]/1e6),
+                ("recent window p50 (ms)", before[1], after[1]),
+                ("recent window p95 (ms)", before[2], after[2])]:
+            self.stdout.write("%-28s %12.2f %12.2f" % (name, a, b))
+        self.stdout.write("archived window: first read %.1f ms, "
+                          "cached p50 %.2f ms"
+                          % (cold[0], statistics.median(warm)))
+
+    def generate(self, years):
+        start = self.now - timedelta(days=365*years)
+        self.stdout.write("Generating %d years of CGM and bolus history"
+                          % years)
+        batch = []
+        t = start
+        while t < self.now:
+            batch.append(GlucoseMeasurement(
+                when=t, value=random.randint(60, 250)))
+            if len(batch) == 10000:
+                GlucoseMeasurement.objects.bulk_create(batch)
+                batch = []
+            t += timedelta(minutes=5)
+        GlucoseMeasurement.objects.bulk_create(batch)
+        InsulinDelivery.objects.bulk_create([
+            InsulinDelivery(when=start + timedelta(hours=4*i, minutes=1),
+                            amount=Decimal("%.2f" % random.uniform(0.5, 8)))
+            for i in range(365*years*6)], batch_size=10000)
+        coverage.rebuild()
+
+    def latencies(self, earliest, latest, n=None):
+        span = (latest - earliest).total_seconds()
+        result = []
+        for _ in range(n or self.queries):
+            dt = earliest + timedelta(seconds=random.uniform(0, span))
+            t = time.perf_counter()
+            list(GlucoseMeasurement.getEventsInWindow(dt))
+            list(InsulinDelivery.getEventsInWindow(dt))
+            result.append((time.perf_counter() - t)*1000)
+        return result
+
+    def measure(self):
+        """(database bytes, p50 ms, p95 ms) for windows in the last 90 days"""
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+        size = os.path.getsize(connection.settings_dict["NAME"])
+        # Cold OS cache effects are out of scope; warm up first
+        self.latencies(self.now - timedelta(days=90), self.now, 20)
+        times = sorted(self.latencies(self.now - timedelta(days=90),
+                                      self.now))
+        return (size, statistics.median(times),
+                times[int(len(times)*0.95)])
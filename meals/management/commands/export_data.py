@@ -0,0 +1,45 @@
+from django.core.management.base import CommandError
+
+import sys
+
+import arrow
+
+from meals import export
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Export meals, CGM and bolus data as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="Start of date range to export")
+        parser.add_argument("--end", help="End of date range to export")
+        parser.add_argument("--kinds", default=",".join(export.KINDS),
+                            help="Comma-separated subset of %s"
+                            % ",".join(export.KINDS))
+        parser.add_argument("--format", dest="fmt", default="ndjson",
+                            choices=export.FORMATS)
+        parser.add_argument("--gzip", action="store_true",
+                            help="Compress output with gzip")
+        parser.add_argument("--out", help="File to write; defaults to stdout")
+
+    def handle(self, *args, **options):
+        start = options["start"]
+        start = arrow.get(start).naive if start else None
+        end = options["end"]
+        end = arrow.get(end).naive if end else None
+        kinds = options["kinds"].split(",")
+        if not set(kinds) <= set(export.KINDS):
+            raise CommandError("--kinds must be a subset of %s"
+                               % ",".join(export.KINDS))
+
+        blocks = export.stream(kinds, start, end, options["fmt"],
+                               options["gzip"])
+        if options["out"]:
+            with open(options["out"], "wb") as fp:
+                for block in blocks:
+                    fp.write(block)
+        else:
+            for block in blocks:
+                sys.stdout.buffer.write(block)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,14 @@
+from meals import basal
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Import basal rates from a t:connect therapy timeline CSV export"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file exported from t:connect")
+
+    def handle(self, *args, **options):
+        with open(options["path"], newline="") as fp:
+            stored = basal.ingest(basal.read_csv(fp))
+        self.stdout.write("Stored %d basal segments" % stored)
@@ -0,0 +1,16 @@
+from meals import export
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Import a file written by export_data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Export file (optionally gzipped)")
+        parser.add_argument("--format", dest="fmt", default="ndjson",
+                            choices=export.FORMATS)
+
+    def handle(self, *args, **options):
+        with open(options["path"], "rb") as fp:
+            meals = export.load(fp, options["fmt"])
+        self.stdout.write("Imported %d new meals" % meals)
@@ -0,0 +1,10 @@
+from meals import coverage
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Recompute CGM coverage intervals from stored measurements"
+
+    def handle(self, *args, **options):
+        n = coverage.rebuild()
+        self.stdout.write("Stored %d coverage intervals" % n)
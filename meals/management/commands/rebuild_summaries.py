@@ -0,0 +1,10 @@
+from meals import summary
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Recompute meal glucose peaks and per-dish summaries"
+
+    def handle(self, *args, **options):
+        stored = summary.rebuild()
+        self.stdout.write("Rebuilt summaries for %d dishes" % stored)
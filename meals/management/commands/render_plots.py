@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from meals import prerender
+
+
+class Command(BaseCommand):
+    help = "Pre-render meal plots that are missing or out of date"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Worker processes (default: "
+                            "PLOT_PRERENDER_WORKERS, or one per CPU); "
+                            "0 renders in this process")
+        parser.add_argument("--all", action="store_true",
+                            help="Queue every meal before rendering")
+        parser.add_argument("--watch", type=float, metavar="SECONDS",
+                            help="Keep running, polling for new requests "
+                            "at this interval")
+
+    def handle(self, *args, **options):
+        from meals.models import Meal
+
+        if options["all"]:
+            prerender.enqueue(Meal.objects.values_list("pk", flat=True))
+        while True:
+            done = prerender.process(workers=options["workers"])
+            self.stdout.write("Rendered %d meal plots" % done)
+            if options["watch"] is None:
+                break
+            time.sleep(options["watch"])
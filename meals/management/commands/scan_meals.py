@@ -0,0 +1,15 @@
+from meals import detection
+from meals.management.base import PatientCommand
+
+
+class Command(PatientCommand):
+    help = "Scan CGM history for likely meals that were not logged"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true",
+                            help="Discard previous results and rescan all "
+                            "history")
+
+    def handle(self, *args, **options):
+        found = detection.scan(full=options["full"])
+        self.stdout.write("Found %d possible unlogged meals" % found)
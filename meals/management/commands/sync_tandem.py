@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import asyncio
+import signal
+
+from meals import sync, tconnectdata
+from meals.models import Patient
+
+
+class Command(BaseCommand):
+    help = "Keep pulling new data from Tandem on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+                            help="Catch up every source once and exit")
+        parser.add_argument("--source", dest="sources", action="append",
+                            help="Data source to pull (repeatable); "
+                            "defaults to those the app uses")
+        parser.add_argument("--patient", dest="patients", action="append",
+                            help="Name of a patient to sync (repeatable); "
+                            "defaults to every patient with credentials")
+
+    def handle(self, *args, **options):
+        from tconnectsync.api import TConnectApi
+
+        patients = Patient.objects.all()
+        if options["patients"]:
+            patients = patients.filter(name__in=options["patients"])
+        services = []
+        for patient in patients:
+            login = tconnectdata.getLogin(patient.env_prefix)
+            if not login:
+                if options["patients"]:
+                    raise CommandError("Missing t:connect login credentials "
+                                       "for %s" % patient)
+                continue
+            services.append(sync.SyncService(
+                TConnectApi(login.email, login.password),
+                sources=options["sources"], patient=patient.pk))
+        if not services:
+            raise CommandError("Missing t:connect login credentials")
+
+        if options["once"]:
+            asyncio.run(sync.run_all_once(services))
+        else:
+            asyncio.run(self.serve(services))
+
+    async def serve(self, services):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        self.stdout.write("Syncing %s for %d patients; stop with Ctrl-C"
+                          % (", ".join(s.key for s in services[0].sources),
+                             len(services)))
+        await sync.run_all(services, stop)
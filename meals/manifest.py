@@ -0,0 +1,135 @@
+"""Upload-level ingest manifest
+
+Raw ciqEvents records are grouped into units before commit: one unit per
+pump `uploadId`, and, since CGM, bolus and basal records arrive with an
+uploadId of 0, one unit per day for those.  Each committed unit is
+recorded with a digest of every record it has held, grouped by record
+identity (type and time), so re-importing an overlapping export skips
+every record already seen with one lookup per unit.
+
+Downloads often hold part of a unit: a day still in progress, or the
+start of a day cut off by a sync window.  Only records not seen before
+are committed, and they are merged into the unit's entry.  The unit is
+flagged for review only on a real conflict: a record whose identity was
+seen before but whose contents differ.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Hex digits kept of each record's SHA-256
+DIGEST_CHARS = 16
+
+
+def unit_key(event):
+    upload = event.get("uploadId") or 0
+    if upload:
+        return "upload:%d" % upload
+    return "day:%s" % event.get("eventDateTime", "")[:10]
+
+
+def group(events):
+    """Split raw records into units, keeping their original order"""
+    units = OrderedDict()
+    for event in events:
+        units.setdefault(unit_key(event), []).append(event)
+    return units
+
+
+def identity(event):
+    """What makes two records the same event, whatever their contents"""
+    return "%s %s" % (event.get("type"), event.get("eventDateTime"))
+
+
+def digest(event):
+    canonical = json.dumps(event, sort_keys=True).encode()
+    # Shortened: distinguishes records of one unit, not adversaries
+    return hashlib.sha256(canonical).hexdigest()[:DIGEST_CHARS]
+
+
+def checksum(digests):
+    """Checksum of a unit from its {identity: [digest, ...]} map"""
+    h = hashlib.sha256()
+    for d in sorted(d for ds in digests.values() for d in ds):
+        h.update(d.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def pending(units):
+    """Select the records that still need committing
+
+    :param units: dict of unit key -> raw records, as from group()
+    :returns: (dict of key -> records not seen before,
+               dict of key -> (merged digests, previous IngestManifest or
+               None, whether a seen record changed)) for units with such
+               records
+    """
+    from meals.models import IngestManifest
+
+    # Keys are unique per patient, which in_bulk() can't be told
+    known = {m.key: m for m in
+             IngestManifest.objects.filter(key__in=list(units))}
+    todo = OrderedDict()
+    sums = {}
+    for (key, events) in units.items():
+        previous = known.get(key)
+        # Entries written before digests were kept compare as empty
+        seen = json.loads(previous.digests) \
+            if previous and previous.digests else {}
+        merged = {k: list(v) for (k, v) in seen.items()}
+        fresh = []
+        conflict = False
+        for event in events:
+            (ident, d) = (identity(event), digest(event))
+            if d in merged.get(ident, ()):
+                continue
+            conflict = conflict or ident in seen
+            merged.setdefault(ident, []).append(d)
+            fresh.append(event)
+        if fresh:
+            todo[key] = fresh
+            sums[key] = (merged, previous, conflict)
+    return todo, sums
+
+
+def record(key, events, digests, previous, conflict):
+    """Merge newly committed records into a unit's manifest entry
+
+    :param events: the records committed, as selected by pending()
+    :param digests: the unit's merged digests, from pending()
+    """
+    from meals.models import IngestManifest
+
+    recs = [e["sourceRecId"] for e in events if e.get("sourceRecId")]
+    if previous:
+        recs += [r for r in (previous.first_source_rec,
+                             previous.last_source_rec) if r]
+    upload = events[0].get("uploadId") or None
+    flagged = bool(previous and previous.flagged) or conflict
+    if conflict:
+        logger.warning("Contents of %s changed since it was first imported;"
+                       " flagged for review under Ingest manifests in the "
+                       "admin" % key)
+    IngestManifest.objects.update_or_create(key=key, defaults=dict(
+        upload_id=upload,
+        first_source_rec=min(recs) if recs else None,
+        last_source_rec=max(recs) if recs else None,
+        events=sum(len(ds) for ds in digests.values()),
+        checksum=checksum(digests),
+        digests=json.dumps(digests, separators=(",", ":")),
+        flagged=flagged,
+    ))
+
+
+def forget(start, end):
+    """Drop day units overlapping [start, end] so they can be re-imported"""
+    from meals.models import IngestManifest
+
+    IngestManifest.objects.filter(
+        key__gte="day:%s" % start.date().isoformat(),
+        key__lte="day:%s" % end.date().isoformat()).delete()
@@ -0,0 +1,332 @@
+"""In-process metrics registry with a Prometheus text exposition
+
+Counters and histograms are kept in plain dicts guarded by a lock, so
+updating them from hot paths costs a dict lookup and an add.  Each worker
+process periodically writes its own snapshot to METRICS_DIR (one JSON file
+per pid); the exposition view merges every snapshot so the totals stay
+consistent no matter which worker answers the scrape.  When a process
+has exited, its snapshot is folded into DEAD_FILE and removed, so totals
+never go backwards (which a scraper would read as a counter reset) and
+the directory doesn't grow with every worker ever started.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+import fcntl
+import json
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) used when a histogram doesn't specify its own
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Minimum number of seconds between snapshot writes from a process
+FLUSH_INTERVAL = 5.0
+
+# Snapshot holding the final values of processes that have exited
+DEAD_FILE = "dead.json"
+
+
+def _labelkey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    # Label values escape backslash, double quote and newline
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for (k, v) in items)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, registry, name, doc):
+        self.registry = registry
+        self.name = name
+        self.doc = doc
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _labelkey(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def snapshot(self):
+        return [[list(map(list, k)), v] for (k, v) in self.values.items()]
+
+    @classmethod
+    def merge(cls, snapshots):
+        total = {}
+        for snap in snapshots:
+            for (k, v) in snap:
+                key = tuple(map(tuple, k))
+                total[key] = total.get(key, 0) + v
+        return total
+
+    @classmethod
+    def render(cls, name, merged, buckets=None):
+        for (key, v) in sorted(merged.items()):
+            yield "%s_total%s %s" % (name, _format_labels(key), v)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, registry, name, doc, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _labelkey(labels)
+        i = bisect_left(self.buckets, value)
+        with self.registry.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [0] * (len(self.buckets) + 2)
+            v[i] += 1
+            v[-1] += value
+        self.registry.maybe_flush()
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def timed(self, **labels):
+        """Decorator recording the wall time of each call"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        return [[list(map(list, k)), list(v)] for (k, v) in self.values.items()]
+
+    @classmethod
+    def merge(cls, snapshots):
+        total = {}
+        for snap in snapshots:
+            for (k, v) in snap:
+                key = tuple(map(tuple, k))
+                if key in total:
+                    total[key] = [a + b for (a, b) in zip(total[key], v)]
+                else:
+                    total[key] = list(v)
+        return total
+
+    @classmethod
+    def render(cls, name, merged, buckets):
+        for (key, v) in sorted(merged.items()):
+            cumulative = 0
+            for (le, n) in zip(list(buckets) + ["+Inf"], v[:-1]):
+                cumulative += n
+                yield "%s_bucket%s %s" % (
+                    name, _format_labels(key, [("le", le)]), cumulative)
+            yield "%s_count%s %s" % (name, _format_labels(key), cumulative)
+            yield "%s_sum%s %s" % (name, _format_labels(key), v[-1])
+
+
+class Registry:
+    def __init__(self, directory=None):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.directory = directory
+        self.last_flush = 0.0
+
+    def counter(self, name, doc):
+        return self._get(Counter, name, doc)
+
+    def histogram(self, name, doc, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, doc, buckets)
+
+    def _get(self, cls, name, doc, *args):
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(self, name, doc, *args)
+        return m
+
+    def get_directory(self):
+        if self.directory is None:
+            from django.conf import settings
+            self.directory = getattr(settings, "METRICS_DIR", None) or ""
+        return self.directory
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: {
+                    "kind": m.kind,
+                    "doc": m.doc,
+                    "buckets": list(getattr(m, "buckets", ())),
+                    "values": m.snapshot(),
+                }
+                for (name, m) in self.metrics.items()
+            }
+
+    def maybe_flush(self):
+        now = time.monotonic()
+        if now - self.last_flush >= FLUSH_INTERVAL:
+            self.last_flush = now
+            self.flush()
+
+    def flush(self):
+        """Write this process's snapshot to the shared metrics directory"""
+        directory = self.get_directory()
+        if not directory:
+            return
+        path = os.path.join(directory, "%d.json" % os.getpid())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(self.snapshot(), fp)
+            os.replace(tmp, path)
+        except OSError as err:
+            logger.warning("Could not write metrics snapshot %s: %s"
+                           % (path, err))
+
+    def fold(self, fname):
+        """Add an exited process's snapshot to DEAD_FILE and remove it"""
+        directory = self.get_directory()
+        path = os.path.join(directory, fname)
+        claimed = "%s.%d.folding" % (path, os.getpid())
+        try:
+            # Only one collector gets to fold each snapshot
+            os.rename(path, claimed)
+        except OSError:
+            return
+        kinds = {"counter": Counter, "histogram": Histogram}
+        dead = os.path.join(directory, DEAD_FILE)
+        with open(dead + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            snapshots = []
+            for name in (dead, claimed):
+                try:
+                    with open(name) as fp:
+                        snapshots.append(json.load(fp))
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError) as err:
+                    logger.warning("Could not read metrics snapshot %s: %s"
+                                   % (name, err))
+            folded = {}
+            for snap in snapshots:
+                for (name, m) in snap.items():
+                    entry = folded.setdefault(name, dict(m, values=[]))
+                    entry["values"].append(m["values"])
+            for m in folded.values():
+                merged = kinds[m["kind"]].merge(m["values"])
+                m["values"] = [[list(map(list, k)), v]
+                               for (k, v) in merged.items()]
+            tmp = dead + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(folded, fp)
+            os.replace(tmp, dead)
+            os.remove(claimed)
+
+    def collect(self):
+        """Return snapshots from every process, including this one"""
+        snapshots = [self.snapshot()]
+        directory = self.get_directory()
+        if directory and os.path.isdir(directory):
+            own = "%d.json" % os.getpid()
+            fnames = [f for f in sorted(os.listdir(directory))
+                      if f != own and f.endswith(".json")]
+            for fname in fnames:
+                pid = fname[:-len(".json")]
+                if pid.isdigit() and not _alive(int(pid)):
+                    try:
+                        self.fold(fname)
+                    except OSError as err:
+                        logger.warning("Could not fold metrics snapshot "
+                                       "%s: %s" % (fname, err))
+            for fname in sorted(os.listdir(directory)):
+                pid = fname[:-len(".json")]
+                if (fname == own or not fname.endswith(".json")
+                        or pid.isdigit() and not _alive(int(pid))):
+                    continue
+                try:
+                    with open(os.path.join(directory, fname)) as fp:
+                        snapshots.append(json.load(fp))
+                except (OSError, ValueError) as err:
+                    logger.warning("Skipping metrics snapshot %s: %s"
+                                   % (fname, err))
+        return snapshots
+
+    def exposition(self):
+        """Render all metrics in the Prometheus text format"""
+        kinds = {"counter": Counter, "histogram": Histogram}
+        merged = {}
+        for snap in self.collect():
+            for (name, m) in snap.items():
+                entry = merged.setdefault(name, {
+                    "kind": m["kind"], "doc": m["doc"],
+                    "buckets": m["buckets"], "values": []})
+                entry["values"].append(m["values"])
+
+        lines = []
+        for name in sorted(merged):
+            m = merged[name]
+            cls = kinds[m["kind"]]
+            lines.append("# HELP %s %s" % (name, m["doc"]))
+            lines.append("# TYPE %s %s" % (name, m["kind"]))
+            lines.extend(cls.render(name, cls.merge(m["values"]),
+                                    m["buckets"]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+ingest_records = registry.counter(
+    "bolushistory_ingest_records",
+    "Event records seen by ingest, by type and outcome")
+window_query_seconds = registry.histogram(
+    "bolushistory_window_query_seconds",
+    "Latency of event window queries")
+plot_render_seconds = registry.histogram(
+    "bolushistory_plot_render_seconds",
+    "Time spent rendering meal plots")
+cache_requests = registry.counter(
+    "bolushistory_cache_requests",
+    "Cache lookups, by cache name and result")
+db_lock_retries = registry.counter(
+    "bolushistory_db_lock_retries",
+    "Writes retried because SQLite reported the database locked")
+sync_pulls = registry.counter(
+    "bolushistory_sync_pulls",
+    "Scheduled Tandem pulls, by source and outcome")
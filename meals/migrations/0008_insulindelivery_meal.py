@@ -0,0 +1,24 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0001_squashed_0007_meal_appx_alter_insulindelivery_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='insulindelivery',
+            name='meal',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='boluses', to='meals.meal'),
+        ),
+        migrations.AlterField(
+            model_name='meal',
+            name='dish',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='meals.dish'),
+        ),
+    ]
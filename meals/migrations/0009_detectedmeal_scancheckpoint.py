@@ -0,0 +1,34 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0008_insulindelivery_meal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectedMeal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('when', models.DateTimeField(unique=True, verbose_name='Detected rise start')),
+                ('rise', models.IntegerField(verbose_name='Rise over detection run (mg/dL)')),
+                ('rate', models.FloatField(verbose_name='Mean rate of rise (mg/dL/min)')),
+                ('bolus', models.BooleanField(default=False, verbose_name='Bolus given near rise')),
+            ],
+            options={
+                'ordering': ['when'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ScanCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('position', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0009_detectedmeal_scancheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MealResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vector', models.BinaryField()),
+                ('meal', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='response', to='meals.meal')),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:37
+
+from django.db import migrations, models
+
+
+def build_coverage(apps, schema_editor):
+    from meals.coverage import runs
+
+    GlucoseMeasurement = apps.get_model("meals", "GlucoseMeasurement")
+    CoverageInterval = apps.get_model("meals", "CoverageInterval")
+    times = (GlucoseMeasurement.objects.order_by("when")
+             .values_list("when", flat=True).iterator(chunk_size=10000))
+    CoverageInterval.objects.bulk_create([
+        CoverageInterval(start=s, end=e, readings=n)
+        for (s, e, n) in runs(times)], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0010_mealresponse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoverageInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(db_index=True)),
+                ('end', models.DateTimeField(db_index=True)),
+                ('readings', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+        migrations.RunPython(build_coverage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0011_coverageinterval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AGPReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('days', models.IntegerField()),
+                ('end', models.DateField(verbose_name='Last day covered')),
+                ('result', models.JSONField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='agpreport',
+            constraint=models.UniqueConstraint(fields=('days', 'end'), name='unique_agp_range'),
+        ),
+    ]
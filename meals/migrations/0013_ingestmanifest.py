@@ -0,0 +1,27 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0012_agpreport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True)),
+                ('upload_id', models.BigIntegerField(blank=True, null=True)),
+                ('first_source_rec', models.BigIntegerField(blank=True, null=True)),
+                ('last_source_rec', models.BigIntegerField(blank=True, null=True)),
+                ('events', models.IntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('committed', models.DateTimeField(auto_now=True)),
+                ('flagged', models.BooleanField(default=False, verbose_name='Content changed since first import')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0013_ingestmanifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MealPlot',
+            fields=[
+                ('meal', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='plot', serialize=False, to='meals.meal')),
+                ('html', models.TextField(blank=True)),
+                ('version', models.IntegerField(default=1)),
+                ('rendered_version', models.IntegerField(default=0)),
+                ('requested', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['requested'], name='meals_mealp_request_3a67d7_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0014_mealplot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BasalSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(unique=True)),
+                ('end', models.DateTimeField()),
+                ('rate', models.FloatField(verbose_name='Units/hour')),
+                ('cumulative', models.FloatField(default=0)),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+    ]
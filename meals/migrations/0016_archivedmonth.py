@@ -0,0 +1,31 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0015_basalsegment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('month', models.DateField()),
+                ('rows', models.IntegerField()),
+                ('size', models.IntegerField(verbose_name='File size (bytes)')),
+                ('archived', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['model', 'month'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmonth',
+            constraint=models.UniqueConstraint(fields=('model', 'month'), name='unique_archived_month'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.2.8 on 2026-10-19 05:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+
+
+def _readings(apps):
+    """(when, value) of every CGM reading, archived months included"""
+    from meals import archive
+
+    GlucoseMeasurement = apps.get_model("meals", "GlucoseMeasurement")
+    ArchivedMonth = apps.get_model("meals", "ArchivedMonth")
+    readings = list(GlucoseMeasurement.objects.values_list("when", "value"))
+    root = archive.get_config()["directory"]
+    for record in ArchivedMonth.objects.filter(
+            model="meals.glucosemeasurement"):
+        # Month files are not yet kept per patient at this point
+        name = os.path.join(root, record.model,
+                            "%s.json.gz" % record.month.strftime("%Y-%m"))
+        if not os.path.exists(name):
+            continue
+        with gzip.open(name, "rt", encoding="utf-8") as fp:
+            data = json.load(fp)
+        (i, j) = (data["fields"].index("when"), data["fields"].index("value"))
+        readings += [(datetime.fromisoformat(row[i]), int(row[j]))
+                     for row in data["rows"]]
+    readings.sort()
+    return readings
+
+
+def build_summaries(apps, schema_editor):
+    from django.db.models import Count, Max, Sum
+    from meals.summary import PEAK_HOURS
+
+    Dish = apps.get_model("meals", "Dish")
+    DishSummary = apps.get_model("meals", "DishSummary")
+    Meal = apps.get_model("meals", "Meal")
+
+    readings = _readings(apps)
+    times = [r[0] for r in readings]
+    meals = list(Meal.objects.only("pk", "when"))
+    for meal in meals:
+        window = readings[bisect_left(times, meal.when):
+                          bisect_right(times, meal.when +
+                                       timedelta(hours=PEAK_HOURS))]
+        meal.peak = max((v for (_, v) in window), default=None)
+    Meal.objects.bulk_update(meals, ["peak"], batch_size=1000)
+
+    stats = {row["dish"]: row for row in
+             Meal.objects.values("dish").order_by().annotate(
+                 meals=Count("id"), last=Max("when"),
+                 total=Sum("peak"), peaks=Count("peak"))}
+    summaries = []
+    for pk in Dish.objects.values_list("pk", flat=True):
+        row = stats.get(pk)
+        if row is None:
+            summaries.append(DishSummary(dish_id=pk))
+            continue
+        summaries.append(DishSummary(
+            dish_id=pk, meals=row["meals"], last_eaten=row["last"],
+            peak_total=row["total"] or 0, peak_meals=row["peaks"],
+            mean_peak=row["total"]/row["peaks"] if row["peaks"] else None))
+    DishSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0016_archivedmonth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DishSummary',
+            fields=[
+                ('dish', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='meals.dish')),
+                ('meals', models.IntegerField(db_index=True, default=0)),
+                ('last_eaten', models.DateTimeField(db_index=True, null=True)),
+                ('peak_total', models.FloatField(default=0)),
+                ('peak_meals', models.IntegerField(default=0)),
+                ('mean_peak', models.FloatField(db_index=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='peak',
+            field=models.IntegerField(blank=True, editable=False, null=True, verbose_name='Peak glucose'),
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
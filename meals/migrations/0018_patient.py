@@ -0,0 +1,207 @@
+# Generated by Django 4.2.8 on 2026-10-19 06:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import meals.patients
+
+import os
+
+
+def create_default_patient(apps, schema_editor):
+    # Existing rows are assigned to the default patient
+    Patient = apps.get_model("meals", "Patient")
+    Patient.objects.get_or_create(pk=meals.patients.default_id(),
+                                  defaults={"name": "default"})
+
+
+def move_archives(apps, schema_editor):
+    # Month files are now kept per patient; see meals.archive.path
+    from meals import archive
+    ArchivedMonth = apps.get_model("meals", "ArchivedMonth")
+    root = archive.get_config()["directory"]
+    for record in ArchivedMonth.objects.all():
+        name = "%s.json.gz" % record.month.strftime("%Y-%m")
+        old = os.path.join(root, record.model, name)
+        new = os.path.join(root, str(record.patient_id), record.model, name)
+        if os.path.exists(old):
+            os.makedirs(os.path.dirname(new), exist_ok=True)
+            os.replace(old, new)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0017_dishsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Patient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('env_prefix', models.CharField(default='TCONNECT', help_text='t:connect login is read from <prefix>_EMAIL, <prefix>_PASSWORD and <prefix>_SERIAL_NUMBER', max_length=50, verbose_name='Credential variable prefix')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.RunPython(create_default_patient, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='agpreport',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='archivedmonth',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='basalsegment',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='coverageinterval',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='detectedmeal',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='dish',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='glucosemeasurement',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='ingestmanifest',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='insulindelivery',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='meal',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.AddField(
+            model_name='scancheckpoint',
+            name='patient',
+            field=models.ForeignKey(default=meals.patients.current_id, on_delete=django.db.models.deletion.CASCADE, db_index=False, to='meals.patient'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='agpreport',
+            name='unique_agp_range',
+        ),
+        migrations.RemoveConstraint(
+            model_name='archivedmonth',
+            name='unique_archived_month',
+        ),
+        migrations.AlterField(
+            model_name='basalsegment',
+            name='start',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='coverageinterval',
+            name='end',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='coverageinterval',
+            name='start',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='detectedmeal',
+            name='when',
+            field=models.DateTimeField(verbose_name='Detected rise start'),
+        ),
+        migrations.AlterField(
+            model_name='dish',
+            name='desc',
+            field=models.CharField(max_length=200, verbose_name='description'),
+        ),
+        migrations.AlterField(
+            model_name='glucosemeasurement',
+            name='when',
+            field=models.DateTimeField(verbose_name='Date/Time'),
+        ),
+        migrations.AlterField(
+            model_name='ingestmanifest',
+            name='key',
+            field=models.CharField(max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='insulindelivery',
+            name='when',
+            field=models.DateTimeField(verbose_name='Date/Time'),
+        ),
+        migrations.AlterField(
+            model_name='scancheckpoint',
+            name='name',
+            field=models.CharField(max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='coverageinterval',
+            index=models.Index(fields=['patient', 'start'], name='meals_cover_patient_b6bbb7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coverageinterval',
+            index=models.Index(fields=['patient', 'end'], name='meals_cover_patient_053bf8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meal',
+            index=models.Index(fields=['patient', 'when'], name='meals_meal_patient_cccd94_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='agpreport',
+            constraint=models.UniqueConstraint(fields=('patient', 'days', 'end'), name='unique_agp_range'),
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmonth',
+            constraint=models.UniqueConstraint(fields=('patient', 'model', 'month'), name='unique_archived_month'),
+        ),
+        migrations.AddConstraint(
+            model_name='basalsegment',
+            constraint=models.UniqueConstraint(fields=('patient', 'start'), name='unique_basal_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='detectedmeal',
+            constraint=models.UniqueConstraint(fields=('patient', 'when'), name='unique_detected_when'),
+        ),
+        migrations.AddConstraint(
+            model_name='dish',
+            constraint=models.UniqueConstraint(fields=('patient', 'desc'), name='unique_dish_desc'),
+        ),
+        migrations.AddConstraint(
+            model_name='glucosemeasurement',
+            constraint=models.UniqueConstraint(fields=('patient', 'when'), name='unique_glucosemeasurement_when'),
+        ),
+        migrations.AddConstraint(
+            model_name='ingestmanifest',
+            constraint=models.UniqueConstraint(fields=('patient', 'key'), name='unique_manifest_key'),
+        ),
+        migrations.AddConstraint(
+            model_name='insulindelivery',
+            constraint=models.UniqueConstraint(fields=('patient', 'when'), name='unique_insulindelivery_when'),
+        ),
+        migrations.AddConstraint(
+            model_name='scancheckpoint',
+            constraint=models.UniqueConstraint(fields=('patient', 'name'), name='unique_checkpoint_name'),
+        ),
+        migrations.RunPython(move_archives, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.8 on 2026-10-19 06:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('meals', '0018_patient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestmanifest',
+            name='digests',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
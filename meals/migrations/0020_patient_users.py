@@ -0,0 +1,20 @@
+# Generated by Django 4.2.8 on 2026-10-19 06:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('meals', '0019_ingestmanifest_digests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='users',
+            field=models.ManyToManyField(blank=True, help_text='Users who may view this patient; superusers may view every patient', related_name='patients', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.urls import reverse
 
@@ -5,22 +6,81 @@ from datetime import timedelta
 from math import ceil, floor
 from types import SimpleNamespace
 
-import plotly.graph_objects as go
-import numpy as np
+from meals import coverage, metrics, patients
 
 import logging
 logger = logging.getLogger(__name__)
 
-class Dish(models.Model):
-    desc = models.CharField(max_length=200, unique=True,
-                            verbose_name="description")
+# Glucose bands (mg/dL) shaded on plots and used for time-in-range
+GLUCOSE_STOPS = [0,70,90,140,180,200]
+
+class Patient(models.Model):
+    """Person whose meals and pump data are tracked"""
+    name = models.CharField(max_length=100, unique=True)
+    # Tandem credentials are kept out of the database; see
+    # tconnectdata.getLogin
+    env_prefix = models.CharField(
+        "Credential variable prefix", max_length=50, default="TCONNECT",
+        help_text="t:connect login is read from <prefix>_EMAIL, "
+        "<prefix>_PASSWORD and <prefix>_SERIAL_NUMBER")
+    users = models.ManyToManyField(
+        settings.AUTH_USER_MODEL, blank=True, related_name="patients",
+        help_text="Users who may view this patient; superusers may view "
+        "every patient")
+
+    class Meta:
+        ordering = ["name"]
+
+    def __str__(self):
+        return self.name
+
+
+class PatientManager(models.Manager):
+    """Rows of the active patient only; see meals.patients"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(
+            patient_id=patients.current_id())
+
+
+class PatientOwned(models.Model):
+    """Base for models holding one patient's data
+
+    `objects` is scoped to the active patient and new rows default to it;
+    `all_objects` spans every patient.
+    """
+    # Not indexed alone: every subclass has an index leading with patient
+    patient = models.ForeignKey('Patient', on_delete=models.CASCADE,
+                                default=patients.current_id, db_index=False)
+
+    objects = PatientManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        abstract = True
+
+
+class Dish(PatientOwned):
+    desc = models.CharField(max_length=200, verbose_name="description")
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "desc"], name="unique_dish_desc")]
+
     def __str__(self):
         return str(self.desc)
 
-class Meal(models.Model):
+class Meal(PatientOwned):
     dish = models.ForeignKey('Dish', on_delete=models.PROTECT)
     when = models.DateTimeField("Time meal started")
     appx = models.BooleanField("Meal time is approximate", default=False)
+    # Highest CGM reading in the hours after the meal; maintained by
+    # meals.summary
+    peak = models.IntegerField("Peak glucose", null=True, blank=True,
+                               editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=["patient", "when"])]
 
     def __str__(self):
         return "%s: %s" % (self.when, self.dish.desc)
@@ -28,13 +88,25 @@ class Meal(models.Model):
     def get_absolute_url(self):
         return reverse("meals:history", args=(self.dish.pk,))
 
+    def plot_html(self):
+        """Pre-rendered plot if current, else rendered inline"""
+        from meals import prerender
+        return prerender.get(self)
+
     def has_egv_data(self):
-        egvs = GlucoseMeasurement.getEventsInWindow(self.when)
-        return len(egvs) > 0
+        with metrics.window_query_seconds.time(model="CoverageInterval"):
+            return coverage.has_data(*EventSeriesModel.window(self.when))
 
+    @metrics.plot_render_seconds.timed()
     def plot_as_div(self):
         """Generate bolus and bg plot for time of meal
         """
+        # Plotting and analytics dependencies are slow to import, so only
+        # load them once a plot is actually drawn
+        import numpy as np
+        import plotly.graph_objects as go
+        from meals import iob
+
         def format_dt(dt, tickval=None):
             """Format datetime according to django template 'D, N j, Y, P'
 
@@ -68,6 +140,14 @@ class Meal(models.Model):
             bolus_line = SimpleNamespace(
                 color = 'red',
             ),
+
+            iob_area = SimpleNamespace(
+                color = 'orange',
+                # IOB axis is scaled so the area fills the lower fraction
+                height = 0.25,
+                min_range = 2.0,
+                title = 'IOB (u)',
+            ),
             
             xaxis = SimpleNamespace(
                 grid = SimpleNamespace(
@@ -92,13 +172,15 @@ class Meal(models.Model):
                 ),
                 fillcolor0 = 'white',
                 fillcolor1 = 'gray',
-                stops = [0,70,90,140,180,200],
+                stops = GLUCOSE_STOPS,
                 title = 'EGV (mg/dL)'
             ),
         )
         
-        egvs = GlucoseMeasurement.getEventsInWindow(self.when)
-        bolus = InsulinDelivery.getEventsInWindow(self.when)
+        with metrics.window_query_seconds.time(model="GlucoseMeasurement"):
+            egvs = list(GlucoseMeasurement.getEventsInWindow(self.when))
+        with metrics.window_query_seconds.time(model="InsulinDelivery"):
+            bolus = list(InsulinDelivery.getEventsInWindow(self.when))
 
         if len(egvs) == 0:
             return None
@@ -124,8 +206,31 @@ class Meal(models.Model):
         fig.add_trace(go.Scatter(
             x=x1,
             y=y1,
+            name="EGV",
         ))
 
+        # Add insulin-on-board as a shaded area under the cgm trace
+        iob_t, iob_u = iob.insulin_on_board(egvs[0].when, egvs[-1].when)
+        iob_max = max(params.iob_area.min_range, float(np.max(iob_u, initial=0)))
+        fig.add_trace(go.Scatter(
+            x=[int((t - t0)/xunit) for t in iob_t],
+            y=np.round(iob_u, 2),
+            name="IOB",
+            yaxis="y2",
+            fill="tozeroy",
+            line_color=params.iob_area.color,
+        ))
+        fig.update_layout(
+            showlegend=False,
+            yaxis2=dict(
+                overlaying="y",
+                side="right",
+                showgrid=False,
+                range=(0, iob_max/params.iob_area.height),
+                title_text=params.iob_area.title,
+            ),
+        )
+
         # Add vertical line at mealtime
         if not self.appx:
             fig.add_vline(
@@ -225,31 +330,55 @@ class Meal(models.Model):
 
 
 
-class EventSeriesModel(models.Model):
-    when = models.DateTimeField("Date/Time", unique=True)
+class EventSeriesModel(PatientOwned):
+    when = models.DateTimeField("Date/Time")
 
     class Meta:
         abstract = True
         ordering = ["when"]
+        # Also the index for every window query
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "when"], name="unique_%(class)s_when")]
+
+    # Default span of event windows around a meal, in hours
+    PRE_HOURS = 1
+    POST_HOURS = 6
+
+    @staticmethod
+    def window(dt, pre=PRE_HOURS, post=POST_HOURS):
+        """Return (begin, end) of the window around given date
+
+        :param dt: datatime to anchor the window
+        :param pre: Number of hours before dt to include
+        :param post: Number of hours after dt to include
+        """
+        return (dt - timedelta(hours=pre), dt + timedelta(hours=post))
 
     @classmethod
-    def getEventsInWindow(self, dt, pre=1, post=6):
+    def getEventsInWindow(self, dt, pre=PRE_HOURS, post=POST_HOURS):
         """Return values in a window around given date
 
         :param dt: datatime to anchor the window
         :param pre: Number of hours before dt to include
         :param post: Number of hours after dt to include
-        :returns: Queryset of events in window
+        :returns: Queryset of events in window, or a list ordered by time
+            when part of the window is in the archive
         """
         
-        begin = dt - timedelta(hours=pre)
-        end = dt + timedelta(hours=post)
+        begin, end = self.window(dt, pre, post)
+        from meals import archive
+        if archive.is_archived(self, begin, end):
+            return archive.events(self, begin, end)
         return self.objects.filter(when__gte=begin, when__lte=end)
 
     
 class InsulinDelivery(EventSeriesModel):
     amount = models.DecimalField("Insulin units", max_digits=5, decimal_places=2)
     duration = models.DurationField("Duration", default=timedelta(0))
+    # Most likely meal for this bolus; maintained by meals.association
+    meal = models.ForeignKey('Meal', null=True, blank=True,
+                             on_delete=models.SET_NULL,
+                             related_name="boluses")
 
     def __str__(self):
         ret = "%s: %f units" % (self.when, self.amount)
@@ -261,3 +390,181 @@ class GlucoseMeasurement(EventSeriesModel):
     value = models.IntegerField()
     def __str__(self):
         return "%s: %s mg/dL" % (self.when, self.value)
+
+
+class CoverageInterval(PatientOwned):
+    """Run of CGM readings with no gap longer than coverage.MAX_GAP"""
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    readings = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ["start"]
+        indexes = [models.Index(fields=["patient", "start"]),
+                   models.Index(fields=["patient", "end"])]
+
+    def __str__(self):
+        return "%s - %s" % (self.start, self.end)
+
+
+class BasalSegment(PatientOwned):
+    """Span of constant basal rate (units/hour), from meals.basal
+
+    `cumulative` is the basal insulin delivered over all segments before
+    this one, so totals over any window need only the segments holding
+    its two ends.
+    """
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    rate = models.FloatField("Units/hour")
+    cumulative = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ["start"]
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "start"], name="unique_basal_start")]
+
+    def __str__(self):
+        return "%s - %s: %.3f u/h" % (self.start, self.end, self.rate)
+
+
+class DishSummary(models.Model):
+    """Per-dish counters for the search page; maintained by meals.summary
+
+    `peak_total` and `peak_meals` are the sum and count of Meal.peak over
+    the dish's meals that have one; `mean_peak` is their ratio.
+    """
+    dish = models.OneToOneField('Dish', on_delete=models.CASCADE,
+                                primary_key=True, related_name="summary")
+    meals = models.IntegerField(default=0, db_index=True)
+    last_eaten = models.DateTimeField(null=True, db_index=True)
+    peak_total = models.FloatField(default=0)
+    peak_meals = models.IntegerField(default=0)
+    mean_peak = models.FloatField(null=True, db_index=True)
+
+    def __str__(self):
+        return "%s: %d meals" % (self.dish, self.meals)
+
+
+class ArchivedMonth(PatientOwned):
+    """Month of events moved to a cold storage file by meals.archive"""
+    model = models.CharField(max_length=100)
+    month = models.DateField()
+    rows = models.IntegerField()
+    size = models.IntegerField("File size (bytes)")
+    archived = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["model", "month"]
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "model", "month"],
+            name="unique_archived_month")]
+
+    def __str__(self):
+        return "%s %s" % (self.model, self.month.strftime("%Y-%m"))
+
+
+class MealPlot(models.Model):
+    """Pre-rendered plot for a meal, doubling as its render job
+
+    `version` is bumped whenever the plot's inputs change; the plot is
+    current when `rendered_version` matches it.  See meals.prerender.
+    """
+    meal = models.OneToOneField('Meal', on_delete=models.CASCADE,
+                                primary_key=True, related_name="plot")
+    html = models.TextField(blank=True)
+    version = models.IntegerField(default=1)
+    rendered_version = models.IntegerField(default=0)
+    requested = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["requested"])]
+
+    def is_current(self):
+        return self.rendered_version == self.version
+
+    def __str__(self):
+        return "Plot for %s" % self.meal_id
+
+
+class MealResponse(models.Model):
+    """Fixed-length postprandial feature vector for a meal
+
+    See meals.similarity for the layout of `vector`.
+    """
+    meal = models.OneToOneField('Meal', on_delete=models.CASCADE,
+                                related_name="response")
+    vector = models.BinaryField()
+
+    def __str__(self):
+        return "Response for %s" % self.meal
+
+
+class AGPReport(PatientOwned):
+    """Cached ambulatory glucose profile; see meals.agp"""
+    days = models.IntegerField()
+    end = models.DateField("Last day covered")
+    result = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["patient", "days", "end"],
+                                    name="unique_agp_range"),
+        ]
+
+    def __str__(self):
+        return "AGP %d days to %s" % (self.days, self.end)
+
+
+class IngestManifest(PatientOwned):
+    """Record of a pump upload (or day of unattributed events) committed
+
+    See meals.manifest.
+    """
+    key = models.CharField(max_length=50)
+    upload_id = models.BigIntegerField(null=True, blank=True)
+    first_source_rec = models.BigIntegerField(null=True, blank=True)
+    last_source_rec = models.BigIntegerField(null=True, blank=True)
+    events = models.IntegerField()
+    checksum = models.CharField(max_length=64)
+    # JSON map of record identity -> digests of the records seen
+    digests = models.TextField(blank=True, default="", editable=False)
+    committed = models.DateTimeField(auto_now=True)
+    flagged = models.BooleanField("Content changed since first import",
+                                  default=False)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "key"], name="unique_manifest_key")]
+
+    def __str__(self):
+        return "%s (%d events)" % (self.key, self.events)
+
+
+class DetectedMeal(PatientOwned):
+    """Likely meal start found in CGM history with no Meal logged near it"""
+    when = models.DateTimeField("Detected rise start")
+    rise = models.IntegerField("Rise over detection run (mg/dL)")
+    rate = models.FloatField("Mean rate of rise (mg/dL/min)")
+    bolus = models.BooleanField("Bolus given near rise", default=False)
+
+    class Meta:
+        ordering = ["when"]
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "when"], name="unique_detected_when")]
+
+    def __str__(self):
+        return "%s: +%d mg/dL" % (self.when, self.rise)
+
+
+class ScanCheckpoint(PatientOwned):
+    """Position reached by an incremental scan over event history"""
+    name = models.CharField(max_length=50)
+    position = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=["patient", "name"], name="unique_checkpoint_name")]
+
+    def __str__(self):
+        return "%s: %s" % (self.name, self.position)
@@ -0,0 +1,76 @@
+"""Active patient for data access
+
+Patient-owned models (see models.PatientOwned) filter their default
+manager on the active patient and assign it to new rows, so derived-data
+modules work on one patient's data without passing the patient through
+every call.  The active patient is held in a context variable:
+
+- requests use the patient selected on the patients page, kept in the
+  session (PatientMiddleware), from those the user may access;
+- ingest, sync and management commands run inside using(patient);
+- anything else gets settings.DEFAULT_PATIENT.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_active = ContextVar("patient", default=None)
+
+SESSION_KEY = "patient"
+
+
+def default_id():
+    from django.conf import settings
+    return getattr(settings, "DEFAULT_PATIENT", 1)
+
+
+def accessible(user):
+    """Patients `user` may switch to"""
+    from meals.models import Patient
+    if user.is_superuser:
+        return Patient.objects.all()
+    return Patient.objects.filter(users__pk=user.pk)
+
+
+def current_id():
+    """Primary key of the active patient"""
+    patient = _active.get()
+    return default_id() if patient is None else patient
+
+
+@contextmanager
+def using(patient):
+    """Make `patient` (a Patient or its pk) active within the block"""
+    token = _active.set(getattr(patient, "pk", patient))
+    try:
+        yield
+    finally:
+        _active.reset(token)
+
+
+def _scoped(iterator, patient):
+    # Streamed responses are consumed after the middleware has returned
+    iterator = iter(iterator)
+    while True:
+        with using(patient):
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+        yield chunk
+
+
+class PatientMiddleware:
+    """Run each request as the patient selected in its session"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        patient = request.session.get(SESSION_KEY)
+        with using(patient):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = _scoped(
+                response.streaming_content, patient)
+        return response
@@ -0,0 +1,176 @@
+"""Background pre-rendering of meal plots
+
+MealPlot rows act as both the job queue and the result store: enqueue()
+bumps a meal's version (creating the row if needed, so repeat requests
+for the same meal collapse into one job), and process() renders every
+out-of-date plot, of every patient, on a pool of worker processes.  A
+result is stored only if the version it was rendered for is still
+current.  A plot that fails to render is logged and left queued, so the
+next pass retries it.
+
+The history view uses get(), which falls back to rendering inline when
+the stored plot is missing or stale.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+
+from meals import metrics, patients
+
+import logging
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+
+def enqueue(meal_ids):
+    """Request (re-)rendering of plots for the given meals"""
+    from django.db.models import F
+    from meals.models import MealPlot
+
+    meal_ids = list(meal_ids)
+    if not meal_ids:
+        return
+    MealPlot.objects.filter(pk__in=meal_ids).update(
+        version=F("version") + 1, requested=datetime.now())
+    MealPlot.objects.bulk_create(
+        [MealPlot(meal_id=pk) for pk in meal_ids], ignore_conflicts=True)
+
+
+def enqueue_window(start, end):
+    """Request plots for meals whose event window overlaps [start, end]"""
+    from meals.models import EventSeriesModel, Meal
+
+    pre = timedelta(hours=EventSeriesModel.PRE_HOURS)
+    post = timedelta(hours=EventSeriesModel.POST_HOURS)
+    enqueue(Meal.objects.filter(when__gte=start - post, when__lte=end + pre)
+            .values_list("pk", flat=True))
+
+
+def store(pk, version, html):
+    """Save a rendered plot unless it was re-requested meanwhile"""
+    from meals.models import MealPlot
+
+    return MealPlot.objects.filter(pk=pk, version=version).update(
+        html=html or "", rendered_version=version) > 0
+
+
+def render(pk):
+    """Render one meal's plot; runs in a worker process"""
+    from meals.models import Meal
+
+    meal = Meal.all_objects.select_related("dish").get(pk=pk)
+    with patients.using(meal.patient_id):
+        return meal.plot_as_div()
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def default_workers():
+    from django.conf import settings
+    workers = getattr(settings, "PLOT_PRERENDER_WORKERS", None)
+    return os.cpu_count() if workers is None else workers
+
+
+def _results(pool, batch):
+    """(pk, version, html or exception) of each job as it finishes"""
+    if pool is None:
+        for (pk, version) in batch:
+            try:
+                yield (pk, version, render(pk))
+            except Exception as e:
+                yield (pk, version, e)
+        return
+    futures = {pool.submit(render, pk): (pk, version)
+               for (pk, version) in batch}
+    for future in as_completed(futures):
+        (pk, version) = futures[future]
+        try:
+            yield (pk, version, future.result())
+        except Exception as e:
+            yield (pk, version, e)
+
+
+def process(workers=None, limit=None):
+    """Render all out-of-date plots
+
+    :param workers: size of the process pool; 0 renders in this process
+    :param limit: stop after this many plots
+    :returns: number of plots stored
+    """
+    from django.db import connections
+    from django.db.models import F
+    from meals.models import MealPlot
+
+    workers = default_workers() if workers is None else workers
+    pool = None
+    if workers:
+        # Workers open their own connections; don't share this one
+        connections.close_all()
+        pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            mp_context=multiprocessing.get_context("spawn"))
+
+    done = 0
+    failed = set()
+    try:
+        while limit is None or done < limit:
+            batch = list(MealPlot.objects
+                         .exclude(rendered_version=F("version"))
+                         .exclude(pk__in=failed)
+                         .order_by("requested")
+                         .values_list("pk", "version")[:BATCH_SIZE])
+            if limit is not None:
+                batch = batch[:limit - done]
+            if not batch:
+                break
+            broken = False
+            for (pk, version, result) in _results(pool, batch):
+                if isinstance(result, Exception):
+                    logger.error("Rendering the plot for meal %d failed"
+                                 % pk, exc_info=result)
+                    failed.add(pk)
+                    broken = broken or isinstance(result, BrokenProcessPool)
+                    continue
+                # Plots re-requested while rendering stay queued
+                done += store(pk, version, result)
+            if broken:
+                # A worker died; the next pass starts a fresh pool
+                break
+    finally:
+        if pool:
+            pool.shutdown()
+    logger.info("Pre-rendered %d meal plots; %d failed"
+                % (done, len(failed)))
+    return done
+
+
+def get(meal):
+    """Plot HTML for a meal, rendering inline if no current plot is stored
+
+    Uses meal.plot when it was fetched with select_related("plot").
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    from meals.models import MealPlot
+
+    try:
+        plot = meal.plot
+    except ObjectDoesNotExist:
+        plot = None
+
+    if plot is not None and plot.is_current():
+        metrics.cache_requests.inc(cache="plot", result="hit")
+        return plot.html or None
+    metrics.cache_requests.inc(cache="plot", result="miss")
+
+    html = meal.plot_as_div()
+    if plot is None:
+        plot, _ = MealPlot.objects.get_or_create(meal=meal)
+    store(meal.pk, plot.version, html)
+    return html
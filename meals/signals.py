@@ -0,0 +1,60 @@
+"""Signal handlers keeping derived data in step with Meal edits
+
+Derived data is updated as the meal's patient, whoever is active.
+"""
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from types import SimpleNamespace
+
+from meals import patients
+from meals.models import Dish, DishSummary, InsulinDelivery, Meal
+
+
+@receiver(pre_save, sender=Meal)
+def remember_meal(sender, instance, raw=False, **kwargs):
+    # Summary counters need the values being replaced by an edit
+    instance._previous = None
+    if raw or instance.pk is None:
+        return
+    previous = (Meal.all_objects.filter(pk=instance.pk)
+                .values("pk", "dish_id", "when", "peak").first())
+    if previous:
+        instance._previous = SimpleNamespace(**previous)
+
+
+@receiver(post_save, sender=Meal)
+def relink_saved_meal(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    from meals import association, detection, prerender, similarity, \
+        summary
+
+    with patients.using(instance.patient_id):
+        # Boluses linked before an edit of the meal time must be revisited
+        linked = list(InsulinDelivery.objects.filter(meal=instance)
+                      .values_list("when", flat=True))
+        association.associate_around(instance.when)
+        if linked:
+            association.associate(min(linked), max(linked))
+        detection.resolve(instance.when)
+        similarity.refresh(instance.when, instance.when)
+        prerender.enqueue([instance.pk])
+        if getattr(instance, "_previous", None):
+            summary.meal_removed(instance._previous)
+        summary.meal_added(instance)
+
+
+@receiver(post_delete, sender=Meal)
+def relink_deleted_meal(sender, instance, **kwargs):
+    from meals import association, summary
+    with patients.using(instance.patient_id):
+        association.associate_around(instance.when)
+        summary.meal_removed(instance)
+
+
+@receiver(post_save, sender=Dish)
+def create_dish_summary(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        DishSummary.objects.get_or_create(dish=instance)
@@ -0,0 +1,230 @@
+"""Similar-response search over meal glucose curves
+
+Each meal's CGM trace from the standard event window is reduced to a
+fixed-length vector: the change from the glucose level at mealtime,
+sampled every GRID_STEP minutes up to the end of the window.  Vectors are
+stored as MealResponse rows and mirrored in a NumPy matrix index per
+patient held by each process, which is topped up incrementally from new
+rows.
+"""
+
+from datetime import timedelta
+import threading
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Sampling grid relative to mealtime (minutes); matches the default
+# getEventsInWindow post-meal span
+GRID_STEP = 15
+GRID_END = 6*60
+GRID = np.arange(0, GRID_END + 1, GRID_STEP)
+
+# Traces with a larger gap between readings are too sparse to compare
+MAX_GAP_MINUTES = 30
+
+DTYPE = np.float32
+
+# Most neighbours a single query may ask for
+MAX_NEIGHBORS = 100
+
+
+def response_vector(when, value, mealtime):
+    """Feature vector for one meal, or None if coverage is insufficient
+
+    :param when: numpy datetime64[s] array of readings, sorted
+    :param value: numpy array of glucose values
+    :param mealtime: datetime the meal started
+    """
+    if len(when) < 2:
+        return None
+    t0 = np.datetime64(mealtime, "s")
+    minutes = (when - t0).astype(np.int64)/60.0
+
+    # Require readings around both ends of the grid and no long gaps
+    if minutes[0] > MAX_GAP_MINUTES/2 or \
+       minutes[-1] < GRID_END - MAX_GAP_MINUTES/2:
+        return None
+    inside = (minutes >= -MAX_GAP_MINUTES) & \
+        (minutes <= GRID_END + MAX_GAP_MINUTES)
+    if np.max(np.diff(minutes[inside]), initial=0) > MAX_GAP_MINUTES:
+        return None
+
+    curve = np.interp(GRID, minutes, value)
+    return (curve - curve[0]).astype(DTYPE)
+
+
+def refresh(start=None, end=None):
+    """Recompute stored vectors for meals whose window overlaps [start, end]
+
+    Meals whose coverage became insufficient lose their stored vector.
+    CGM data for all affected meals is fetched in one query and sliced per
+    meal, so a whole ingest batch costs two queries plus the writes.
+
+    :returns: number of vectors written
+    """
+    from django.db import transaction
+    from meals import archive
+    from meals.models import GlucoseMeasurement, Meal, MealResponse
+
+    pre = timedelta(hours=1)
+    post = timedelta(minutes=GRID_END)
+
+    meals = Meal.objects.order_by("when")
+    if start is not None:
+        meals = meals.filter(when__gte=start - post)
+    if end is not None:
+        meals = meals.filter(when__lte=end + pre)
+    in_range = meals
+    meals = list(meals.values_list("pk", "when"))
+    if not meals:
+        return 0
+
+    rows = archive.values(GlucoseMeasurement, ["when", "value"],
+                          meals[0][1] - pre, meals[-1][1] + post)
+    when = np.array([r[0] for r in rows], dtype="datetime64[s]")
+    value = np.array([r[1] for r in rows], dtype=float)
+
+    mealtimes = np.array([m[1] for m in meals], dtype="datetime64[s]")
+    lo = np.searchsorted(when, mealtimes - np.timedelta64(pre), side="left")
+    hi = np.searchsorted(when, mealtimes + np.timedelta64(post), side="right")
+
+    vectors = []
+    for ((pk, mealtime), i, j) in zip(meals, lo, hi):
+        v = response_vector(when[i:j], value[i:j], mealtime)
+        if v is not None:
+            vectors.append(MealResponse(meal_id=pk, vector=v.tobytes()))
+
+    # Replace rather than update, so indexes see changed vectors as new rows
+    with transaction.atomic():
+        MealResponse.objects.filter(
+            meal__in=in_range.values("pk")).delete()
+        MealResponse.objects.bulk_create(vectors, batch_size=500)
+    logger.info("Stored response vectors for %d of %d meals"
+                % (len(vectors), len(meals)))
+    return len(vectors)
+
+
+class ResponseIndex:
+    """In-memory matrix of meal response vectors
+
+    Rows are appended as new MealResponse records appear; superseded rows
+    are masked out, and the matrix is rebuilt if rows vanish from the DB.
+
+    :param patient: pk of the patient whose meals are indexed
+    """
+
+    def __init__(self, patient):
+        self.patient = patient
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.last_pk = 0
+        self.matrix = np.zeros((0, len(GRID)), dtype=DTYPE)
+        self.meal_ids = np.zeros(0, dtype=np.int64)
+        self.dish_ids = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.slot = {}   # meal id -> row in matrix
+
+    def sync(self):
+        from meals.models import MealResponse
+
+        responses = MealResponse.objects.filter(meal__patient=self.patient)
+        with self.lock:
+            self._append(responses.filter(pk__gt=self.last_pk))
+            # Rows deleted other than by replacement leave stale slots;
+            # cheap to detect by count, and rare enough to rebuild for
+            if responses.filter(pk__lte=self.last_pk).count() \
+               != int(self.alive.sum()):
+                logger.info("Rebuilding meal response index")
+                self.reset()
+                self._append(responses)
+
+    def _append(self, queryset):
+        rows = list(queryset.order_by("pk").values_list(
+            "pk", "meal_id", "meal__dish_id", "vector"))
+        if not rows:
+            return
+
+        n = len(self.meal_ids)
+        self.alive = np.r_[self.alive, np.ones(len(rows), dtype=bool)]
+        for (k, row) in enumerate(rows):
+            old = self.slot.get(row[1])
+            if old is not None:
+                self.alive[old] = False
+            self.slot[row[1]] = n + k
+
+        self.matrix = np.vstack([self.matrix] + [
+            np.frombuffer(bytes(r[3]), dtype=DTYPE) for r in rows])
+        self.meal_ids = np.r_[self.meal_ids, [r[1] for r in rows]]
+        self.dish_ids = np.r_[self.dish_ids, [r[2] for r in rows]]
+        self.last_pk = rows[-1][0]
+
+    def _live(self):
+        return np.flatnonzero(self.alive)
+
+    def nearest_meals(self, meal_id, k=10):
+        """Meals whose response is closest to that of `meal_id`
+
+        :returns: list of (meal id, distance), closest first
+        """
+        self.sync()
+        if meal_id not in self.slot:
+            return []
+        live = self._live()
+        query = self.matrix[self.slot[meal_id]]
+        live = live[self.meal_ids[live] != meal_id]
+        dist = np.linalg.norm(self.matrix[live] - query, axis=1)
+        return self._top(self.meal_ids[live], dist, k)
+
+    def dish_means(self):
+        """Average response per dish
+
+        :returns: (dish ids, matrix of mean vectors)
+        """
+        self.sync()
+        live = self._live()
+        dishes, inverse = np.unique(self.dish_ids[live], return_inverse=True)
+        sums = np.zeros((len(dishes), self.matrix.shape[1]))
+        np.add.at(sums, inverse, self.matrix[live])
+        counts = np.bincount(inverse, minlength=len(dishes))
+        return dishes, sums/counts[:, None]
+
+    def nearest_dishes(self, dish_id, k=10):
+        """Dishes whose average response is closest to that of `dish_id`
+
+        :returns: list of (dish id, distance), closest first
+        """
+        dishes, means = self.dish_means()
+        match = np.flatnonzero(dishes == dish_id)
+        if len(match) == 0:
+            return []
+        others = dishes != dish_id
+        dist = np.linalg.norm(means[others] - means[match[0]], axis=1)
+        return self._top(dishes[others], dist, k)
+
+    @staticmethod
+    def _top(ids, dist, k):
+        if len(ids) > k:
+            part = np.argpartition(dist, k)[:k]
+            ids, dist = ids[part], dist[part]
+        order = np.argsort(dist, kind="stable")
+        return [(int(ids[i]), float(dist[i])) for i in order]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index():
+    """ResponseIndex of the active patient"""
+    from meals import patients
+
+    patient = patients.current_id()
+    with _indexes_lock:
+        if patient not in _indexes:
+            _indexes[patient] = ResponseIndex(patient)
+        return _indexes[patient]
@@ -0,0 +1,62 @@
+"""SQLite connection tuning and lock handling
+
+install() applies settings.SQLITE_PRAGMAS to every new SQLite connection
+(see the concurrent database profile in settings.py).  retry_locked() is
+for writers: the busy timeout covers most contention, but SQLite reports
+some conflicts immediately, e.g. a transaction that read under WAL and
+then finds another writer has committed since.
+"""
+
+from random import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+from django.db.backends.signals import connection_created
+
+from meals import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = 5
+# Base delay (seconds) before the first retry; doubles on each attempt
+RETRY_DELAY = 0.05
+
+
+def configure(sender, connection, **kwargs):
+    """connection_created receiver applying SQLITE_PRAGMAS"""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for (name, value) in settings.SQLITE_PRAGMAS.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+
+def install():
+    if getattr(settings, "SQLITE_PRAGMAS", None):
+        connection_created.connect(configure,
+                                   dispatch_uid="meals.sqlite.configure")
+
+
+def is_locked(err):
+    return isinstance(err, OperationalError) and "locked" in str(err)
+
+
+def retry_locked(func, *args, **kwargs):
+    """Call func, retrying with backoff while the database is locked
+
+    func must run its own transaction: a retry inside an enclosing atomic
+    block would repeat only part of it.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as err:
+            if not is_locked(err) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = RETRY_DELAY * 2**attempt * (1 + random())
+            logger.warning("Database locked in %s; retrying in %.2f s"
+                           % (getattr(func, "__name__", func), delay))
+            metrics.db_lock_retries.inc()
+            time.sleep(delay)
@@ -0,0 +1,145 @@
+"""Per-dish summary counters
+
+DishSummary holds each dish's meal count, when it was last eaten and the
+mean post-meal glucose peak, so the search page can list and sort dishes
+without aggregating over meals and CGM data.  Each meal's own peak is
+kept on Meal.peak, so a meal's contribution can be taken back out.
+
+Counters are adjusted in place with single UPDATEs: meal_added() and
+meal_removed() from the Meal signals (an edit is a removal of the old
+values plus an addition of the new), and refresh_window() from ingest for
+meals whose peak window received readings.  rebuild() recomputes
+everything from scratch.
+"""
+
+from datetime import timedelta
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Span after the start of a meal searched for its glucose peak
+PEAK_HOURS = 3
+
+
+def peak(when):
+    """Highest CGM reading within PEAK_HOURS after `when`, or None"""
+    from django.db.models import Max
+    from meals import archive
+    from meals.models import GlucoseMeasurement
+
+    end = when + timedelta(hours=PEAK_HOURS)
+    if archive.is_archived(GlucoseMeasurement, when, end):
+        return max((e.value for e in
+                    archive.events(GlucoseMeasurement, when, end)),
+                   default=None)
+    return GlucoseMeasurement.objects.filter(
+        when__gte=when, when__lte=end).aggregate(peak=Max("value"))["peak"]
+
+
+def _adjust(dish_id, meals=0, total=0.0, peaks=0, eaten=None):
+    """Apply counter deltas to a dish's summary"""
+    from django.db.models import DateTimeField, F, Value
+    from django.db.models.functions import Coalesce, Greatest, NullIf
+    from meals.models import DishSummary
+
+    DishSummary.objects.get_or_create(dish_id=dish_id)
+    updates = dict(
+        meals=F("meals") + meals,
+        peak_total=F("peak_total") + total,
+        peak_meals=F("peak_meals") + peaks,
+        # Right-hand sides all see the values from before this UPDATE
+        mean_peak=(F("peak_total") + total)/NullIf(F("peak_meals") + peaks,
+                                                   0),
+    )
+    if eaten is not None:
+        eaten = Value(eaten, output_field=DateTimeField())
+        updates["last_eaten"] = Greatest(Coalesce("last_eaten", eaten), eaten)
+    DishSummary.objects.filter(dish_id=dish_id).update(**updates)
+
+
+def meal_added(meal):
+    """Count a new (or just edited) meal in its dish's summary"""
+    from meals.models import Meal
+
+    meal.peak = peak(meal.when)
+    Meal.objects.filter(pk=meal.pk).update(peak=meal.peak)
+    _adjust(meal.dish_id, 1, meal.peak or 0, meal.peak is not None,
+            meal.when)
+
+
+def meal_removed(meal):
+    """Take a deleted meal (or a meal's values before an edit) back out
+
+    :param meal: object with the meal's dish_id, when and peak
+    """
+    from django.db.models import Max
+    from meals.models import DishSummary, Meal
+
+    _adjust(meal.dish_id, -1, -(meal.peak or 0), -(meal.peak is not None))
+    # Only removing the latest meal moves last_eaten back
+    DishSummary.objects.filter(dish_id=meal.dish_id,
+                               last_eaten__lte=meal.when).update(
+        last_eaten=Meal.objects.filter(dish_id=meal.dish_id)
+        .exclude(pk=meal.pk).order_by().values("dish_id")
+        .annotate(last=Max("when")).values("last"))
+
+
+def refresh_window(start, end):
+    """Update peaks of meals whose peak window overlaps [start, end]
+
+    :returns: number of meals whose peak changed
+    """
+    from meals.models import Meal
+
+    deltas = {}
+    changed = 0
+    meals = Meal.objects.filter(
+        when__gte=start - timedelta(hours=PEAK_HOURS), when__lte=end)
+    for (pk, dish_id, when, old) in meals.values_list(
+            "pk", "dish_id", "when", "peak"):
+        new = peak(when)
+        if new == old:
+            continue
+        Meal.objects.filter(pk=pk).update(peak=new)
+        (total, peaks) = deltas.get(dish_id, (0, 0))
+        deltas[dish_id] = (total + (new or 0) - (old or 0),
+                           peaks + (new is not None) - (old is not None))
+        changed += 1
+    for (dish_id, (total, peaks)) in deltas.items():
+        _adjust(dish_id, total=total, peaks=peaks)
+    return changed
+
+
+def rebuild():
+    """Recompute the active patient's meal peaks and dish summaries
+
+    :returns: number of dish summaries stored
+    """
+    from django.db import transaction
+    from django.db.models import Count, Max, Sum
+    from meals import patients
+    from meals.models import Dish, DishSummary, Meal
+
+    with transaction.atomic():
+        for (pk, when) in Meal.objects.values_list("pk", "when").iterator():
+            Meal.objects.filter(pk=pk).update(peak=peak(when))
+        stats = {row["dish"]: row for row in
+                 Meal.objects.values("dish").order_by().annotate(
+                     meals=Count("id"), last=Max("when"),
+                     total=Sum("peak"), peaks=Count("peak"))}
+        summaries = []
+        for pk in Dish.objects.values_list("pk", flat=True):
+            row = stats.get(pk)
+            if row is None:
+                summaries.append(DishSummary(dish_id=pk))
+                continue
+            summaries.append(DishSummary(
+                dish_id=pk, meals=row["meals"], last_eaten=row["last"],
+                peak_total=row["total"] or 0, peak_meals=row["peaks"],
+                mean_peak=(row["total"]/row["peaks"]
+                           if row["peaks"] else None)))
+        DishSummary.objects.filter(
+            dish__patient=patients.current_id()).delete()
+        DishSummary.objects.bulk_create(summaries, batch_size=1000)
+    logger.info("Rebuilt summaries for %d dishes" % len(summaries))
+    return len(summaries)
@@ -0,0 +1,244 @@
+"""Long-running Tandem sync service
+
+Each data source used by the app (see tconnectdata.dataQueries) is pulled
+by its own asyncio task every TANDEM_SYNC["interval_seconds"], with random
+jitter so sources and restarted services don't fire in lockstep.  A
+service syncs one patient, and all its pulls share that patient's API
+session, one request at a time.  Requests to Tandem run on the default
+executor; commits run on
+a database thread of the service's own, so each patient's ingest writes
+are serialized and reuse one connection, while several services (see
+run_all) ingest for different patients in parallel.
+
+Progress is kept per patient and source as a ScanCheckpoint named
+"sync:<source>", holding the time of the newest event committed.  The
+pump uploads to Tandem only now and then, so a span fetched before an
+upload can fill in later; starting each pull `overlap_seconds` before the
+newest event, rather than from the end of the last request, picks such
+events up.  After downtime the gap is
+backfilled, oldest first and in chunks of at most `chunk_days`; a crash
+mid-backfill resumes from the last chunk committed.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import random
+import threading
+
+from meals import metrics, patients, tconnectdata
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Default schedule; override with settings.TANDEM_SYNC
+DEFAULT_SCHEDULE = {
+    "interval_seconds": 30*60,
+    # Each wait is randomly lengthened or shortened by up to this fraction
+    "jitter": 0.2,
+    # History fetched for a source that has never been synced
+    "initial_days": 7,
+    # Each pull starts this long before the previous one ended
+    "overlap_seconds": 60*60,
+    # Longest span fetched in one request while backfilling
+    "chunk_days": 7,
+    # First delay after a failed pull; doubles up to interval_seconds
+    "retry_seconds": 60,
+}
+
+
+def get_schedule(schedule=None):
+    if schedule is None:
+        from django.conf import settings
+        schedule = getattr(settings, "TANDEM_SYNC", None) or {}
+    params = dict(DEFAULT_SCHEDULE)
+    params.update(schedule)
+    return params
+
+
+def checkpoint_name(key):
+    return "sync:%s" % key
+
+
+def windows(since, until, chunk):
+    """Split [since, until] into consecutive spans no longer than chunk"""
+    result = []
+    while since < until:
+        result.append((since, min(since + chunk, until)))
+        since = result[-1][1]
+    return result
+
+
+def _in_db_thread(patient, func, *args):
+    from django.db import close_old_connections
+
+    # Same connection lifecycle as a request: honours CONN_MAX_AGE and
+    # drops connections that went bad
+    close_old_connections()
+    try:
+        with patients.using(patient):
+            return func(*args)
+    finally:
+        close_old_connections()
+
+
+def _position(key):
+    from meals.models import ScanCheckpoint
+    return (ScanCheckpoint.objects.filter(name=checkpoint_name(key))
+            .values_list("position", flat=True).first())
+
+
+def _advance(key, position):
+    """Move a source's checkpoint forward to `position`, never back"""
+    from meals.models import ScanCheckpoint
+    (checkpoint, created) = ScanCheckpoint.objects.get_or_create(
+        name=checkpoint_name(key), defaults={"position": position})
+    if not created and checkpoint.position < position:
+        checkpoint.position = position
+        checkpoint.save(update_fields=["position"])
+
+
+def _commit(key, data):
+    return tconnectdata.commit({key: data})
+
+
+class SyncService:
+    """Periodic pulls of every source through one API session
+
+    :param api: tconnectsync TConnectApi, or a stand-in with the same
+        controliq and ws2 endpoints
+    :param sources: keys of the data sources to pull; defaults to those
+        the app uses
+    :param schedule: schedule parameters; defaults to settings.TANDEM_SYNC
+    :param clock: returns the current time; replaced in tests
+    :param patient: pk of the patient whose data is pulled; defaults to
+        the active patient
+    """
+
+    def __init__(self, api, sources=None, schedule=None,
+                 clock=datetime.now, patient=None):
+        self.api = api
+        self.patient = patients.current_id() if patient is None else patient
+        self.schedule = get_schedule(schedule)
+        queries = tconnectdata.dataQueries(api)
+        if sources is None:
+            self.sources = [q for q in queries if q.used]
+        else:
+            self.sources = [q for q in queries if q.key in sources]
+        self.clock = clock
+        # TConnectApi logs in lazily and is not safe to share between
+        # concurrent requests
+        self.api_lock = threading.Lock()
+        self.db = ThreadPoolExecutor(max_workers=1,
+                                     thread_name_prefix="sync-db")
+
+    def close(self):
+        self.db.shutdown()
+
+    async def _db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.db, partial(_in_db_thread, self.patient, func, *args))
+
+    def _fetch(self, source, start, end):
+        with self.api_lock:
+            return source.get(start, end)
+
+    async def pull(self, source):
+        """Fetch and commit a source's data since its checkpoint
+
+        :returns: number of spans fetched
+        """
+        now = self.clock()
+        cfg = self.schedule
+        position = await self._db(_position, source.key)
+        if position is None:
+            since = now - timedelta(days=cfg["initial_days"])
+            logger.info("First sync of %s from %s" % (source.desc, since))
+        else:
+            since = position - timedelta(seconds=cfg["overlap_seconds"])
+            gap = now - position
+            if gap > timedelta(seconds=cfg["interval_seconds"]
+                               * (1 + cfg["jitter"]) * 2):
+                logger.warning("Backfilling %s of %s since %s"
+                               % (gap, source.desc, position))
+
+        loop = asyncio.get_running_loop()
+        spans = windows(since, now, timedelta(days=cfg["chunk_days"]))
+        for (start, end) in spans:
+            logger.info("Querying for %s from %s to %s"
+                        % (source.desc, start, end))
+            data = await loop.run_in_executor(
+                None, self._fetch, source, start, end)
+            await self._db(_commit, source.key, data)
+            # Requests cover whole days, so events may lie past `end`
+            newest = tconnectdata.latestTime({source.key: data})
+            if newest is not None:
+                await self._db(_advance, source.key, min(newest, end))
+        return len(spans)
+
+    def delay(self, failures=0):
+        """Seconds until the next pull, with jitter"""
+        cfg = self.schedule
+        base = cfg["interval_seconds"]
+        if failures:
+            base = min(base, cfg["retry_seconds"] * 2**(failures - 1))
+        return base * (1 + random.uniform(-cfg["jitter"], cfg["jitter"]))
+
+    async def _wait(self, stop, seconds):
+        """Sleep, returning early (True) if stop is set"""
+        try:
+            await asyncio.wait_for(stop.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run_source(self, source, stop):
+        # Spread the first pulls of the sources over one jitter period
+        cfg = self.schedule
+        if await self._wait(stop, random.uniform(
+                0, cfg["jitter"] * min(cfg["interval_seconds"], 60))):
+            return
+        failures = 0
+        while True:
+            try:
+                await self.pull(source)
+                failures = 0
+                metrics.sync_pulls.inc(source=source.key, outcome="ok")
+            except Exception as err:
+                failures += 1
+                logger.error("Sync of %s failed (%d in a row): %s"
+                             % (source.desc, failures, err))
+                metrics.sync_pulls.inc(source=source.key, outcome="error")
+            metrics.registry.flush()
+            if await self._wait(stop, self.delay(failures)):
+                return
+
+    async def run(self, stop=None):
+        """Pull every source periodically until stop is set"""
+        stop = stop or asyncio.Event()
+        try:
+            await asyncio.gather(*(self.run_source(s, stop)
+                                   for s in self.sources))
+        finally:
+            self.close()
+
+    async def run_once(self):
+        """Pull every source once, e.g. to catch up from cron"""
+        try:
+            return await asyncio.gather(*(self.pull(s)
+                                          for s in self.sources))
+        finally:
+            self.close()
+
+
+async def run_all(services, stop=None):
+    """Run several services (one per patient) until stop is set"""
+    stop = stop or asyncio.Event()
+    await asyncio.gather(*(service.run(stop) for service in services))
+
+
+async def run_all_once(services):
+    """Pull every source of every service once"""
+    return await asyncio.gather(*(service.run_once() for service in services))
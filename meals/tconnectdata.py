@@ -6,14 +6,11 @@ import json
 import os
 import re
 import sys
+from types import SimpleNamespace
 from typing import Callable
 
 import arrow
 
-from tconnectsync.api import TConnectApi
-from tconnectsync.domain import therapy_event
-from tconnectsync.parser.tconnect import TConnectEntry
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -26,21 +23,28 @@ class TconnectLogin:
     def __str__(self):
         return "(%s, *******, *******)" % self.email
 
-def getLogin():
-    logger.info("Looking for TCONNECT login info environment variables...")
-    email = os.environ.get("TCONNECT_EMAIL")
-    password = os.environ.get("TCONNECT_PASSWORD")
-    sn = os.environ.get("TCONNECT_SERIAL_NUMBER")
+def getLogin(prefix="TCONNECT"):
+    """t:connect login from <prefix>_EMAIL, <prefix>_PASSWORD and
+    <prefix>_SERIAL_NUMBER environment variables
+
+    :param prefix: variable prefix; see Patient.env_prefix
+    """
+    logger.info("Looking for %s login info environment variables..."
+                % prefix)
+    email = os.environ.get(prefix + "_EMAIL")
+    password = os.environ.get(prefix + "_PASSWORD")
+    sn = os.environ.get(prefix + "_SERIAL_NUMBER")
 
     fail = False
     if not email:
-        logger.warning("Missing login email (TCONNECT_EMAIL)")
+        logger.warning("Missing login email (%s_EMAIL)" % prefix)
         fail = True
     if not password:
-        logger.warning("Missing login password (TCONNECT_PASSWORD)")
+        logger.warning("Missing login password (%s_PASSWORD)" % prefix)
         fail = True
     if not sn:
-        logger.warning("Missing t:slim serial number (TCONNECT_SERIAL_NUMBER)")
+        logger.warning("Missing t:slim serial number (%s_SERIAL_NUMBER)"
+                       % prefix)
         fail = True
 
     if sn:
@@ -53,10 +57,47 @@ def getLogin():
     if fail:
         return None
 
-    logger.info("Located TCONNECT login info environment variables")    
+    logger.info("Located %s login info environment variables" % prefix)
     return TconnectLogin(email, password, sn)
     
 
+@dataclass
+class DataQuery:
+    key: str
+    get: Callable
+    desc: str
+    used: bool
+
+def dataQueries(tconnect):
+    """Tandem data sources available through an API session
+
+    :param tconnect: tconnectsync TConnectApi (or an object with the same
+        controliq and ws2 endpoints)
+    """
+    # Endpoints are looked up at call time: TConnectApi logs in on first
+    # use and logs in again when its session expires
+    return (DataQuery("ciqSummary",
+                      lambda *args: tconnect.controliq.dashboard_summary(*args),
+                      "ControlIQ dashboard summary",
+                      False),
+            DataQuery("ciqTimeline",
+                      lambda *args: tconnect.controliq.therapy_timeline(*args),
+                      "ControlIQ therapy timeline",
+                      False),
+            DataQuery("ciqEvents",
+                      lambda *args: tconnect.controliq.therapy_events(*args),
+                      "ControlIQ event history",
+                      True),
+            DataQuery("biqSummary",
+                      lambda *args: tconnect.ws2.basaliqtech(*args),
+                      "BasalIQ summary",
+                      False),
+            DataQuery("csvTimeline",
+                      lambda *args: tconnect.ws2.therapy_timeline_csv(*args),
+                      "WS2 timeline CSV",
+                      True),
+            )
+
 def getTandemData(login, time_start, time_end, allsources=False):
     """Retrieve CGM and insulin event data from Tandem
 
@@ -66,40 +107,14 @@ def getTandemData(login, time_start, time_end, allsources=False):
     :param allsources: Retrieve data sources not used in app models
     :returns: dict of tconnect API query types and results
     """
+    # tconnectsync loads its whole API client on import; only pay for it
+    # when actually talking to Tandem
+    from tconnectsync.api import TConnectApi
     tconnect = TConnectApi(login.email,login.password)
 
-    @dataclass
-    class DataQuery:
-        key: str
-        get: Callable
-        desc: str
-        used: bool
-
-    queries = (DataQuery("ciqSummary",
-                         tconnect.controliq.dashboard_summary,
-                         "ControlIQ dashboard summary",
-                         False),
-               DataQuery("ciqTimeline",
-                         tconnect.controliq.therapy_timeline,
-                         "ControlIQ therapy timeline",
-                         False),
-               DataQuery("ciqEvents",
-                         tconnect.controliq.therapy_events,
-                         "ControlIQ event history",
-                         True),
-               DataQuery("biqSummary",
-                         tconnect.ws2.basaliqtech,
-                         "BasalIQ summary",
-                         False),
-               DataQuery("csvTimeline",
-                         tconnect.ws2.therapy_timeline_csv,
-                         "WS2 timeline CSV",
-                         False),
-               )
-
     data = {}
 
-    for q in filter(lambda x: x.used or allsources, queries):
+    for q in filter(lambda x: x.used or allsources, dataQueries(tconnect)):
         try:
             logger.info("Querying for %s" % q.desc)
             _data = q.get(time_start, time_end)
@@ -120,6 +135,58 @@ def parseTime(timestring):
 
     return datetime.strptime(m.groups()[0], "%Y-%m-%dT%H:%M:%S")
 
+def parseTherapyEvent(data):
+    """Extract the fields used by commit() from a ciqEvents record
+
+    Mirrors tconnectsync's TConnectEntry.parse_therapy_event for CGM and
+    bolus records, without importing tconnectsync just to replay JSON.
+    """
+    event = SimpleNamespace(
+        type = data["type"],
+        eventDateTime = data["eventDateTime"],
+        sourceRecId = data.get("sourceRecId"),
+        rawJson = data,
+    )
+    if event.type == "CGM":
+        event.egv = data["egv"]["estimatedGlucoseValue"]
+    elif event.type == "Bolus":
+        standard = data.get("standard", {})
+        event.insulin = standard.get("insulinDelivered", {}).get("value")
+        event.extended_bolus = \
+            data.get("bolusRequestOptions") == "Extended"
+        if event.extended_bolus:
+            # The extended part runs for "duration" minutes from
+            # bolexStartDateTime; until it completes only its size is known
+            bolex = data.get("bolex", {})
+            event.extended_insulin = bolex.get("insulinDelivered", {}).get(
+                "value", bolex.get("size", 0))
+            event.extended_start = bolex.get("bolexStartDateTime")
+            event.extended_duration = timedelta(
+                minutes=data.get("duration", 0))
+    return event
+
+def isClosingRow(row):
+    """Whether a timeline row is the one Tandem appends to close each day
+
+    These carry the day's last rate at 23:59:59 plus a fraction, whether
+    or not the pump has uploaded that far.
+    """
+    return re.match(r"^\d{4}-\d{2}-\d{2}T23:59:59[.]\d+$",
+                    row.get("EventDateTime", "")) is not None
+
+def latestTime(data):
+    """Newest event time in data as returned by getTandemData, or None"""
+    times = [e.get("eventDateTime", "")
+             for e in (data.get("ciqEvents") or {}).get("event", [])]
+    times += [r.get("EventDateTime", "")
+              for r in (data.get("csvTimeline") or {}).get("basalData", [])
+              if not isClosingRow(r)]
+    return max(filter(None, map(parseTime, times)), default=None)
+
+def saveRecord(record):
+    with transaction.atomic():
+        record.save()
+
 def commit(data):
     """Import Tandem data to app models
 
@@ -130,12 +197,25 @@ def commit(data):
     django.setup()
     from django.conf import settings
     from meals.models import GlucoseMeasurement, InsulinDelivery
+    from meals import basal, coverage, derived, manifest, metrics
+    from meals.sqlite import retry_locked
     
     accepted = {}
     discarded = {}
+    skipped = {}
+    added = {}
 
-    for event in map(TConnectEntry.parse_therapy_event,
-                     data["ciqEvents"]["event"]):
+    # Skip records already committed with identical contents
+    units = manifest.group(data.get("ciqEvents", {}).get("event", []))
+    todo, checksums = manifest.pending(units)
+    new = {id(e) for events in todo.values() for e in events}
+    for events in units.values():
+        for e in events:
+            if id(e) not in new:
+                skipped[e["type"]] = skipped.get(e["type"], 0) + 1
+
+    for event in map(parseTherapyEvent,
+                     (e for events in todo.values() for e in events)):
 
         t = parseTime(event.eventDateTime)
         if not t:
@@ -145,50 +225,99 @@ def commit(data):
         
         if event.type == "CGM":
             logger.debug("Adding CGM record: %s - %s" % (t, event.egv))
-            record = GlucoseMeasurement(
+            records = [GlucoseMeasurement(
                 when = t,
                 value = event.egv,
-            )
+            )]
         elif event.type == "Bolus":
             logger.debug("Adding Bolus record: %s - %s" % (t, event.insulin))
-            if event.extended_bolus:
-                logger.warning("Discarding extended bolus duration data")
-            record = InsulinDelivery(
+            records = [InsulinDelivery(
                 when = t,
                 amount = event.insulin,
-            )
+                # Only present in files written by meals.export
+                duration = timedelta(
+                    seconds=event.rawJson.get("durationSeconds", 0)),
+            )]
+            if event.extended_bolus:
+                start = parseTime(event.extended_start or "")
+                extended = InsulinDelivery(
+                    when = start or t,
+                    amount = event.extended_insulin,
+                    duration = event.extended_duration,
+                )
+                if not event.insulin:
+                    # Entirely extended
+                    records = [extended]
+                    extended.when = t
+                elif start and start != t:
+                    records.append(extended)
+                else:
+                    logger.warning("Extended bolus at %s has no separate "
+                                   "start; spreading it all over %s"
+                                   % (t, extended.duration))
+                    extended.when = t
+                    extended.amount += event.insulin
+                    records = [extended]
         else:
             discarded[event.type] = discarded.get(event.type, 0) + 1
             continue
 
-        try:
-            with transaction.atomic():
-                record.save()
+        for record in records:
+            try:
+                # Browsing or another ingest may hold the write lock
+                retry_locked(saveRecord, record)
                 accepted[event.type] = accepted.get(event.type, 0) + 1
-        except IntegrityError:
-            discarded[event.type] = discarded.get(event.type, 0) + 1
-            rec0 = record.__class__.objects.get(when=record.when)
-            duplicate = True
-            for f in filter(lambda x: x.auto_created == False,
-                            rec0._meta.get_fields()):
-                duplicate = (duplicate and
-                             (getattr(rec0, f.name) == getattr(record, f.name)))
-            if duplicate:
-                logger.info("Ignoring duplicate entry")
-            else:
-                logger.warning(
-                    "Ignoring collision in %s: exists %s; rejecting %s"
-                    % (record.__class__, rec0, record)
-                    )
-        except Exception as err:
-            import sys
-            sys.stderr.write("Unexpected exception type: %s" % err.__class__)
+                added.setdefault(event.type, []).append(record.when)
+            except IntegrityError:
+                discarded[event.type] = discarded.get(event.type, 0) + 1
+                rec0 = record.__class__.objects.get(when=record.when)
+                duplicate = True
+                for f in filter(lambda x: x.auto_created == False,
+                                rec0._meta.get_fields()):
+                    duplicate = (duplicate and
+                                 (getattr(rec0, f.name) ==
+                                  getattr(record, f.name)))
+                if duplicate:
+                    logger.info("Ignoring duplicate entry")
+                else:
+                    logger.warning(
+                        "Ignoring collision in %s: exists %s; rejecting %s"
+                        % (record.__class__, rec0, record)
+                        )
+            except Exception as err:
+                import sys
+                sys.stderr.write("Unexpected exception type: %s"
+                                 % err.__class__)
 
     for (k, v) in accepted.items():
         logger.info("Parsed %d records of type %s" % (v, k))
+        metrics.ingest_records.inc(v, type=k, outcome="accepted")
     for (k, v) in discarded.items():
         logger.warning("Discarded %d records of type %s" % (v, k))
-
+        metrics.ingest_records.inc(v, type=k, outcome="discarded")
+    for (k, v) in skipped.items():
+        logger.info("Skipped %d previously imported records of type %s"
+                    % (v, k))
+        metrics.ingest_records.inc(v, type=k, outcome="skipped")
+    metrics.registry.flush()
+
+    # Basal rates come from the CSV timeline as a list of rate changes
+    timeline = data.get("csvTimeline") or {}
+    if timeline.get("basalData"):
+        retry_locked(basal.ingest, timeline["basalData"])
+
+    for (key, events) in todo.items():
+        retry_locked(manifest.record, key, events, *checksums[key])
+
+    if added.get("CGM"):
+        retry_locked(coverage.add_readings, added["CGM"])
+    times = added.get("CGM", []) + added.get("Bolus", [])
+    if times:
+        derived.refresh_derived(min(times), max(times),
+                                readings="CGM" in added,
+                                boluses="Bolus" in added)
+
+    return {"accepted": accepted, "discarded": discarded, "skipped": skipped}
     
 
 if __name__ == "__main__":
@@ -210,6 +339,9 @@ if __name__ == "__main__":
                         help="File to write JSON output")
     parser.add_argument("--commit", dest="commit", type=bool, default=False,
                         help="Commit retrieved data to database")
+    parser.add_argument("--patient", dest="patient",
+                        help="Name of the patient whose data to download "
+                        "(default: DEFAULT_PATIENT)")
 
     args = parser.parse_args()
 
@@ -242,7 +374,19 @@ if __name__ == "__main__":
     assert(start_date < end_date)
     logger.warning("Using date range %s to %s" % (start_date, end_date))
 
-    login = getLogin()
+    import django
+    django.setup()
+    from meals import patients
+    from meals.models import Patient
+    try:
+        if args.patient:
+            patient = Patient.objects.get(name=args.patient)
+        else:
+            patient = Patient.objects.get(pk=patients.default_id())
+    except Patient.DoesNotExist:
+        parser.error("No patient named %s" % args.patient)
+
+    login = getLogin(patient.env_prefix)
 
     if not login:
         sys.stderr.write("Missing login credentials - aborting")
@@ -259,4 +403,5 @@ if __name__ == "__main__":
 
     if args.commit:
         logger.info("Committing retrieved Tandem data to databases")
-        commit(data)
+        with patients.using(patient):
+            commit(data)
@@ -0,0 +1,110 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+
+from meals.models import CoverageInterval, Dish, DishSummary, \
+    GlucoseMeasurement, IngestManifest, Meal, MealPlot
+from meals import coverage
+from meals.admin import estimate_count
+
+
+class EventAdminTestClass(TestCase):
+    t0 = datetime(2000, 1, 1)
+    url = "/admin/meals/glucosemeasurement/"
+
+    @classmethod
+    def setUpTestData(cls):
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=cls.t0 + timedelta(minutes=5*i), value=100)
+            for i in range(3*288)])
+        coverage.rebuild()
+        User.objects.create_superuser("admin", "admin@example.com", "pw")
+
+    def setUp(self):
+        self.client.login(username="admin", password="pw")
+
+    def test_keyset_paging(self):
+        response = self.client.get(self.url)
+        first = response.context["cl"]
+        self.assertEqual(first.result_list[0].when,
+                         self.t0 + timedelta(minutes=5*(3*288 - 1)))
+        self.assertEqual(first.result_count, 3*288)
+
+        response = self.client.get(self.url + first.get_next_url())
+        second = response.context["cl"].result_list
+        self.assertEqual(second[0].when,
+                         first.result_list[-1].when - timedelta(minutes=5))
+        self.assertEqual(len(second), 200)
+
+    def test_estimate_count_analyzes(self):
+        self.assertEqual(estimate_count(GlucoseMeasurement), 3*288)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM sqlite_stat1 WHERE tbl = %s",
+                           [GlucoseMeasurement._meta.db_table])
+            self.assertGreater(cursor.fetchone()[0], 0)
+        # Later estimates come from the statistics, not a count
+        GlucoseMeasurement.objects.create(when=self.t0 - timedelta(days=1),
+                                          value=100)
+        self.assertEqual(estimate_count(GlucoseMeasurement), 3*288)
+
+    def test_drill_down(self):
+        response = self.client.get(self.url, {"period": "2000-01-02"})
+        cl = response.context["cl"]
+        self.assertEqual(cl.result_count, 288)
+        self.assertTrue(all(r.when.day == 2 for r in cl.result_list))
+
+    def test_delete_range(self):
+        url = self.url + "delete-range/"
+        data = {"start": "2000-01-02 00:00", "end": "2000-01-03 00:00"}
+        response = self.client.post(url, data)
+        self.assertEqual(response.context["count"], 288)
+        self.client.post(url, dict(data, confirm="1"))
+        self.assertEqual(GlucoseMeasurement.objects.count(), 2*288)
+        self.assertEqual(CoverageInterval.objects.count(), 2)
+
+    def test_delete_range_refreshes_derived(self):
+        dish = Dish.objects.create(desc="toast")
+        meal = Meal.objects.create(dish=dish,
+                                   when=self.t0 + timedelta(days=1, hours=12))
+        self.assertEqual(Meal.objects.get(pk=meal.pk).peak, 100)
+        MealPlot.objects.all().delete()
+        data = {"start": "2000-01-02 00:00", "end": "2000-01-03 00:00",
+                "confirm": "1"}
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post(self.url + "delete-range/", data)
+        self.assertEqual(len(callbacks), 1)
+        # The meal lost its peak, and its plot is queued for re-rendering
+        self.assertIsNone(Meal.objects.get(pk=meal.pk).peak)
+        self.assertEqual(DishSummary.objects.get(dish=dish).peak_meals, 0)
+        self.assertTrue(MealPlot.objects.filter(meal=meal).exists())
+
+    def test_single_reading_edits(self):
+        # A reading added in the middle of nowhere is its own interval
+        response = self.client.post(self.url + "add/", {
+            "when_0": "2000-01-10", "when_1": "12:00:00", "value": 150})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(CoverageInterval.objects.count(), 2)
+        reading = GlucoseMeasurement.objects.get(value=150)
+        self.client.post(self.url + "%d/delete/" % reading.pk,
+                         {"post": "yes"})
+        self.assertEqual(CoverageInterval.objects.count(), 1)
+
+    def test_manifest_review(self):
+        for (key, flagged) in (("upload:1", True), ("upload:2", False)):
+            IngestManifest.objects.create(key=key, events=1, checksum="x",
+                                          flagged=flagged)
+        url = "/admin/meals/ingestmanifest/"
+        response = self.client.get(url, {"flagged__exact": "1"})
+        self.assertEqual([m.key for m in response.context["cl"].result_list],
+                         ["upload:1"])
+        flagged = IngestManifest.objects.get(key="upload:1")
+        self.client.post(url, {"action": "clear_flag",
+                               "_selected_action": [flagged.pk]})
+        self.assertFalse(IngestManifest.objects.filter(flagged=True).exists())
+        self.client.post(url, {"action": "forget",
+                               "_selected_action": [flagged.pk]})
+        self.assertEqual(list(IngestManifest.objects.values_list(
+            "key", flat=True)), ["upload:2"])
+
@@ -0,0 +1,83 @@
+from django.test import TestCase
+
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from meals import agp
+from meals.models import AGPReport, GlucoseMeasurement
+
+
+class AGPTestClass(TestCase):
+    end = date(2000, 1, 14)
+
+    @classmethod
+    def setUpTestData(cls):
+        # Day d reads 100 + d all day long, so each bin holds 100..113
+        start = datetime(2000, 1, 1)
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=start + timedelta(days=d, minutes=5*i),
+                               value=100 + d)
+            for d in range(14) for i in range(288)])
+
+    def test_histogram_percentiles(self):
+        rng = np.random.default_rng(0)
+        bins = rng.integers(0, 4, 500)
+        values = np.rint(rng.normal(120, 30, 500))
+        (hist, low) = agp.histogram(bins, values, 5)
+        result = agp.percentiles(hist, low)
+        for b in range(4):
+            np.testing.assert_allclose(
+                result[:, b], np.percentile(values[bins == b],
+                                            agp.PERCENTILES))
+        self.assertTrue(np.all(np.isnan(result[:, 4])))
+
+    def test_compute(self):
+        result = agp.compute(14, self.end)
+        self.assertEqual(result["readings"], 14*288)
+        self.assertEqual(len(result["percentiles"]["50"]), 24*60)
+        self.assertEqual(result["percentiles"]["50"][0], 106.5)
+        # The last minute pools six readings a day, across midnight
+        expected = np.percentile(np.repeat(np.arange(100, 114), 6), 5)
+        self.assertAlmostEqual(result["percentiles"]["5"][-1], expected,
+                               delta=0.05)
+        bands = {b["low"]: b["fraction"] for b in result["time_in_range"]}
+        self.assertEqual(bands[90], 1.0)
+
+    def test_pool_wraps_around(self):
+        rng = np.random.default_rng(1)
+        minute = rng.integers(0, 1440, 3000)
+        values = np.rint(rng.normal(140, 40, 3000))
+        (hist, low) = agp.histogram(minute, values, 1440)
+        result = agp.percentiles(agp.pool(hist, 15), low)
+        for m in (0, 7, 700, 1439):
+            near = np.minimum((minute - m) % 1440, (m - minute) % 1440) <= 15
+            np.testing.assert_allclose(
+                result[:, m], np.percentile(values[near], agp.PERCENTILES))
+
+    def test_peak_placed_to_the_minute(self):
+        # A daily spike at 12:07 peaks at 12:07, not at a bin boundary
+        start = datetime(2001, 1, 1)
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=start + timedelta(days=d, minutes=m),
+                               value=300 if m == 12*60 + 7 else 100)
+            for d in range(14) for m in range(2, 1440, 5)])
+        p95 = agp.compute(14, date(2001, 1, 14))["percentiles"]["95"]
+        peak = [i for (i, v) in enumerate(p95) if v == max(p95)]
+        self.assertIn(12*60 + 7, peak)
+        self.assertEqual(peak, list(range(peak[0], peak[-1] + 1)))
+        self.assertLess(abs((peak[0] + peak[-1])/2 - (12*60 + 7)), 3)
+
+    def test_cache_invalidated_by_ingest_range(self):
+        agp.report(14, self.end)
+        agp.report(30, self.end + timedelta(days=40))
+        self.assertEqual(AGPReport.objects.count(), 2)
+        agp.invalidate(datetime(2000, 1, 10), datetime(2000, 1, 10, 1))
+        self.assertEqual(list(AGPReport.objects.values_list("days", flat=True)),
+                         [30])
+
+    def test_view(self):
+        response = self.client.get("/meals/agp/", {"days": 30})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/meals/agp/", {"days": 7})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,171 @@
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import os
+import tempfile
+from unittest import mock
+
+from meals import agp, archive, association, coverage, export
+from meals.models import ArchivedMonth, CoverageInterval, Dish, GlucoseMeasurement, \
+    InsulinDelivery, Meal
+
+
+class ArchiveTestClass(TestCase):
+    # Data runs from mid-January to mid-March
+    t0 = datetime(2020, 1, 15)
+    cutoff = datetime(2020, 3, 1)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        settings = override_settings(
+            EVENT_ARCHIVE={"directory": self.tmpdir.name})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(self.tmpdir.cleanup)
+        archive._months.clear()
+        archive._boundary.clear()
+
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=self.t0 + timedelta(minutes=30*i),
+                               value=100 + i % 50) for i in range(48*60)])
+        self.meal = Meal.objects.create(
+            dish=Dish.objects.create(desc="stew"),
+            when=datetime(2020, 2, 29, 22))
+        InsulinDelivery.objects.create(when=datetime(2020, 2, 29, 21, 50),
+                                       amount=Decimal("4.50"),
+                                       meal=self.meal)
+        InsulinDelivery.objects.create(when=datetime(2020, 3, 1, 1),
+                                       amount=Decimal("1.25"))
+
+    def snapshot(self, model, begin, end):
+        return [(e.pk, e.when, [getattr(e, f.attname)
+                                for f in model._meta.concrete_fields])
+                for e in archive.events(model, begin, end)]
+
+    def test_move_out_and_read_back(self):
+        span = (self.t0, self.t0 + timedelta(days=60))
+        before = self.snapshot(GlucoseMeasurement, *span)
+        window = list(GlucoseMeasurement.getEventsInWindow(self.meal.when))
+
+        moved = archive.move_out(self.cutoff)
+        self.assertEqual(moved["meals.glucosemeasurement"],
+                         48*(17 + 29))
+        self.assertEqual(moved["meals.insulindelivery"], 1)
+        self.assertFalse(GlucoseMeasurement.objects.filter(
+            when__lt=self.cutoff).exists())
+        self.assertTrue(os.path.exists(archive.path(
+            GlucoseMeasurement, datetime(2020, 2, 1).date())))
+
+        # The meal window straddles the archive boundary
+        self.assertEqual(
+            [(e.when, e.value) for e in
+             GlucoseMeasurement.getEventsInWindow(self.meal.when)],
+            [(e.when, e.value) for e in window])
+        self.assertEqual(self.snapshot(GlucoseMeasurement, *span), before)
+        # Recent windows stay plain querysets
+        self.assertFalse(isinstance(
+            GlucoseMeasurement.getEventsInWindow(datetime(2020, 3, 10)),
+            list))
+
+    def test_restore(self):
+        before = list(InsulinDelivery.objects.values_list(
+            "pk", "when", "amount", "duration", "meal"))
+        coverage.rebuild()
+        archive.move_out(self.cutoff)
+        restored = archive.restore()
+        self.assertEqual(restored["meals.insulindelivery"], 1)
+        self.assertFalse(ArchivedMonth.objects.exists())
+        self.assertEqual(list(InsulinDelivery.objects.values_list(
+            "pk", "when", "amount", "duration", "meal")), before)
+        self.assertEqual(GlucoseMeasurement.objects.count(), 48*60)
+        # Coverage is rebuilt for the restored months, not double counted
+        self.assertEqual(
+            CoverageInterval.objects.aggregate(n=Sum("readings"))["n"],
+            48*60)
+
+    def test_late_rows_merged(self):
+        archive.move_out(self.cutoff)
+        late = datetime(2020, 2, 10, 0, 10)
+        GlucoseMeasurement.objects.create(when=late, value=321)
+        self.assertIn((late, 321), [
+            (e.when, e.value) for e in
+            archive.events(GlucoseMeasurement, late, late)])
+        archive.move_out(self.cutoff)
+        self.assertFalse(GlucoseMeasurement.objects.filter(
+            when=late).exists())
+        record = ArchivedMonth.objects.get(model="meals.glucosemeasurement",
+                                           month=late.date().replace(day=1))
+        self.assertEqual(record.rows, 48*29 + 1)
+        self.assertEqual([e.value for e in archive.archived(
+            GlucoseMeasurement, late, late)], [321])
+
+    def test_derived_data_from_archive(self):
+        archive.move_out(self.cutoff)
+        coverage.rebuild()
+        self.assertTrue(coverage.has_data(datetime(2020, 2, 1, 12),
+                                          datetime(2020, 2, 1, 13)))
+        self.assertEqual(agp.compute(14, datetime(2020, 2, 14).date())
+                         ["readings"], 48*14)
+
+        # Links of archived boluses are rewritten in their month file
+        window = InsulinDelivery.window(self.meal.when)
+        bolus = archive.archived(InsulinDelivery, *window)[0]
+        archive.update(InsulinDelivery, "meal_id",
+                       [(bolus.when, bolus.pk, None)])
+        self.assertIsNone(
+            archive.archived(InsulinDelivery, *window)[0].meal_id)
+        self.assertEqual(association.associate(), 1)
+        self.assertEqual(
+            archive.archived(InsulinDelivery, *window)[0].meal_id,
+            self.meal.pk)
+
+    def test_rows_ingested_while_archiving_kept(self):
+        late = datetime(2020, 2, 10, 0, 10)
+        write_month = archive.write_month
+
+        def ingest_meanwhile(model, month, instances):
+            if model is GlucoseMeasurement and month.month == 2:
+                GlucoseMeasurement.objects.create(when=late, value=321)
+            return write_month(model, month, instances)
+
+        with mock.patch.object(archive, "write_month", ingest_meanwhile):
+            archive.move_out(self.cutoff)
+        # Not in the file yet, so still in the database
+        self.assertEqual(list(GlucoseMeasurement.objects.filter(
+            when__lt=self.cutoff).values_list("value", flat=True)), [321])
+        self.assertIn((late, 321), [
+            (e.when, e.value) for e in
+            archive.events(GlucoseMeasurement, late, late)])
+
+    def test_history_and_export(self):
+        archive.move_out(self.cutoff)
+        response = self.client.get(reverse("meals:history",
+                                           args=[self.meal.dish.pk]))
+        (meal,) = response.context["meal_set"]
+        self.assertEqual(meal.insulin, Decimal("4.50"))
+        self.assertEqual(response.context["insulin_stats"]["total"],
+                         Decimal("4.50"))
+
+        events = list(export.events(("cgm", "bolus")))
+        self.assertEqual(sum(e["type"] == "CGM" for e in events), 48*60)
+        self.assertEqual(sum(e["type"] == "Bolus" for e in events), 2)
+        times = [e["eventDateTime"] for e in events if e["type"] == "CGM"]
+        self.assertEqual(times, sorted(times))
+
+    def test_export_prefers_database_rows(self):
+        archive.move_out(self.cutoff)
+        # A corrected reading ingested over an archived one
+        when = datetime(2020, 2, 10)
+        GlucoseMeasurement.objects.create(when=when, value=321)
+        events = list(export.events(("cgm",), when - timedelta(hours=1),
+                                    when + timedelta(hours=1)))
+        self.assertEqual(
+            [(e["eventDateTime"], e["egv"]["estimatedGlucoseValue"])
+             for e in events],
+            [("2020-02-09T23:00:00", 100 + (26*48 - 2) % 50),
+             ("2020-02-09T23:30:00", 100 + (26*48 - 1) % 50),
+             ("2020-02-10T00:00:00", 321),
+             ("2020-02-10T00:30:00", 100 + (26*48 + 1) % 50)])
@@ -0,0 +1,53 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from meals import association
+from meals.models import Dish, Meal, InsulinDelivery
+
+
+class AssociationTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    def bolus(self, minutes, amount="1.00"):
+        return InsulinDelivery.objects.create(
+            when=self.t0 + timedelta(minutes=minutes), amount=Decimal(amount))
+
+    def setUp(self):
+        self.dish = Dish.objects.create(desc="pizza")
+
+    def test_match_sweep(self):
+        m = timedelta(minutes=1)
+        meals = [(1, self.t0), (2, self.t0 + 40*m)]
+        boluses = [(10, self.t0 - 45*m), (11, self.t0 - 10*m),
+                   (12, self.t0 + 25*m), (13, self.t0 + 15*m),
+                   (14, self.t0 + 2*60*m)]
+        boluses.sort(key=lambda b: b[1])
+        links = association.match(meals, boluses, 30*m, 30*m)
+        self.assertEqual(links, {10: None, 11: 1, 13: 1, 12: 2, 14: None})
+
+    def test_meal_save_links_boluses(self):
+        pre = self.bolus(-15)
+        far = self.bolus(90)
+        meal = Meal.objects.create(dish=self.dish, when=self.t0)
+        pre.refresh_from_db()
+        far.refresh_from_db()
+        self.assertEqual(pre.meal, meal)
+        self.assertIsNone(far.meal)
+
+        # Moving the meal relinks boluses on both sides of the edit
+        meal.when = self.t0 + timedelta(minutes=80)
+        meal.save()
+        pre.refresh_from_db()
+        far.refresh_from_db()
+        self.assertIsNone(pre.meal)
+        self.assertEqual(far.meal, meal)
+
+    def test_history_shows_insulin(self):
+        self.bolus(0, "2.50")
+        self.bolus(5, "1.00")
+        Meal.objects.create(dish=self.dish, when=self.t0)
+        response = self.client.get("/meals/history/%d/" % self.dish.pk)
+        self.assertContains(response, "bolused 3.50 u")
+        self.assertContains(response, "Average bolus: 3.50 u")
@@ -0,0 +1,92 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+import io
+import json
+import os
+
+from meals import basal, tconnectdata
+from meals.models import BasalSegment
+
+CSV = """\
+DeviceType,SerialNumber,Description,EventDateTime,BG,IOB,Note
+t:slim X2 Insulin Pump,123456,BG,2024-01-08T00:33:46,131,0.27,
+
+Type,EventDateTime,BasalRate
+Basal,2024-01-08T00:00:00,1.000
+Basal,2024-01-08T00:00:00,1.000
+Basal,2024-01-08T01:00:00,0.000
+Basal,2024-01-08T01:30:00,2.000
+Basal,2024-01-08T03:00:00,2.000
+Basal,2024-01-08T04:00:00.500,2.000
+
+Type,EventID,EventDateTime,IOB
+IOB,81,2024-01-08T00:00:42,0.50
+"""
+
+
+class BasalTestClass(TestCase):
+    t0 = datetime(2024, 1, 8)
+
+    def at(self, hours):
+        return self.t0 + timedelta(hours=hours)
+
+    def brute_total(self, segs, start, end):
+        return sum(rate*max(0, (min(e, end) - max(s, start))
+                            .total_seconds())/3600
+                   for (s, e, rate) in segs)
+
+    def test_read_csv_segments(self):
+        segs = list(basal.segments(basal.changes(
+            basal.read_csv(io.StringIO(CSV)))))
+        self.assertEqual(segs, [(self.at(0), self.at(1), 1.0),
+                                (self.at(1), self.at(1.5), 0.0),
+                                (self.at(1.5), self.at(4), 2.0)])
+
+    def test_totals(self):
+        basal.ingest(basal.read_csv(io.StringIO(CSV)))
+        self.assertEqual(BasalSegment.objects.count(), 3)
+        self.assertAlmostEqual(basal.total(self.at(0), self.at(4)), 6.0)
+        self.assertAlmostEqual(basal.total(self.at(0.5), self.at(2)), 1.5)
+        # Nothing is delivered outside the stored segments
+        self.assertAlmostEqual(basal.total(self.at(-2), self.at(6)), 6.0)
+        self.assertEqual(basal.total(self.at(5), self.at(6)), 0.0)
+
+    def test_replace_span(self):
+        basal.store([(self.at(0), self.at(10), 1.0)])
+        basal.store([(self.at(12), self.at(14), 3.0)])
+        # Overwrite the middle of the first segment
+        basal.store([(self.at(2), self.at(3), 0.0),
+                     (self.at(3), self.at(4), 4.0)])
+        expected = [(self.at(0), self.at(2), 1.0),
+                    (self.at(2), self.at(3), 0.0),
+                    (self.at(3), self.at(4), 4.0),
+                    (self.at(4), self.at(10), 1.0),
+                    (self.at(12), self.at(14), 3.0)]
+        self.assertEqual(list(BasalSegment.objects.values_list(
+            "start", "end", "rate")), expected)
+        index = basal.BasalIndex.load(self.at(-1), self.at(20))
+        for (a, b) in [(0, 14), (1, 3.5), (3.5, 13), (9, 20)]:
+            want = self.brute_total(expected, self.at(a), self.at(b))
+            self.assertAlmostEqual(basal.total(self.at(a), self.at(b)), want)
+            self.assertAlmostEqual(index.total(self.at(a), self.at(b)), want)
+
+    def test_commit_timeline(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                  "tandem_20240108_20240114_sanitized.json")) as fp:
+            data = json.load(fp)
+        tconnectdata.commit(data)
+        rows = data["csvTimeline"]["basalData"]
+        segs = list(BasalSegment.objects.values_list("start", "end", "rate"))
+        # Repeated rows collapse into far fewer segments
+        self.assertLess(len(segs), len(rows)/2)
+        for (a, b) in zip(segs, segs[1:]):
+            self.assertEqual(a[1], b[0])
+            self.assertNotEqual(a[2], b[2])
+        (start, end) = (self.at(0), self.at(24*7))
+        self.assertAlmostEqual(basal.total(start, end),
+                               self.brute_total(segs, start, end))
+        # Importing the same timeline again changes nothing
+        tconnectdata.commit(data)
+        self.assertEqual(list(BasalSegment.objects.values_list(
+            "start", "end", "rate")), segs)
@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+# Slowest history page load allowed while an ingest runs (seconds);
+# override for slow CI machines
+LATENCY_BUDGET = float(os.environ.get("BOLUSHISTORY_READ_LATENCY_BUDGET", 2))
+
+DATA = os.path.join(os.path.dirname(__file__),
+                    "tandem_20240108_20240114_sanitized.json")
+
+SETUP = """
+from datetime import datetime
+from meals.models import Dish, Meal
+dish = Dish.objects.create(desc="oatmeal")
+for day in range(8, 15):
+    Meal.objects.create(dish=dish, when=datetime(2024, 1, day, 8))
+print(dish.pk)
+"""
+
+# Page loads made while the writer holds its transaction open
+HELD_READS = 5
+
+# Both processes wait here until the other arrives; file-based, as the
+# processes share nothing but the temporary directory
+BARRIER = """
+import os, time
+def wait_for(path, timeout=120):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise SystemExit("Timed out waiting for %%s" %% path)
+        time.sleep(0.01)
+def barrier(name):
+    open(os.path.join(%(tmpdir)r, name + ".ready"), "w").close()
+    for party in ("ingest", "browse"):
+        wait_for(os.path.join(%(tmpdir)r, party + ".ready"))
+"""
+
+# Holds a write transaction open (rolled back afterwards) until the reader
+# has made HELD_READS page loads, then ingests the test data
+INGEST = BARRIER + """
+import json, pathlib
+from datetime import datetime
+from django.db import transaction
+from meals import tconnectdata
+from meals.models import GlucoseMeasurement
+barrier("ingest")
+with transaction.atomic():
+    GlucoseMeasurement.objects.create(when=datetime(2024, 1, 1), value=100)
+    pathlib.Path(%(holding)r).touch()
+    wait_for(%(held)r)
+    transaction.set_rollback(True)
+with open(%(data)r) as fp:
+    result = tconnectdata.commit(json.load(fp))
+pathlib.Path(%(done)r).touch()
+print(json.dumps(result["accepted"]))
+"""
+
+# Page loads (which also render and store meal plots): HELD_READS while the
+# writer's transaction is open, then more until ingest is done.  A first
+# load stores the plots and imports the plotting libraries beforehand, so
+# the held loads are pure reads.
+BROWSE = BARRIER + """
+import json, pathlib, time
+from django.test import Client
+client = Client(HTTP_HOST="localhost")
+def load():
+    t = time.perf_counter()
+    response = client.get("/meals/history/%(dish)d/")
+    return (time.perf_counter() - t, response.status_code)
+load()
+barrier("browse")
+wait_for(%(holding)r)
+held = [load() for _ in range(%(reads)d)]
+pathlib.Path(%(held)r).touch()
+during = []
+while not os.path.exists(%(done)r):
+    during.append(load())
+print(json.dumps({"held": held, "during": during}))
+"""
+
+
+class ConcurrentProfileTestClass(SimpleTestCase):
+    """Ingest and history reads against one database file at once"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = os.path.join(self.tmpdir.name, "db.sqlite3")
+        self.env = dict(os.environ,
+                        BOLUSHISTORY_DB_NAME=self.db,
+                        BOLUSHISTORY_DB_PROFILE="concurrent")
+        self.manage("migrate", "-v0")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def manage(self, *args, background=False):
+        command = [sys.executable, "manage.py"] + list(args)
+        if background:
+            return subprocess.Popen(command, cwd=settings.BASE_DIR,
+                                    env=self.env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, text=True)
+        return subprocess.run(command, cwd=settings.BASE_DIR, env=self.env,
+                              capture_output=True, text=True,
+                              check=True).stdout
+
+    def test_ingest_while_browsing(self):
+        dish = int(self.manage("shell", "-c", SETUP).split()[-1])
+        names = {name: os.path.join(self.tmpdir.name, name)
+                 for name in ("holding", "held", "done")}
+        params = dict(names, tmpdir=self.tmpdir.name, data=DATA, dish=dish,
+                      reads=HELD_READS)
+        ingest = self.manage("shell", "-c", INGEST % params, background=True)
+        browse = self.manage("shell", "-c", BROWSE % params, background=True)
+        (browsed, _) = browse.communicate(timeout=300)
+        (ingested, _) = ingest.communicate(timeout=300)
+        self.assertEqual(browse.returncode, 0)
+        self.assertEqual(ingest.returncode, 0)
+
+        reads = json.loads(browsed.splitlines()[-1])
+        self.assertEqual(len(reads["held"]), HELD_READS)
+        self.assertEqual({status for (_, status) in
+                          reads["held"] + reads["during"]}, {200})
+        # WAL readers don't wait for the open write transaction
+        self.assertLess(max(latency for (latency, _) in reads["held"]),
+                        LATENCY_BUDGET)
+
+        # Every record the ingest accepted is in the database
+        accepted = json.loads(ingested.splitlines()[-1])
+        with open(DATA) as fp:
+            cgm = sum(e["type"] == "CGM" for e in json.load(fp)["ciqEvents"]
+                      ["event"])
+        conn = sqlite3.connect(self.db)
+        try:
+            (journal,) = conn.execute("PRAGMA journal_mode").fetchone()
+            (stored,) = conn.execute(
+                "SELECT COUNT(*) FROM meals_glucosemeasurement").fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(journal, "wal")
+        self.assertEqual(accepted["CGM"], stored)
+        self.assertEqual(stored, cgm)
@@ -0,0 +1,68 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+import json
+import os
+
+from meals import coverage, tconnectdata
+from meals.models import CoverageInterval, Dish, GlucoseMeasurement, Meal
+
+
+class CoverageTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    def minutes(self, *offsets):
+        return [self.t0 + timedelta(minutes=m) for m in offsets]
+
+    def test_runs_split_on_gaps(self):
+        result = coverage.runs(self.minutes(0, 5, 10, 60, 65))
+        self.assertEqual(result, [[self.t0, self.t0 + timedelta(minutes=10), 3],
+                                  [self.t0 + timedelta(minutes=60),
+                                   self.t0 + timedelta(minutes=65), 2]])
+
+    def test_add_readings_merges(self):
+        coverage.add_readings(self.minutes(0, 5, 10))
+        coverage.add_readings(self.minutes(60, 65))
+        self.assertEqual(CoverageInterval.objects.count(), 2)
+        # Filling the gap joins both runs
+        coverage.add_readings(self.minutes(25, 40))
+        self.assertEqual(list(CoverageInterval.objects.values_list(
+            "start", "end", "readings")),
+            [(self.t0, self.t0 + timedelta(minutes=65), 7)])
+
+    def test_fraction(self):
+        index = coverage.CoverageIndex([
+            self.minutes(0, 30), self.minutes(60, 90)])
+        self.assertEqual(index.fraction(*self.minutes(0, 30)), 1.0)
+        self.assertEqual(index.fraction(*self.minutes(15, 75)), 0.5)
+        self.assertEqual(index.fraction(*self.minutes(100, 200)), 0.0)
+        self.assertTrue(index.has_data(*self.minutes(90, 100)))
+        self.assertFalse(index.has_data(*self.minutes(31, 59)))
+
+    def test_has_data(self):
+        coverage.add_readings(self.minutes(0, 5, 10))
+        coverage.add_readings(self.minutes(60, 65))
+        self.assertTrue(coverage.has_data(*self.minutes(10, 20)))
+        self.assertTrue(coverage.has_data(*self.minutes(-10, 0)))
+        self.assertTrue(coverage.has_data(*self.minutes(-10, 100)))
+        self.assertFalse(coverage.has_data(*self.minutes(11, 59)))
+        self.assertFalse(coverage.has_data(*self.minutes(66, 100)))
+
+    def test_ingest_matches_rebuild(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                  "tandem_20240108_20240114_sanitized.json")) as fp:
+            tconnectdata.commit(json.load(fp))
+        ingested = list(CoverageInterval.objects.values_list(
+            "start", "end", "readings"))
+        coverage.rebuild()
+        rebuilt = list(CoverageInterval.objects.values_list(
+            "start", "end", "readings"))
+        self.assertEqual(ingested, rebuilt)
+        self.assertEqual(sum(r[2] for r in rebuilt),
+                         GlucoseMeasurement.objects.count())
+
+    def test_has_egv_data(self):
+        meal = Meal(dish=Dish.objects.create(desc="rice"), when=self.t0)
+        self.assertFalse(meal.has_egv_data())
+        coverage.add_readings(self.minutes(120))
+        self.assertTrue(meal.has_egv_data())
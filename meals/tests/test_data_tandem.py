@@ -1,9 +1,11 @@
 from django.test import TestCase
 
+from datetime import datetime, timedelta
+from decimal import Decimal
 import json
 import os
 
-from meals.models import GlucoseMeasurement, InsulinDelivery
+from meals.models import GlucoseMeasurement, IngestManifest, InsulinDelivery
 from meals import tconnectdata
 
 
@@ -34,3 +36,80 @@ class TConnectTestClass(TestCase):
         tconnectdata.commit(data)
         numBolusEvents_after = len(InsulinDelivery.objects.all())
         self.assertEqual(numBolusEvents_before, numBolusEvents_after)
+
+    def test_manifest_skips_imported_uploads(self):
+        self.assertEqual(IngestManifest.objects.count(), 10)
+        with open(self.testfilename()) as fp:
+            data = json.load(fp)
+        summary = tconnectdata.commit(data)
+        self.assertEqual(summary["accepted"], {})
+        self.assertEqual(summary["skipped"]["CGM"], 1987)
+
+    def test_manifest_flags_changed_upload(self):
+        with open(self.testfilename()) as fp:
+            data = json.load(fp)
+        events = data["ciqEvents"]["event"]
+        bg = [e for e in events if e["uploadId"] == 2039264043]
+        bg[0]["bg"] += 1
+        with self.assertLogs("meals.manifest", "WARNING") as logs:
+            summary = tconnectdata.commit(data)
+        self.assertIn("upload:2039264043 changed", logs.output[0])
+        # Only the changed record is committed again
+        self.assertEqual(summary["discarded"], {"BG": 1})
+        flagged = IngestManifest.objects.filter(flagged=True)
+        self.assertEqual([m.key for m in flagged], ["upload:2039264043"])
+
+        # A day that only gained records is not flagged
+        cgm = [e for e in events if e["type"] == "CGM"]
+        extra = dict(cgm[-1], eventDateTime=cgm[-1]["eventDateTime"][:11]
+                     + "23:59:59")
+        events.append(extra)
+        tconnectdata.commit(data)
+        self.assertEqual(IngestManifest.objects.filter(flagged=True).count(),
+                         1)
+
+    def test_manifest_partial_redownload(self):
+        with open(self.testfilename()) as fp:
+            data = json.load(fp)
+        events = data["ciqEvents"]["event"]
+        day = events[-1]["eventDateTime"][:10]
+        unit = IngestManifest.objects.get(key="day:%s" % day)
+        # The afternoon of a day already imported, plus one new reading
+        cgm = [e for e in events
+               if e["eventDateTime"][:10] == day and e["type"] == "CGM"]
+        later = cgm[len(cgm)//2:]
+        extra = dict(later[-1], eventDateTime=day + "T23:59:59")
+        data["ciqEvents"]["event"] = later + [extra]
+        summary = tconnectdata.commit(data)
+        self.assertEqual(summary["accepted"], {"CGM": 1})
+        self.assertEqual(summary["skipped"], {"CGM": len(later)})
+
+        merged = IngestManifest.objects.get(pk=unit.pk)
+        self.assertFalse(merged.flagged)
+        self.assertEqual(merged.events, unit.events + 1)
+        # The subset alone changes nothing
+        data["ciqEvents"]["event"] = later
+        self.assertEqual(tconnectdata.commit(data)["accepted"], {})
+        self.assertEqual(IngestManifest.objects.get(pk=unit.pk).checksum,
+                         merged.checksum)
+
+    def test_extended_bolus(self):
+        bolus = {
+            "type": "Bolus", "eventDateTime": "2024-01-20T12:00:00",
+            "sourceRecId": 1, "uploadId": 1, "duration": 90,
+            "bolusRequestOptions": "Extended",
+            "standard": {"insulinDelivered": {"value": 1.5}},
+            "bolex": {"size": 2.0,
+                      "bolexStartDateTime": "2024-01-20T12:00:49",
+                      "insulinDelivered": {"value": 1.8},
+                      "extendedBolusIsComplete": 1},
+        }
+        summary = tconnectdata.commit({"ciqEvents": {"event": [bolus]}})
+        self.assertEqual(summary["accepted"], {"Bolus": 2})
+        rows = InsulinDelivery.objects.filter(
+            when__gte=datetime(2024, 1, 20)).order_by("when")
+        self.assertEqual(
+            [(r.when, r.amount, r.duration) for r in rows],
+            [(datetime(2024, 1, 20, 12), Decimal("1.50"), timedelta(0)),
+             (datetime(2024, 1, 20, 12, 0, 49), Decimal("1.80"),
+              timedelta(minutes=90))])
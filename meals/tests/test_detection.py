@@ -0,0 +1,74 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+
+from meals import detection
+from meals.models import DetectedMeal, Dish, GlucoseMeasurement, Meal
+
+
+class DetectionTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 0, 0)
+
+    @classmethod
+    def day(cls, start, rises):
+        """Flat trace at 100 with a 60 mg/dL rise at each hour in `rises`"""
+        records = []
+        for i in range(24*12):
+            t = start + timedelta(minutes=5*i)
+            value = 100
+            for h in rises:
+                k = i - h*12
+                if 0 <= k < 6:
+                    value = 100 + 10*k
+                elif 6 <= k < 18:
+                    value = 160 - 5*(k - 6)
+            records.append(GlucoseMeasurement(when=t, value=value))
+        GlucoseMeasurement.objects.bulk_create(records)
+
+    def test_finds_unlogged_rises(self):
+        self.day(self.t0, [8, 13, 19])
+        Meal.objects.create(dish=Dish.objects.create(desc="soup"),
+                            when=self.t0 + timedelta(hours=13, minutes=10))
+        self.assertEqual(detection.scan(), 2)
+        found = list(DetectedMeal.objects.values_list("when", flat=True))
+        self.assertEqual(found, [self.t0 + timedelta(hours=8),
+                                 self.t0 + timedelta(hours=19)])
+
+    def test_resumes_from_checkpoint(self):
+        self.day(self.t0, [8])
+        detection.scan()
+        self.day(self.t0 + timedelta(days=1), [12])
+        detection.scan()
+        self.assertEqual(DetectedMeal.objects.count(), 2)
+        # Rescanning with no new data finds nothing new
+        detection.scan()
+        self.assertEqual(DetectedMeal.objects.count(), 2)
+
+    def test_logging_meal_resolves_detection(self):
+        self.day(self.t0, [8])
+        detection.scan()
+        Meal.objects.create(dish=Dish.objects.create(desc="eggs"),
+                            when=self.t0 + timedelta(hours=8))
+        self.assertEqual(DetectedMeal.objects.count(), 0)
+
+    def test_finds_slow_rise(self):
+        # 72 mg/dL over an hour at 1.2 mg/dL/min: no three intervals reach
+        # min_rise on their own
+        records = [GlucoseMeasurement(when=self.t0 + timedelta(minutes=5*i),
+                                      value=100 + 6*min(max(i - 24, 0), 12))
+                   for i in range(72)]
+        GlucoseMeasurement.objects.bulk_create(records)
+        self.assertEqual(detection.scan(), 1)
+        found = DetectedMeal.objects.get()
+        self.assertEqual(found.when, self.t0 + timedelta(hours=2))
+        self.assertEqual(found.rise, 72)
+
+    def test_backfill_rewinds_checkpoint(self):
+        self.day(self.t0 + timedelta(days=1), [12])
+        detection.scan()
+        # Older data arriving after the scan
+        self.day(self.t0, [8])
+        detection.rewind(self.t0)
+        # The stored detection is found again but not counted
+        self.assertEqual(detection.scan(), 1)
+        self.assertEqual(DetectedMeal.objects.count(), 2)
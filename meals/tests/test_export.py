@@ -0,0 +1,74 @@
+from django.core.management import call_command
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import gzip
+import io
+import os
+import tempfile
+
+from meals import export
+from meals.models import CoverageInterval, Dish, GlucoseMeasurement, InsulinDelivery, Meal
+
+
+class ExportTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    @classmethod
+    def setUpTestData(cls):
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=cls.t0 + timedelta(minutes=5*i),
+                               value=100 + i) for i in range(50)])
+        InsulinDelivery.objects.create(when=cls.t0, amount=Decimal("3.25"))
+        InsulinDelivery.objects.create(when=cls.t0 + timedelta(hours=1),
+                                       amount=Decimal("1.50"),
+                                       duration=timedelta(minutes=90))
+        Meal.objects.create(dish=Dish.objects.create(desc="curry"),
+                            when=cls.t0, appx=True)
+
+    def snapshot(self):
+        return (
+            list(GlucoseMeasurement.objects.values_list("when", "value")),
+            list(InsulinDelivery.objects.values_list("when", "amount",
+                                                     "duration")),
+            list(Meal.objects.values_list("when", "dish__desc", "appx")),
+        )
+
+    def roundtrip(self, fmt, compress):
+        data = b"".join(export.stream(export.KINDS, fmt=fmt,
+                                      compress=compress, block=100))
+        before = self.snapshot()
+        Meal.objects.all().delete()
+        Dish.objects.all().delete()
+        GlucoseMeasurement.objects.all().delete()
+        InsulinDelivery.objects.all().delete()
+        export.load(io.BufferedReader(io.BytesIO(data)), fmt)
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(list(CoverageInterval.objects.values_list(
+            "start", "end", "readings")),
+            [(self.t0, self.t0 + timedelta(minutes=5*49), 50)])
+
+    def test_roundtrip_ndjson(self):
+        self.roundtrip("ndjson", False)
+
+    def test_roundtrip_csv_gzip(self):
+        self.roundtrip("csv", True)
+
+    def test_range(self):
+        text = "".join(export.lines(["cgm"], self.t0 + timedelta(minutes=10),
+                                    self.t0 + timedelta(minutes=30)))
+        self.assertEqual(len(text.splitlines()), 4)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "out.csv.gz")
+            call_command("export_data", "--format", "csv", "--gzip",
+                         "--kinds", "bolus", "--out", path)
+            with gzip.open(path, "rt") as fp:
+                self.assertEqual(len(fp.read().splitlines()), 3)
+
+    def test_view(self):
+        response = self.client.get("/meals/export/", {"kinds": "meals"})
+        body = b"".join(response.streaming_content)
+        self.assertIn(b'"dish": "curry"', body)
@@ -0,0 +1,93 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from meals import iob
+from meals.models import Dish, Meal, GlucoseMeasurement, InsulinDelivery
+
+LINEAR = {"model": "linear", "dia_minutes": 240}
+
+
+class IOBTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    @classmethod
+    def setUpTestData(cls):
+        InsulinDelivery(when=cls.t0, amount=Decimal("4.00")).save()
+        InsulinDelivery(when=cls.t0 + timedelta(hours=2),
+                        amount=Decimal("2.00"),
+                        duration=timedelta(minutes=60)).save()
+
+    def test_exponential_curve_shape(self):
+        curve = iob.exponential_curve(300, 75)
+        self.assertAlmostEqual(curve[0], 1.0)
+        self.assertTrue(np.all(np.diff(curve) <= 1e-12))
+        self.assertLess(curve[-1], 0.01)
+
+    def test_single_bolus_decay(self):
+        times, units = iob.insulin_on_board(
+            self.t0, self.t0 + timedelta(minutes=115),
+            step=timedelta(minutes=60), curve=LINEAR)
+        self.assertEqual(times[0], self.t0)
+        np.testing.assert_allclose(units, [4.0, 3.0])
+
+    def test_extended_bolus_spread(self):
+        t = self.t0 + timedelta(hours=2)
+        times, units = iob.insulin_on_board(
+            t, t + timedelta(minutes=60),
+            step=timedelta(minutes=30), curve=LINEAR)
+        # First minute of the extension is delivered at its start
+        self.assertAlmostEqual(units[0], 2.0 + 2/60)
+        # Half of the extended bolus has been delivered after 30 minutes
+        naive = 4*(1 - 150/240) + sum(2/60*(1 - (30 - k)/240)
+                                      for k in range(31))
+        self.assertAlmostEqual(units[1], naive)
+
+    def test_extended_bolus_started_before_lookback(self):
+        # Started 6 hours before the window, still running for its first hour
+        t = datetime(2000, 1, 5, 12)
+        InsulinDelivery(when=t - timedelta(hours=6), amount=Decimal("7.00"),
+                        duration=timedelta(hours=7)).save()
+        times, units = iob.insulin_on_board(t, t, curve=LINEAR)
+        self.assertGreater(units[0], 0.9)
+
+    def test_cache_invalidated_by_new_delivery(self):
+        end = self.t0 + timedelta(hours=1)
+        before = iob.insulin_on_board(self.t0, end, curve=LINEAR)[1]
+        again = iob.insulin_on_board(self.t0, end, curve=LINEAR)[1]
+        self.assertIs(before, again)
+        InsulinDelivery(when=self.t0 + timedelta(minutes=10),
+                        amount=Decimal("1.00")).save()
+        after = iob.insulin_on_board(self.t0, end, curve=LINEAR)[1]
+        self.assertAlmostEqual(after[-1] - before[-1], 1*(1 - 50/240))
+
+    def test_cache_invalidated_by_new_duration(self):
+        end = self.t0 + timedelta(hours=1)
+        before = iob.insulin_on_board(self.t0, end, curve=LINEAR)[1]
+        # Same count and total; only the spread changes
+        InsulinDelivery.objects.filter(when=self.t0).update(
+            duration=timedelta(minutes=30))
+        after = iob.insulin_on_board(self.t0, end, curve=LINEAR)[1]
+        self.assertLess(after[0], before[0])
+
+    def test_plot_includes_iob(self):
+        for i in range(24):
+            GlucoseMeasurement(when=self.t0 + timedelta(minutes=5*i),
+                               value=100 + i).save()
+        meal = Meal(dish=Dish.objects.create(desc="toast"), when=self.t0)
+        self.assertIn('"name":"IOB"', meal.plot_as_div())
+
+    def test_view(self):
+        response = self.client.get("/meals/iob/", {
+            "start": self.t0.isoformat(), "step": 60})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["iob"]), 25)
+
+    def test_view_span_limited(self):
+        response = self.client.get("/meals/iob/", {
+            "start": self.t0.isoformat(),
+            "end": (self.t0 + iob.MAX_SPAN + timedelta(days=1)).isoformat()})
+        self.assertEqual(response.status_code, 400)
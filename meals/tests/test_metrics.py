@@ -0,0 +1,76 @@
+from django.test import TestCase
+from django.urls import reverse
+
+import json
+import os
+import tempfile
+
+from meals import metrics
+
+
+class MetricsTestClass(TestCase):
+    def test_counter_exposition(self):
+        registry = metrics.Registry(directory="")
+        c = registry.counter("test_events", "Test events")
+        c.inc(type="CGM")
+        c.inc(3, type="CGM")
+        c.inc(type="Bolus")
+        text = registry.exposition()
+        self.assertIn("# TYPE test_events counter", text)
+        self.assertIn('test_events_total{type="CGM"} 4', text)
+        self.assertIn('test_events_total{type="Bolus"} 1', text)
+
+    def test_histogram_buckets(self):
+        registry = metrics.Registry(directory="")
+        h = registry.histogram("test_seconds", "Test latency",
+                               buckets=(0.1, 1.0))
+        for v in (0.05, 0.1, 0.5, 2.0):
+            h.observe(v)
+        text = registry.exposition()
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("test_seconds_count 4", text)
+        self.assertIn("test_seconds_sum 2.65", text)
+
+    def test_merges_other_processes(self):
+        with tempfile.TemporaryDirectory() as d:
+            registry = metrics.Registry(directory=d)
+            registry.counter("test_events", "Test events").inc(2)
+            # Snapshot as written by another worker process
+            other = {"test_events": {"kind": "counter", "doc": "Test events",
+                                     "buckets": [], "values": [[[], 5]]}}
+            with open(os.path.join(d, "%d.json" % os.getppid()), "w") as fp:
+                json.dump(other, fp)
+            self.assertIn("test_events_total 7", registry.exposition())
+
+    def test_folds_exited_processes(self):
+        with tempfile.TemporaryDirectory() as d:
+            registry = metrics.Registry(directory=d)
+            registry.counter("test_events", "Test events").inc(2)
+            # Pids beyond pid_max can't belong to a live process
+            for (pid, count, total) in ((2**22 + 1, 5, 7), (2**22 + 2, 3, 10)):
+                other = {"test_events": {"kind": "counter",
+                                         "doc": "Test events", "buckets": [],
+                                         "values": [[[], count]]}}
+                path = os.path.join(d, "%d.json" % pid)
+                with open(path, "w") as fp:
+                    json.dump(other, fp)
+                self.assertIn("test_events_total %d" % total,
+                              registry.exposition())
+                self.assertFalse(os.path.exists(path))
+            # The exited processes' counts stay in the total
+            self.assertIn("test_events_total 10", registry.exposition())
+
+    def test_label_escaping(self):
+        registry = metrics.Registry(directory="")
+        registry.counter("test_events", "Test events").inc(
+            path='C:\\dir\n"x"')
+        self.assertIn('test_events_total{path="C:\\\\dir\\n\\"x\\""} 1',
+                      registry.exposition())
+
+    def test_endpoint(self):
+        metrics.ingest_records.inc(type="CGM", outcome="accepted")
+        response = self.client.get(reverse("meals:metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"bolushistory_ingest_records_total", response.content)
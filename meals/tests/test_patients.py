@@ -0,0 +1,167 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import io
+import tempfile
+
+from meals import archive, coverage, iob, patients, similarity, summary
+from meals.admin import DishAdmin
+from meals.forms import DishForm
+from meals.models import CoverageInterval, Dish, DishSummary, \
+    GlucoseMeasurement, InsulinDelivery, Meal, Patient
+
+
+class PatientsTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 8)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first = Patient.objects.get(pk=patients.default_id())
+        cls.second = Patient.objects.create(name="second")
+        cls.user = User.objects.create_user("carer")
+        cls.second.users.add(cls.user)
+        # Both patients have readings at the same times
+        for (patient, value) in ((cls.first, 100), (cls.second, 200)):
+            with patients.using(patient):
+                GlucoseMeasurement.objects.bulk_create([
+                    GlucoseMeasurement(when=cls.t0 + timedelta(minutes=5*i),
+                                       value=value) for i in range(96)])
+                coverage.rebuild()
+        with patients.using(cls.second):
+            InsulinDelivery.objects.create(when=cls.t0, amount=Decimal("3"))
+            cls.dish = Dish.objects.create(desc="toast")
+            cls.meal = Meal.objects.create(dish=cls.dish, when=cls.t0)
+
+    def test_window_queries_scoped(self):
+        window = GlucoseMeasurement.getEventsInWindow(self.t0)
+        self.assertEqual({e.value for e in window}, {100})
+        with patients.using(self.second):
+            window = GlucoseMeasurement.getEventsInWindow(self.t0)
+            self.assertEqual({e.value for e in window}, {200})
+            self.assertTrue(self.meal.has_egv_data())
+        self.assertEqual(GlucoseMeasurement.all_objects.count(), 2*96)
+
+    def test_window_query_uses_patient_index(self):
+        qs = GlucoseMeasurement.objects.filter(
+            when__gte=self.t0, when__lte=self.t0 + timedelta(hours=1))
+        with connection.cursor() as cursor:
+            (sql, params) = qs.query.sql_with_params()
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("patient_id=? AND when>? AND when<?", plan)
+
+    def test_uniqueness_per_patient(self):
+        Dish.objects.create(desc="toast")
+        with patients.using(self.second), self.assertRaises(IntegrityError), \
+                transaction.atomic():
+            Dish.objects.create(desc="toast")
+
+    def test_dish_form_unique_per_patient(self):
+        self.assertTrue(DishForm({"desc": "toast"}).is_valid())
+        with patients.using(self.second):
+            form = DishForm({"desc": "toast"})
+            self.assertFalse(form.is_valid())
+            self.assertIn("desc", form.errors)
+            # Saving a dish unchanged is not a duplicate of itself
+            self.assertTrue(DishForm({"desc": "toast"},
+                                     instance=self.dish).is_valid())
+
+    def test_iob_cache_per_patient(self):
+        end = self.t0 + timedelta(hours=1)
+        (_, units) = iob.insulin_on_board(self.t0, end)
+        self.assertEqual(float(units.max()), 0)
+        with patients.using(self.second):
+            (_, units) = iob.insulin_on_board(self.t0, end)
+            self.assertGreater(float(units.max()), 2)
+
+    def test_similarity_index_per_patient(self):
+        first = similarity.index()
+        self.assertIs(similarity.index(), first)
+        with patients.using(self.second):
+            self.assertIsNot(similarity.index(), first)
+            self.assertEqual(similarity.index().patient, self.second.pk)
+
+    def test_archive_per_patient(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(EVENT_ARCHIVE={"directory": directory}):
+            archive._boundary.clear()
+            with patients.using(self.second):
+                archive.move_out(datetime(2000, 2, 1))
+                self.assertFalse(GlucoseMeasurement.objects.exists())
+                self.assertEqual(len(archive.events(
+                    GlucoseMeasurement, self.t0, self.t0 + timedelta(days=1))),
+                    96)
+            # The first patient's rows stay hot and its reads see no archive
+            self.assertEqual(GlucoseMeasurement.objects.count(), 96)
+            self.assertFalse(archive.is_archived(
+                GlucoseMeasurement, self.t0, self.t0 + timedelta(days=1)))
+            with patients.using(self.second):
+                archive.restore()
+            archive._boundary.clear()
+
+    def test_session_selects_patient(self):
+        url = reverse("meals:history", args=(self.dish.pk,))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse("meals:patients"),
+                                    {"patient": self.second.pk})
+        self.assertRedirects(response, reverse("meals:search"))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["meal_set"]), [self.meal])
+        response = self.client.get(reverse("meals:patients"))
+        self.assertContains(response, "second (viewing)")
+
+    def test_select_requires_access(self):
+        response = self.client.post(reverse("meals:patients"),
+                                    {"patient": self.second.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(reverse("admin:login"), response["Location"])
+        self.client.force_login(self.user)
+        # The user may not view the first patient
+        response = self.client.post(reverse("meals:patients"),
+                                    {"patient": self.first.pk})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse("meals:patients"))
+        self.assertEqual(list(response.context["patients"]), [self.second])
+        # Selecting by GET is gone
+        self.client.get(reverse("meals:patients"), {"select": self.second.pk})
+        self.assertNotIn(patients.SESSION_KEY, self.client.session)
+
+    def test_streamed_export_scoped(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse("meals:patients"), {"patient": self.second.pk})
+        response = self.client.get(reverse("meals:export"),
+                                   {"kinds": "cgm", "format": "csv"})
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn(",200", body)
+        self.assertNotIn(",100", body)
+
+    def test_summary_rebuild_scoped(self):
+        Dish.objects.create(desc="porridge")
+        self.assertEqual(summary.rebuild(), 1)
+        self.assertEqual(DishSummary.objects.count(), 2)
+        with patients.using(self.second):
+            self.assertEqual(summary.rebuild(), 1)
+        self.assertEqual(DishSummary.objects.count(), 2)
+
+    def test_command_patient_option(self):
+        with patients.using(self.second):
+            CoverageInterval.objects.all().delete()
+        out = io.StringIO()
+        call_command("rebuild_coverage", patient="second", stdout=out)
+        self.assertIn("Stored 1 coverage", out.getvalue())
+        with patients.using(self.second):
+            self.assertEqual(CoverageInterval.objects.count(), 1)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_coverage", patient="nobody", stdout=out)
+
+    def test_admin_hides_patient(self):
+        form = DishAdmin(Dish, None).get_form(None)
+        self.assertNotIn("patient", form.base_fields)
@@ -0,0 +1,82 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+from meals import prerender
+from meals.models import Dish, GlucoseMeasurement, Meal, MealPlot
+
+
+class PrerenderTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    def setUp(self):
+        self.meal = Meal.objects.create(
+            dish=Dish.objects.create(desc="rice"), when=self.t0)
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=self.t0 + timedelta(minutes=m), value=100)
+            for m in range(-60, 360, 5)])
+
+    def test_saving_meal_queues_plot(self):
+        plot = MealPlot.objects.get(meal=self.meal)
+        self.assertFalse(plot.is_current())
+
+    def test_repeat_requests_collapse(self):
+        prerender.enqueue([self.meal.pk])
+        prerender.enqueue([self.meal.pk])
+        self.assertEqual(MealPlot.objects.count(), 1)
+        self.assertEqual(prerender.process(workers=0), 1)
+        self.assertEqual(prerender.process(workers=0), 0)
+
+    def test_process_stores_html(self):
+        prerender.process(workers=0)
+        plot = MealPlot.objects.get(meal=self.meal)
+        self.assertTrue(plot.is_current())
+        self.assertIn("plotly", plot.html)
+
+    def test_stale_result_discarded(self):
+        version = MealPlot.objects.get(meal=self.meal).version
+        prerender.enqueue([self.meal.pk])
+        self.assertFalse(prerender.store(self.meal.pk, version, "old"))
+        plot = MealPlot.objects.get(meal=self.meal)
+        self.assertFalse(plot.is_current())
+        self.assertEqual(plot.html, "")
+
+    def test_failed_render_skipped(self):
+        other = Meal.objects.create(dish=self.meal.dish,
+                                    when=self.t0 + timedelta(hours=1))
+        real = prerender.render
+
+        def render(pk):
+            if pk == self.meal.pk:
+                raise ValueError("bad data")
+            return real(pk)
+
+        with mock.patch.object(prerender, "render", render), \
+                self.assertLogs("meals.prerender", "ERROR"):
+            self.assertEqual(prerender.process(workers=0), 1)
+        self.assertTrue(MealPlot.objects.get(meal=other).is_current())
+        # The failed plot stays queued for the next pass
+        self.assertFalse(MealPlot.objects.get(meal=self.meal).is_current())
+        self.assertEqual(prerender.process(workers=0), 1)
+
+    def test_window_requests(self):
+        prerender.process(workers=0)
+        prerender.enqueue_window(self.t0 + timedelta(hours=5),
+                                 self.t0 + timedelta(hours=5))
+        self.assertFalse(MealPlot.objects.get(meal=self.meal).is_current())
+        prerender.process(workers=0)
+        prerender.enqueue_window(self.t0 + timedelta(hours=7),
+                                 self.t0 + timedelta(hours=8))
+        self.assertTrue(MealPlot.objects.get(meal=self.meal).is_current())
+
+    def test_get_falls_back_to_inline(self):
+        meal = Meal.objects.select_related("plot").get(pk=self.meal.pk)
+        html = prerender.get(meal)
+        self.assertIn("plotly", html)
+        self.assertTrue(MealPlot.objects.get(meal=self.meal).is_current())
+        # A current plot is served without rendering
+        meal = Meal.objects.select_related("plot").get(pk=self.meal.pk)
+        with mock.patch.object(Meal, "plot_as_div") as render:
+            self.assertEqual(prerender.get(meal), html)
+        render.assert_not_called()
@@ -0,0 +1,90 @@
+from django.test import TestCase
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from meals import similarity
+from meals.models import Dish, GlucoseMeasurement, Meal, MealResponse
+
+
+class SimilarityTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 8, 0)
+
+    @classmethod
+    def setUpTestData(cls):
+        # One meal per day; peak height depends on the dish
+        peaks = {"oatmeal": [40, 45], "pancakes": [110, 100],
+                 "eggs": [5, 10]}
+        records = []
+        cls.meals = {}
+        day = 0
+        for (desc, heights) in peaks.items():
+            dish = Dish.objects.create(desc=desc)
+            for h in heights:
+                start = cls.t0 + timedelta(days=day)
+                for i in range(-12, 7*12):
+                    bump = h*np.sin(np.pi*i/36) if 0 <= i < 36 else 0
+                    records.append(GlucoseMeasurement(
+                        when=start + timedelta(minutes=5*i),
+                        value=int(100 + bump)))
+                cls.meals.setdefault(desc, []).append((dish, start))
+                day += 1
+        GlucoseMeasurement.objects.bulk_create(records)
+        for (desc, meals) in cls.meals.items():
+            for (dish, when) in meals:
+                Meal.objects.create(dish=dish, when=when)
+
+    def setUp(self):
+        similarity.index().reset()
+
+    def test_vectors_stored_on_save(self):
+        self.assertEqual(MealResponse.objects.count(), 6)
+        v = np.frombuffer(MealResponse.objects.first().vector,
+                          dtype=similarity.DTYPE)
+        self.assertEqual(len(v), len(similarity.GRID))
+        self.assertEqual(v[0], 0)
+
+    def test_insufficient_coverage(self):
+        when = np.array([self.t0], dtype="datetime64[s]")
+        self.assertIsNone(similarity.response_vector(when, np.array([100.]),
+                                                     self.t0))
+
+    def test_nearest_dishes(self):
+        oatmeal = Dish.objects.get(desc="oatmeal")
+        result = similarity.index().nearest_dishes(oatmeal.pk, k=2)
+        self.assertEqual([Dish.objects.get(pk=pk).desc for (pk, _) in result],
+                         ["eggs", "pancakes"])
+
+    def test_incremental_update(self):
+        eggs = Dish.objects.get(desc="eggs")
+        pancakes = Dish.objects.get(desc="pancakes")
+        before = similarity.index().nearest_dishes(eggs.pk, k=1)
+        # Reassigning a pancake meal to eggs replaces its vector
+        meal = Meal.objects.filter(dish=pancakes).first()
+        meal.dish = eggs
+        meal.save()
+        after = similarity.index().nearest_dishes(eggs.pk, k=1)
+        self.assertNotEqual(before[0][1], after[0][1])
+        self.assertEqual(int(similarity.index().alive.sum()), 6)
+
+    def test_view(self):
+        meal = Meal.objects.filter(dish__desc="pancakes").first()
+        response = self.client.get("/meals/similar/meal/%d/" % meal.pk,
+                                   {"k": 1})
+        self.assertEqual(response.json()["similar"][0]["dish"], "pancakes")
+        for k in ("x", 0, 10**6):
+            response = self.client.get(
+                "/meals/similar/dish/%d/" % meal.dish.pk, {"k": k})
+            self.assertEqual(response.status_code, 400)
+
+    def test_lost_coverage_drops_vector(self):
+        meal = Meal.objects.filter(dish__desc="eggs").first()
+        self.assertTrue(MealResponse.objects.filter(meal=meal).exists())
+        GlucoseMeasurement.objects.filter(
+            when__gt=meal.when, when__lt=meal.when + timedelta(hours=3)
+        ).delete()
+        similarity.refresh(meal.when, meal.when)
+        self.assertFalse(MealResponse.objects.filter(meal=meal).exists())
+        similarity.index().sync()
+        self.assertEqual(int(similarity.index().alive.sum()), 5)
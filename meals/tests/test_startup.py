@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+
+import os
+import subprocess
+import sys
+
+# Total import time allowed for `manage.py check` (milliseconds);
+# override for slow CI machines
+BUDGET_MS = float(os.environ.get("BOLUSHISTORY_STARTUP_BUDGET_MS", 1000))
+
+# Dependencies that must only load when plotting, analytics or the
+# Tandem API client are used
+HEAVY_MODULES = ("numpy", "plotly", "tconnectsync")
+
+
+def importtime(*args):
+    """Run python -X importtime and return {module: self time in us}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(args),
+        cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        (self_us, _, name) = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us)
+    return modules
+
+
+class StartupTestClass(SimpleTestCase):
+    def test_check_startup(self):
+        modules = importtime("manage.py", "check")
+        heavy = sorted(m for m in modules
+                       if m.split(".")[0] in HEAVY_MODULES)
+        self.assertEqual(heavy, [])
+        total_ms = sum(modules.values())/1000
+        self.assertLess(total_ms, BUDGET_MS,
+                        "manage.py check spent %.0f ms importing modules"
+                        % total_ms)
+
+    def test_replay_without_api_client(self):
+        modules = importtime("-c", "import meals.tconnectdata")
+        self.assertFalse(any(m.startswith("tconnectsync") for m in modules))
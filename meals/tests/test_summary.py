@@ -0,0 +1,103 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from datetime import datetime, timedelta
+import json
+import os
+
+from meals import summary, tconnectdata
+from meals.models import Dish, DishSummary, GlucoseMeasurement, Meal
+
+
+class SummaryTestClass(TestCase):
+    t0 = datetime(2000, 1, 1, 12, 0)
+
+    def setUp(self):
+        # A rise to 100 + hours*10 peaking two hours after each full hour
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=self.t0 + timedelta(minutes=5*i),
+                               value=100 + i//12*10 + (i % 12 == 0)*5)
+            for i in range(12*48)])
+        self.rice = Dish.objects.create(desc="rice")
+        self.soup = Dish.objects.create(desc="soup")
+
+    def at(self, hours):
+        return self.t0 + timedelta(hours=hours)
+
+    def counters(self, dish):
+        s = DishSummary.objects.get(dish=dish)
+        return (s.meals, s.last_eaten, s.peak_meals, s.mean_peak)
+
+    def assertMatchesRebuild(self):
+        current = {s.pk: self.counters(s.dish)
+                   for s in DishSummary.objects.all()}
+        summary.rebuild()
+        rebuilt = {s.pk: self.counters(s.dish)
+                   for s in DishSummary.objects.all()}
+        self.assertEqual(current.keys(), rebuilt.keys())
+        for pk in current:
+            self.assertEqual(current[pk][:3], rebuilt[pk][:3])
+            if rebuilt[pk][3] is None:
+                self.assertIsNone(current[pk][3])
+            else:
+                self.assertAlmostEqual(current[pk][3], rebuilt[pk][3])
+
+    def test_new_dish_has_summary(self):
+        self.assertEqual(self.counters(self.soup), (0, None, 0, None))
+
+    def test_meals_added_and_removed(self):
+        first = Meal.objects.create(dish=self.rice, when=self.at(0))
+        second = Meal.objects.create(dish=self.rice, when=self.at(10))
+        self.assertEqual(Meal.objects.get(pk=first.pk).peak,
+                         summary.peak(self.at(0)))
+        self.assertEqual(self.counters(self.rice)[:3], (2, self.at(10), 2))
+        self.assertAlmostEqual(self.counters(self.rice)[3],
+                               (first.peak + second.peak)/2)
+        self.assertMatchesRebuild()
+
+        # Removing the latest meal moves last_eaten back
+        Meal.objects.get(pk=second.pk).delete()
+        self.assertEqual(self.counters(self.rice)[:3], (1, self.at(0), 1))
+        Meal.objects.get(pk=first.pk).delete()
+        self.assertEqual(self.counters(self.rice), (0, None, 0, None))
+
+    def test_meal_edited(self):
+        meal = Meal.objects.create(dish=self.rice, when=self.at(5))
+        Meal.objects.create(dish=self.rice, when=self.at(1))
+        meal = Meal.objects.get(pk=meal.pk)
+        meal.dish = self.soup
+        meal.when = self.at(100)
+        meal.save()
+        self.assertEqual(self.counters(self.rice)[:3], (1, self.at(1), 1))
+        # No readings after the new time
+        self.assertEqual(self.counters(self.soup), (1, self.at(100), 0, None))
+        self.assertMatchesRebuild()
+
+    def test_ingest_updates_peaks(self):
+        meal = Meal.objects.create(dish=self.soup,
+                                   when=datetime(2024, 1, 9, 12))
+        self.assertIsNone(Meal.objects.get(pk=meal.pk).peak)
+        with open(os.path.join(os.path.dirname(__file__),
+                  "tandem_20240108_20240114_sanitized.json")) as fp:
+            tconnectdata.commit(json.load(fp))
+        meal = Meal.objects.get(pk=meal.pk)
+        self.assertEqual(meal.peak, summary.peak(meal.when))
+        self.assertIsNotNone(meal.peak)
+        self.assertEqual(self.counters(self.soup)[2:], (1, meal.peak))
+        self.assertMatchesRebuild()
+
+    def test_search_page_sorting(self):
+        Meal.objects.create(dish=self.rice, when=self.at(0))
+        Meal.objects.create(dish=self.rice, when=self.at(20))
+        Meal.objects.create(dish=self.soup, when=self.at(30))
+        Dish.objects.create(desc="bread")
+        url = reverse("meals:search")
+        order = lambda sort: [d.desc for d in self.client.get(
+            url, {"sort": sort}).context["object_list"]]
+        self.assertEqual(order("meals"), ["rice", "soup", "bread"])
+        self.assertEqual(order("last"), ["soup", "rice", "bread"])
+        self.assertEqual(order("name"), ["bread", "rice", "soup"])
+        self.assertEqual(order("peak")[-1], "bread")
+        # Dishes and their summaries come from one query
+        with self.assertNumQueries(1):
+            self.client.get(url, {"sort": "peak"})
@@ -0,0 +1,190 @@
+from django.test import TransactionTestCase
+
+import asyncio
+from datetime import datetime, timedelta
+import json
+import os
+import threading
+import time
+
+from meals import patients, sync, tconnectdata
+from meals.models import BasalSegment, GlucoseMeasurement, Patient, \
+    ScanCheckpoint
+
+with open(os.path.join(os.path.dirname(__file__),
+          "tandem_20240108_20240114_sanitized.json")) as fp:
+    DATA = json.load(fp)
+
+
+def in_days(when, start, end):
+    # Tandem's endpoints take whole days, both ends inclusive
+    return start.date().isoformat() <= when[:10] <= end.date().isoformat()
+
+
+class FakeApi:
+    """Stand-in for TConnectApi serving the sample download"""
+
+    def __init__(self, fail=0):
+        self.logins = 0
+        self.calls = []
+        self.fail = fail
+        self.session = None
+        self.active = 0
+        self.overlapped = False
+        self.lock = threading.Lock()
+
+    def login(self):
+        if self.session is None:
+            self.logins += 1
+            self.session = self
+
+    @property
+    def controliq(self):
+        self.login()
+        return self
+
+    @property
+    def ws2(self):
+        self.login()
+        return self
+
+    def busy(self):
+        # Note requests running at once on this session
+        with self.lock:
+            self.active += 1
+            self.overlapped = self.overlapped or self.active > 1
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+
+    def therapy_events(self, start, end):
+        self.calls.append(("ciqEvents", start, end))
+        self.busy()
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("Tandem is down")
+        return {"event": [e for e in DATA["ciqEvents"]["event"]
+                          if in_days(e["eventDateTime"], start, end)]}
+
+    def therapy_timeline_csv(self, start, end):
+        self.calls.append(("csvTimeline", start, end))
+        self.busy()
+        return dict(DATA["csvTimeline"], basalData=[
+            r for r in DATA["csvTimeline"]["basalData"]
+            if in_days(r["EventDateTime"], start, end)])
+
+
+class SyncTestClass(TransactionTestCase):
+    schedule = {"interval_seconds": 0.05, "jitter": 0.2, "initial_days": 2,
+                "overlap_seconds": 3600, "chunk_days": 2,
+                "retry_seconds": 0.01}
+
+    def setUp(self):
+        # Flushing between tests also removes the default patient
+        Patient.objects.get_or_create(pk=patients.default_id(),
+                                      defaults={"name": "default"})
+
+    def service(self, api, now, **kwargs):
+        return sync.SyncService(api, schedule=self.schedule,
+                                clock=lambda: now, **kwargs)
+
+    def test_windows(self):
+        t0 = datetime(2024, 1, 1)
+        self.assertEqual(sync.windows(t0, t0 + timedelta(days=5),
+                                      timedelta(days=2)),
+                         [(t0, t0 + timedelta(days=2)),
+                          (t0 + timedelta(days=2), t0 + timedelta(days=4)),
+                          (t0 + timedelta(days=4), t0 + timedelta(days=5))])
+
+    def test_backfill_after_downtime(self):
+        api = FakeApi()
+        asyncio.run(self.service(api, datetime(2024, 1, 10)).run_once())
+        self.assertEqual(ScanCheckpoint.objects.get(
+            name="sync:ciqEvents").position, datetime(2024, 1, 10))
+        self.assertFalse(GlucoseMeasurement.objects.filter(
+            when__gte=datetime(2024, 1, 11)).exists())
+
+        # Down for five days: the next pull fills the gap, oldest first
+        api.calls.clear()
+        asyncio.run(self.service(api, datetime(2024, 1, 15)).run_once())
+        starts = [start for (key, start, _) in api.calls
+                  if key == "ciqEvents"]
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual(len(starts), 3)
+        self.assertEqual(starts[0], datetime(2024, 1, 9, 23))
+        self.assertEqual(GlucoseMeasurement.objects.count(),
+                         sum(e["type"] == "CGM"
+                             for e in DATA["ciqEvents"]["event"]))
+        self.assertTrue(BasalSegment.objects.exists())
+        # Both sources shared one login, one request at a time
+        self.assertEqual(api.logins, 1)
+        self.assertFalse(api.overlapped)
+
+    def test_failed_pull_is_retried(self):
+        api = FakeApi(fail=2)
+        service = self.service(api, datetime(2024, 1, 15),
+                               sources=["ciqEvents"])
+
+        async def run():
+            stop = asyncio.Event()
+            task = asyncio.create_task(service.run(stop))
+            while await service._db(sync._position, "ciqEvents") is None:
+                await asyncio.sleep(0.01)
+            stop.set()
+            await task
+
+        asyncio.run(asyncio.wait_for(run(), 60))
+        # Two failures, then a pull of one chunk per two days
+        self.assertGreaterEqual(len(api.calls), 3)
+        self.assertEqual(api.fail, 0)
+        self.assertTrue(GlucoseMeasurement.objects.exists())
+
+    def test_patients_in_parallel(self):
+        other = Patient.objects.create(name="other")
+        apis = (FakeApi(), FakeApi())
+        services = [self.service(apis[0], datetime(2024, 1, 15)),
+                    self.service(apis[1], datetime(2024, 1, 15),
+                                 patient=other.pk)]
+        asyncio.run(sync.run_all_once(services))
+        cgm = GlucoseMeasurement.objects.count()
+        self.assertGreater(cgm, 0)
+        for patient in (patients.default_id(), other.pk):
+            with patients.using(patient):
+                self.assertEqual(GlucoseMeasurement.objects.count(), cgm)
+                # The checkpoint is the newest event, not the clock
+                self.assertEqual(ScanCheckpoint.objects.get(
+                    name="sync:ciqEvents").position,
+                    tconnectdata.latestTime({"ciqEvents": DATA["ciqEvents"]}))
+        self.assertEqual(GlucoseMeasurement.all_objects.count(), 2*cgm)
+        self.assertEqual([api.logins for api in apis], [1, 1])
+
+    def test_closing_row_not_a_checkpoint(self):
+        # Pump data uploaded up to 10:00, but the timeline closes the day
+        cutoff = "2024-01-12T10:00:00"
+
+        class LateApi(FakeApi):
+            def therapy_timeline_csv(self, start, end):
+                data = super().therapy_timeline_csv(start, end)
+                rows = [r for r in data["basalData"]
+                        if r["EventDateTime"] <= cutoff]
+                return dict(data, basalData=rows + [dict(
+                    rows[-1], EventDateTime="2024-01-12T23:59:59.993")])
+
+        data = LateApi().therapy_timeline_csv(datetime(2024, 1, 12),
+                                              datetime(2024, 1, 12))
+        newest = max(r["EventDateTime"] for r in data["basalData"][:-1])
+        asyncio.run(self.service(LateApi(), datetime(2024, 1, 12, 12),
+                                 sources=["csvTimeline"]).run_once())
+        self.assertEqual(ScanCheckpoint.objects.get(
+            name="sync:csvTimeline").position,
+            datetime.fromisoformat(newest))
+
+    def test_delay_jitter(self):
+        service = sync.SyncService(FakeApi(), schedule={
+            "interval_seconds": 100, "jitter": 0.2, "retry_seconds": 10})
+        delays = [service.delay() for _ in range(50)]
+        self.assertTrue(all(80 <= d <= 120 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertLessEqual(service.delay(failures=1), 12)
+        self.assertLessEqual(service.delay(failures=10), 120)
+        service.close()
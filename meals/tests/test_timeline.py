@@ -0,0 +1,101 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from meals import timeline
+from meals.models import GlucoseMeasurement, InsulinDelivery
+
+
+class TimelineTestClass(TestCase):
+    start = datetime(2000, 1, 1)
+
+    @classmethod
+    def setUpTestData(cls):
+        # 30 days of readings every 5 minutes, with a gap on day 10
+        rng = np.random.default_rng(0)
+        values = rng.integers(60, 300, 30*288)
+        GlucoseMeasurement.objects.bulk_create([
+            GlucoseMeasurement(when=cls.start + timedelta(minutes=5*i),
+                               value=int(values[i]))
+            for i in range(30*288) if not 10*288 + 120 <= i < 10*288 + 156])
+        InsulinDelivery.objects.bulk_create([
+            InsulinDelivery(when=cls.start + timedelta(hours=4*i), amount=1)
+            for i in range(30*6)])
+
+    def test_minmax(self):
+        rng = np.random.default_rng(1)
+        t = np.arange(10000)
+        y = rng.normal(120, 30, 10000)
+        keep = timeline.minmax(t, y, 0, 10000, 100)
+        self.assertLessEqual(len(keep), 200)
+        self.assertTrue(np.all(np.diff(keep) > 0))
+        for b in range(100):
+            bucket = y[100*b:100*(b + 1)]
+            kept = y[keep[(keep >= 100*b) & (keep < 100*(b + 1))]]
+            self.assertEqual(kept.min(), bucket.min())
+            self.assertEqual(kept.max(), bucket.max())
+
+    def test_minmax_small(self):
+        t = np.arange(50)
+        np.testing.assert_array_equal(
+            timeline.minmax(t, t*2.0, 0, 50, 100), t)
+
+    def test_bucket_sums(self):
+        t = np.arange(0, 100, 10)
+        (bt, bv) = timeline.bucket_sums(t, np.ones(10), 0, 100, 5)
+        np.testing.assert_array_equal(bt, [0, 20, 40, 60, 80])
+        np.testing.assert_array_equal(bv, [2, 2, 2, 2, 2])
+
+    def test_series_bounded(self):
+        for days in (1, 7, 30):
+            data = timeline.series(self.start,
+                                   self.start + timedelta(days=days), 200)
+            points = [y for y in data["cgm"]["y"] if y is not None]
+            self.assertLessEqual(len(points), 400)
+            self.assertLessEqual(len(data["bolus"]["y"]), 200)
+            self.assertAlmostEqual(sum(data["bolus"]["y"]),
+                                   min(6*days + 1, 180))
+
+    def test_series_gap(self):
+        # Three hours are missing: long enough to break a day's line but
+        # narrower than a month's buckets
+        day = timeline.series(self.start + timedelta(days=10),
+                              self.start + timedelta(days=11), 1000)
+        self.assertEqual(day["cgm"]["y"].count(None), 1)
+        month = timeline.series(self.start, self.start + timedelta(days=30),
+                                100)
+        self.assertEqual(month["cgm"]["y"].count(None), 0)
+
+    def test_data_view(self):
+        sizes = []
+        for days in (7, 30):
+            response = self.client.get(reverse("meals:timeline-data"), {
+                "start": self.start.isoformat(),
+                "end": (self.start + timedelta(days=days)).isoformat(),
+                "width": 500})
+            self.assertEqual(response.status_code, 200)
+            sizes.append(len(response.content))
+        # Past the pixel budget, a month costs about as much as a week
+        self.assertLess(sizes[1], 1.5*sizes[0])
+        response = self.client.get(reverse("meals:timeline-data"),
+                                   {"start": "never"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("meals:timeline-data"), {
+            "start": self.start.isoformat(),
+            "end": (self.start + timedelta(days=365)).isoformat()})
+        self.assertEqual(response.status_code, 400)
+
+    def test_page(self):
+        response = self.client.get(reverse("meals:timeline"),
+                                   {"span": "week", "end": "2000-01-14"})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "plotly_relayout")
+        self.assertEqual(response.context["data"]["start"],
+                         "2000-01-08T00:00:00")
+        self.assertEqual(response.context["previous"], "2000-01-07")
+        response = self.client.get(reverse("meals:timeline"),
+                                   {"span": "year"})
+        self.assertEqual(response.status_code, 400)
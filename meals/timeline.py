@@ -0,0 +1,179 @@
+"""Long-range glucose timeline downsampled to a pixel budget
+
+Day, week and month views would otherwise send every CGM reading (8,600
+a month).  The range is split into one bucket per horizontal pixel and
+only the lowest and highest reading of each bucket is kept, so peaks and
+lows survive and at most two points per pixel are sent whatever the
+range.  Boluses are summed per bucket once there are more than buckets.
+
+Zooming in the browser requests the visible range again at the same
+budget, so finer data appears as the range narrows.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+
+from meals.coverage import MAX_GAP
+
+# Views offered by the timeline page, in days
+SPANS = {"day": 1, "week": 7, "month": 30}
+
+# Longest range served, zoomed or not
+MAX_SPAN = timedelta(days=max(SPANS.values()))
+
+DEFAULT_WIDTH = 1000
+MAX_WIDTH = 4000
+
+
+def bucket_index(t, start, end, buckets):
+    """Pixel bucket of each time (int64 seconds) in [start, end)"""
+    span = max(end - start, 1)
+    return np.clip((t - start)*buckets//span, 0, buckets - 1)
+
+
+def minmax(t, y, start, end, buckets):
+    """Indices of the lowest and highest point in each bucket
+
+    :param t: sorted int64 times (seconds)
+    :param y: values at those times
+    :returns: sorted indices into t, at most two per bucket
+    """
+    if len(t) <= 2*buckets:
+        return np.arange(len(t))
+    b = bucket_index(t, start, end, buckets)
+    # Within each bucket, order by value: first is the min, last the max
+    order = np.lexsort((y, b))
+    edges = np.flatnonzero(np.diff(b[order])) + 1
+    firsts = order[np.concatenate(([0], edges))]
+    lasts = order[np.concatenate((edges - 1, [len(order) - 1]))]
+    return np.unique(np.concatenate((firsts, lasts)))
+
+
+def bucket_sums(t, v, start, end, buckets):
+    """Sum values per bucket, placed at the first time in each bucket"""
+    if len(t) <= buckets:
+        return (t, v)
+    b = bucket_index(t, start, end, buckets)
+    edges = np.concatenate(([0], np.flatnonzero(np.diff(b)) + 1))
+    return (t[edges], np.add.reduceat(v, edges))
+
+
+def isoformat(t):
+    return [str(s) for s in t.astype("datetime64[s]")]
+
+
+def with_gaps(t, y, max_gap):
+    """x and y lists with None breaking the line across long gaps"""
+    x = isoformat(t)
+    values = [float(v) for v in y]
+    if len(t) < 2:
+        return (x, values)
+    breaks = set(np.flatnonzero(np.diff(t) > max_gap).tolist())
+    (xs, ys) = ([], [])
+    for i in range(len(x)):
+        xs.append(x[i])
+        ys.append(values[i])
+        if i in breaks:
+            xs.append(None)
+            ys.append(None)
+    return (xs, ys)
+
+
+def _seconds(times):
+    return np.array(times, dtype="datetime64[s]").astype(np.int64)
+
+
+def series(start, end, width=DEFAULT_WIDTH):
+    """CGM and bolus data for [start, end] at `width` buckets
+
+    :returns: dict ready to serialize as JSON
+    """
+    from meals import archive
+    from meals.models import GlucoseMeasurement, InsulinDelivery
+
+    width = max(1, min(int(width), MAX_WIDTH))
+    (lo, hi) = _seconds([start, end])
+
+    if archive.is_archived(GlucoseMeasurement, start, end):
+        egvs = [(e.when, e.value) for e in
+                archive.events(GlucoseMeasurement, start, end)]
+    else:
+        egvs = list(GlucoseMeasurement.objects
+                    .filter(when__gte=start, when__lte=end)
+                    .order_by("when").values_list("when", "value"))
+    if archive.is_archived(InsulinDelivery, start, end):
+        boluses = [(e.when, e.amount) for e in
+                   archive.events(InsulinDelivery, start, end)]
+    else:
+        boluses = list(InsulinDelivery.objects
+                       .filter(when__gte=start, when__lte=end)
+                       .order_by("when").values_list("when", "amount"))
+
+    t = _seconds([r[0] for r in egvs])
+    y = np.array([r[1] for r in egvs], dtype=np.float64)
+    keep = minmax(t, y, lo, hi, width)
+    # A gap only shows once it is wider than the buckets on either side
+    max_gap = max(MAX_GAP.total_seconds(), 2*(hi - lo)/width)
+    (cgm_x, cgm_y) = with_gaps(t[keep], y[keep], max_gap)
+
+    (bt, bv) = bucket_sums(_seconds([r[0] for r in boluses]),
+                           np.array([r[1] for r in boluses],
+                                    dtype=np.float64),
+                           lo, hi, width)
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "readings": len(egvs),
+        "cgm": {"x": cgm_x, "y": cgm_y},
+        "bolus": {"x": isoformat(bt), "y": [round(float(v), 2) for v in bv]},
+    }
+
+
+# Re-requests the visible range whenever the x axis is zoomed or panned
+RELAYOUT_SCRIPT = """
+var plot = document.getElementById("{plot_id}");
+plot.on("plotly_relayout", function(ev) {
+    var start = ev["xaxis.range[0]"], end = ev["xaxis.range[1]"];
+    var url = "%s?width=%d";
+    if (start !== undefined && end !== undefined) {
+        url += "&start=" + encodeURIComponent(start.replace(" ", "T").slice(0, 19))
+             + "&end=" + encodeURIComponent(end.replace(" ", "T").slice(0, 19));
+    } else if (ev["xaxis.autorange"]) {
+        url += "&start=%s&end=%s";
+    } else {
+        return;
+    }
+    fetch(url).then(function(r) { return r.json(); }).then(function(data) {
+        Plotly.restyle(plot, {x: [data.cgm.x, data.bolus.x],
+                              y: [data.cgm.y, data.bolus.y]}, [0, 1]);
+    });
+});
+"""
+
+
+def figure(data, data_url, width=DEFAULT_WIDTH):
+    """Plotly HTML for a series() result, refetching on zoom"""
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=data["cgm"]["x"], y=data["cgm"]["y"],
+                             mode="lines", name="EGV (mg/dL)",
+                             line=dict(color="black", width=1),
+                             connectgaps=False))
+    fig.add_trace(go.Bar(x=data["bolus"]["x"], y=data["bolus"]["y"],
+                         name="Bolus (u)", yaxis="y2",
+                         marker=dict(color="red"), opacity=0.6))
+    fig.update_layout(
+        xaxis=dict(type="date", range=[data["start"], data["end"]]),
+        yaxis=dict(title="EGV (mg/dL)", range=[40, 400]),
+        yaxis2=dict(title="Bolus (u)", overlaying="y", side="right",
+                    showgrid=False, rangemode="tozero"),
+        bargap=0, showlegend=False, width=width,
+    )
+    return fig.to_html(
+        include_plotlyjs="cdn",
+        full_html=False,
+        post_script=RELAYOUT_SCRIPT % (data_url, width, data["start"],
+                                       data["end"]),
+    )
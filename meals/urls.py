@@ -3,7 +3,7 @@ from django.urls import path
 from . import views
 
 from meals.views import MealHistoryView, DishCreateView, \
-    MealCreateView
+    MealCreateView, DetectedMealListView
 
 app_name = "meals"
 urlpatterns = [
@@ -14,4 +14,14 @@ urlpatterns = [
     path("add/", views.add_dish, name="add"),
     path("add/<str:initial>", views.add_dish, name="add"),
     path("addmeal/", MealCreateView.as_view(), name="addmeal"),
+    path("unlogged/", DetectedMealListView.as_view(), name="unlogged"),
+    path("similar/dish/<int:pk>/", views.similar_dishes, name="similar-dishes"),
+    path("similar/meal/<int:pk>/", views.similar_meals, name="similar-meals"),
+    path("agp/", views.agp_report, name="agp"),
+    path("timeline/", views.timeline_view, name="timeline"),
+    path("timeline/data/", views.timeline_data, name="timeline-data"),
+    path("export/", views.export_data, name="export"),
+    path("patients/", views.patients_view, name="patients"),
+    path("metrics/", views.metrics_view, name="metrics"),
+    path("iob/", views.iob_view, name="iob"),
 ]
@@ -1,15 +1,25 @@
+from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, render, redirect
+from django.views.decorators.http import require_http_methods
 from django.views.generic import View, ListView, FormView
 from django.views.generic.base import ContextMixin
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import CreateView
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+    HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
+from django.db.models import Count, F, Sum
+
+from datetime import datetime, timedelta
 
 import logging
 logger = logging.getLogger(__name__)
 
-from meals.models import Dish, Meal
+# agp, iob, similarity and timeline pull in NumPy/Plotly; they are
+# imported by the views that use them to keep process startup fast
+from meals import archive, basal, coverage, export, metrics
+from meals.models import DetectedMeal, Dish, Meal, EventSeriesModel, \
+    GlucoseMeasurement, InsulinDelivery, Patient
 from meals.forms import DishForm, MealForm, SearchForm
 
 # Dish select or Add -> Meal Add and History
@@ -22,6 +32,203 @@ def index(request):
     logger.info("Hello, world")
     return HttpResponse("Hello, world")
 
+@login_required
+@require_http_methods(["GET", "POST"])
+def patients_view(request):
+    """List the user's patients; POSTing `patient` switches the session"""
+    from meals import patients
+    allowed = patients.accessible(request.user)
+    if request.method == "POST":
+        patient = get_object_or_404(allowed, pk=request.POST.get("patient"))
+        request.session[patients.SESSION_KEY] = patient.pk
+        return HttpResponseRedirect(reverse("meals:search"))
+    return render(request, "meals/patients.html", {
+        "patients": allowed,
+        "current": patients.current_id(),
+    })
+
+def metrics_view(request):
+    return HttpResponse(metrics.registry.exposition(),
+                        content_type="text/plain; version=0.0.4")
+
+def iob_view(request):
+    """Insulin-on-board series as JSON
+
+    Query parameters: start, end (ISO datetimes; end defaults to one day
+    after start, and may be at most iob.MAX_SPAN after it) and step
+    (minutes, default 5).
+    """
+    from meals import iob
+    try:
+        start = datetime.fromisoformat(request.GET["start"])
+        end = request.GET.get("end")
+        end = datetime.fromisoformat(end) if end else start + timedelta(days=1)
+        step = timedelta(minutes=int(request.GET.get("step", 5)))
+    except (KeyError, ValueError) as err:
+        return HttpResponseBadRequest("Invalid IOB query: %s" % err)
+    if end < start or step <= timedelta(0):
+        return HttpResponseBadRequest("Invalid IOB query range")
+    if end - start > iob.MAX_SPAN:
+        return HttpResponseBadRequest("IOB query range is limited to %s"
+                                      % iob.MAX_SPAN)
+
+    times, units = iob.insulin_on_board(start, end, step)
+    return JsonResponse({
+        "when": [t.isoformat() for t in times],
+        "iob": [round(float(u), 3) for u in units],
+    })
+
+def _neighbors(request):
+    """The k query parameter, or None if it is not a valid count"""
+    from meals import similarity
+    try:
+        k = int(request.GET.get("k", 10))
+    except ValueError:
+        return None
+    return k if 1 <= k <= similarity.MAX_NEIGHBORS else None
+
+def similar_dishes(request, pk):
+    """Dishes with the most similar average glucose response, as JSON"""
+    from meals import similarity
+    dish = get_object_or_404(Dish, pk=pk)
+    k = _neighbors(request)
+    if k is None:
+        return HttpResponseBadRequest("k must be between 1 and %d"
+                                      % similarity.MAX_NEIGHBORS)
+    matches = similarity.index().nearest_dishes(dish.pk, k)
+    names = Dish.objects.in_bulk([m[0] for m in matches])
+    return JsonResponse({
+        "dish": dish.desc,
+        "similar": [
+            {"pk": pk, "desc": names[pk].desc, "distance": round(d, 2)}
+            for (pk, d) in matches if pk in names
+        ],
+    })
+
+def similar_meals(request, pk):
+    """Meals with the most similar glucose response, as JSON"""
+    from meals import similarity
+    meal = get_object_or_404(Meal, pk=pk)
+    k = _neighbors(request)
+    if k is None:
+        return HttpResponseBadRequest("k must be between 1 and %d"
+                                      % similarity.MAX_NEIGHBORS)
+    matches = similarity.index().nearest_meals(meal.pk, k)
+    meals = Meal.objects.select_related("dish").in_bulk(
+        [m[0] for m in matches])
+    return JsonResponse({
+        "meal": str(meal),
+        "similar": [
+            {"pk": pk, "when": meals[pk].when.isoformat(),
+             "dish": meals[pk].dish.desc, "distance": round(d, 2)}
+            for (pk, d) in matches if pk in meals
+        ],
+    })
+
+def agp_report(request):
+    from meals import agp
+    try:
+        days = int(request.GET.get("days", agp.RANGES[0]))
+    except ValueError:
+        days = None
+    if days not in agp.RANGES:
+        return HttpResponseBadRequest("days must be one of %s"
+                                      % (agp.RANGES,))
+    result = agp.report(days)
+    return render(request, "meals/agp.html", {
+        "ranges": agp.RANGES,
+        "result": result,
+        "plot": agp.figure(result) if result["readings"] else None,
+    })
+
+def timeline_view(request):
+    """Day, week or month of CGM and boluses, downsampled to the plot width
+
+    Query parameters: span (day, week or month), end (ISO date; defaults
+    to the day of the latest reading) and width (pixels).
+    """
+    from meals import timeline
+    span = request.GET.get("span", "day")
+    if span not in timeline.SPANS:
+        return HttpResponseBadRequest("span must be one of %s"
+                                      % (list(timeline.SPANS),))
+    try:
+        end = request.GET.get("end")
+        if end:
+            end = datetime.fromisoformat(end)
+        else:
+            latest = (GlucoseMeasurement.objects.order_by("-when")
+                      .values_list("when", flat=True).first())
+            end = latest or datetime.now()
+        width = int(request.GET.get("width", timeline.DEFAULT_WIDTH))
+    except ValueError as err:
+        return HttpResponseBadRequest("Invalid timeline query: %s" % err)
+    end = datetime.combine(end.date() + timedelta(days=1),
+                           datetime.min.time())
+    start = end - timedelta(days=timeline.SPANS[span])
+
+    data = timeline.series(start, end, width)
+    step = timedelta(days=timeline.SPANS[span])
+    return render(request, "meals/timeline.html", {
+        "spans": timeline.SPANS,
+        "span": span,
+        "data": data,
+        "day": (end - timedelta(days=1)).date().isoformat(),
+        "previous": (end - step - timedelta(days=1)).date().isoformat(),
+        "next": (end + step - timedelta(days=1)).date().isoformat(),
+        "plot": (timeline.figure(data, reverse("meals:timeline-data"), width)
+                 if data["readings"] else None),
+    })
+
+def timeline_data(request):
+    """Downsampled CGM and bolus series for a zoomed timeline, as JSON
+
+    Query parameters: start, end (ISO datetimes, at most
+    timeline.MAX_SPAN apart) and width (pixels).
+    """
+    from meals import timeline
+    try:
+        start = datetime.fromisoformat(request.GET["start"])
+        end = datetime.fromisoformat(request.GET["end"])
+        width = int(request.GET.get("width", timeline.DEFAULT_WIDTH))
+    except (KeyError, ValueError) as err:
+        return HttpResponseBadRequest("Invalid timeline query: %s" % err)
+    if end <= start or width <= 0:
+        return HttpResponseBadRequest("Invalid timeline query range")
+    if end - start > timeline.MAX_SPAN:
+        return HttpResponseBadRequest("Timeline range is limited to %s"
+                                      % timeline.MAX_SPAN)
+    return JsonResponse(timeline.series(start, end, width))
+
+def export_data(request):
+    """Stream meals and event data as NDJSON or CSV
+
+    Query parameters: start, end (ISO datetimes, optional), kinds
+    (comma-separated subset of meals,cgm,bolus), format (ndjson or csv)
+    and gzip (1 to compress).
+    """
+    try:
+        start = request.GET.get("start")
+        start = datetime.fromisoformat(start) if start else None
+        end = request.GET.get("end")
+        end = datetime.fromisoformat(end) if end else None
+    except ValueError as err:
+        return HttpResponseBadRequest("Invalid export range: %s" % err)
+    kinds = request.GET.get("kinds", ",".join(export.KINDS)).split(",")
+    fmt = request.GET.get("format", "ndjson")
+    compress = request.GET.get("gzip") == "1"
+    if fmt not in export.FORMATS or not set(kinds) <= set(export.KINDS):
+        return HttpResponseBadRequest("Invalid export format or kinds")
+
+    filename = "bolushistory.%s%s" % (fmt, ".gz" if compress else "")
+    response = StreamingHttpResponse(
+        export.stream(kinds, start, end, fmt, compress),
+        content_type=("application/gzip" if compress
+                      else "text/csv" if fmt == "csv"
+                      else "application/x-ndjson"))
+    response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+    return response
+
 class MealListView(ListView):
     template_name = "meals/history.html"
     model = Dish
@@ -32,8 +239,44 @@ class MealListView(ListView):
         context = super().get_context_data(**kwargs)
         dish = get_object_or_404(Dish, pk=self.kwargs["pk"])
         # Display meals chronologically, most-recent first
-        meal_set = Meal.objects.filter(dish=dish).order_by('when').reverse()
+        meal_set = list(Meal.objects.filter(dish=dish)
+                        .select_related("plot")
+                        .annotate(insulin=Sum("boluses__amount"))
+                        .order_by('when').reverse())
+        # One coverage and one basal lookup for every meal on the page
+        if meal_set:
+            span = (EventSeriesModel.window(meal_set[-1].when)[0],
+                    EventSeriesModel.window(meal_set[0].when)[1])
+            index = coverage.CoverageIndex.load(*span)
+            basal_index = basal.BasalIndex.load(*span)
+            for meal in meal_set:
+                window = EventSeriesModel.window(meal.when)
+                meal.egv = index.has_data(*window)
+                meal.coverage = index.fraction(*window)
+                meal.basal = basal_index.total(*window)
+        # Archived boluses are not reached by the Sum annotations; only
+        # the months around each old meal are read
+        cold = {}
+        until = archive.archived_until(InsulinDelivery)
+        for meal in meal_set:
+            window = EventSeriesModel.window(meal.when)
+            if until is None or window[0] >= until:
+                continue
+            for bolus in archive.archived(InsulinDelivery, *window):
+                if bolus.meal_id == meal.pk:
+                    cold[meal.pk] = cold.get(meal.pk, 0) + bolus.amount
+            if meal.pk in cold:
+                meal.insulin = (meal.insulin or 0) + cold[meal.pk]
         context["dish"] = dish
+        stats = Meal.objects.filter(dish=dish).aggregate(
+            meals=Count("id", distinct=True),
+            total=Sum("boluses__amount"),
+        )
+        if cold:
+            stats["total"] = (stats["total"] or 0) + sum(cold.values())
+        if stats["meals"] and stats["total"] is not None:
+            stats["mean"] = stats["total"]/stats["meals"]
+        context["insulin_stats"] = stats
         context["meal_set"] = meal_set
         context["form"] = MealForm()
         context["showform"] = self.showform
@@ -70,7 +313,7 @@ class MealHistoryView(ContextMixin, View):
 
 class DishCreateView(CreateView):
     model = Dish
-    fields = ["desc"]
+    form_class = DishForm
 
     def form_valid(self, form):
         self.object = form.save()
@@ -80,6 +323,15 @@ class DishCreateView(CreateView):
                 )
             )
 
+class DetectedMealListView(ListView):
+    template_name = "meals/unlogged.html"
+    model = DetectedMeal
+    paginate_by = 50
+
+    def get_queryset(self):
+        # Most-recent first
+        return DetectedMeal.objects.order_by("-when")
+
 class MealCreateView(CreateView):
     form_class = MealForm
     model = Meal
@@ -122,6 +374,14 @@ def add_dish(request, initial=None):
                       "meals/dish_add.html",
                       { 'initial' : initial })
 
+# Orderings offered by the search page, from the DishSummary columns
+SEARCH_ORDERINGS = {
+    "name": F("desc").asc(),
+    "meals": F("summary__meals").desc(nulls_last=True),
+    "last": F("summary__last_eaten").desc(nulls_last=True),
+    "peak": F("summary__mean_peak").desc(nulls_last=True),
+}
+
 def search(request):
     logger.debug("views.search()")
     
@@ -148,7 +408,13 @@ def search(request):
                           )
     else:
         logger.debug("Initial render of meals/search")
+        sort = request.GET.get("sort")
+        if sort not in SEARCH_ORDERINGS:
+            sort = "last"
+        # One query: summaries are joined, not aggregated
+        dishes = Dish.objects.select_related("summary").order_by(
+            SEARCH_ORDERINGS[sort], "desc")
         return render(request,
                       "meals/search.html",
-                      { "object_list" : Dish.objects.all()}
+                      { "object_list" : dishes, "sort": sort }
                       )